@@ -1,37 +1,64 @@
 import asyncio
 import base64
+import difflib
+import functools
 import hashlib
+import importlib.metadata
+import importlib.util
 import io
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import socket
 import subprocess
+import tarfile
 import tempfile
+import threading
 import urllib.error
 import urllib.request
 import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 import asyncpg
-from fastapi import Depends, FastAPI, HTTPException, WebSocket, WebSocketDisconnect, status
-from fastapi.responses import JSONResponse
+import certifi
+import urllib3
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
+import minio
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 from passlib.context import CryptContext
 
+import ngram_index
+import yara_profiler
+import yara_worker
+
 app = FastAPI()
 logger = logging.getLogger("orchestrator")
 logging.basicConfig(level=logging.INFO)
 
 # agent_id -> websocket
 agents: Dict[str, WebSocket] = {}
-# agent_id -> asyncio.Queue of incoming messages from agent
-agent_queues: Dict[str, asyncio.Queue] = {}
+# job_id -> future resolved by the agent websocket loop with the job's result message
+job_waiters: Dict[str, asyncio.Future] = {}
+# job_id -> agent_id the waiting job was dispatched to
+job_agents: Dict[str, str] = {}
+# job_id -> (origin replica, agent_id, loop time) for jobs this replica relays to a local agent on behalf of another replica
+relayed_jobs: Dict[str, tuple[str, str, float]] = {}
+# job_id -> queues of long-poll/SSE listeners following the job's status transitions
+job_listeners: Dict[str, set] = {}
+# strong references to fire-and-forget tasks (async command jobs)
+_background_tasks: set = set()
 # agent_id -> runtime state
 agent_state: Dict[str, Dict[str, Any]] = {}
 
@@ -58,18 +85,157 @@ AGENT_CLEANUP_INTERVAL_SECONDS = int(os.getenv("AGENT_CLEANUP_INTERVAL_SECONDS",
 AGENT_AUTO_DELETE_EPHEMERAL = (os.getenv("AGENT_AUTO_DELETE_EPHEMERAL", "true").strip().lower() in {"1", "true", "yes", "on"})
 AGENT_ORPHAN_DELETE_SECONDS = int(os.getenv("AGENT_ORPHAN_DELETE_SECONDS", "21600"))
 AGENT_STALE_RETENTION_DAYS = int(os.getenv("AGENT_STALE_RETENTION_DAYS", "30"))
+AGENT_STATE_FLUSH_INTERVAL_SECONDS = float(os.getenv("AGENT_STATE_FLUSH_INTERVAL_SECONDS", "1.0"))
+AGENT_STATE_FLUSH_MAX_PENDING = int(os.getenv("AGENT_STATE_FLUSH_MAX_PENDING", "500"))
+INVENTORY_QUERY_MAX_LIMIT = int(os.getenv("INVENTORY_QUERY_MAX_LIMIT", "1000"))
+COMMAND_JOB_TIMEOUT_SECONDS = float(os.getenv("COMMAND_JOB_TIMEOUT_SECONDS", "15"))
+JOB_LONG_POLL_MAX_SECONDS = float(os.getenv("JOB_LONG_POLL_MAX_SECONDS", "30"))
+JOB_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("JOB_EVENTS_KEEPALIVE_SECONDS", "15"))
+BULK_PUSH_DEFAULT_CONCURRENCY = int(os.getenv("BULK_PUSH_DEFAULT_CONCURRENCY", "32"))
+BULK_PUSH_MAX_CONCURRENCY = int(os.getenv("BULK_PUSH_MAX_CONCURRENCY", "256"))
+BULK_PUSH_MAX_TARGETS = int(os.getenv("BULK_PUSH_MAX_TARGETS", "10000"))
+ORCHESTRATOR_ROUTING_ENABLED = (os.getenv("ORCHESTRATOR_ROUTING_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+ORCHESTRATOR_REPLICA_ID = (os.getenv("ORCHESTRATOR_REPLICA_ID", "") or "").strip() or f"{socket.gethostname()}-{os.getpid()}"
+ORCHESTRATOR_REPLICA_TTL_SECONDS = int(os.getenv("ORCHESTRATOR_REPLICA_TTL_SECONDS", "30"))
 YARA_STORAGE_ENABLED = (os.getenv("YARA_STORAGE_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
 YARA_STORAGE_ENDPOINT = os.getenv("YARA_STORAGE_ENDPOINT", "minio:9000")
 YARA_STORAGE_ACCESS_KEY = os.getenv("YARA_STORAGE_ACCESS_KEY", "yaragent")
 YARA_STORAGE_SECRET_KEY = os.getenv("YARA_STORAGE_SECRET_KEY", "yaragent-minio-secret")
 YARA_STORAGE_BUCKET = os.getenv("YARA_STORAGE_BUCKET", "yaragent-rules")
 YARA_STORAGE_USE_SSL = (os.getenv("YARA_STORAGE_USE_SSL", "false").strip().lower() in {"1", "true", "yes", "on"})
+YARA_STORAGE_MAX_CONNECTIONS = int(os.getenv("YARA_STORAGE_MAX_CONNECTIONS", "32"))
+YARA_STORAGE_THREADS = int(os.getenv("YARA_STORAGE_THREADS", "16"))
+YARA_STORAGE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("YARA_STORAGE_CONNECT_TIMEOUT_SECONDS", "5"))
+YARA_STORAGE_READ_TIMEOUT_SECONDS = float(os.getenv("YARA_STORAGE_READ_TIMEOUT_SECONDS", "60"))
+YARA_STORAGE_RETRIES = int(os.getenv("YARA_STORAGE_RETRIES", "3"))
+YARA_STORAGE_RETRY_BACKOFF_SECONDS = float(os.getenv("YARA_STORAGE_RETRY_BACKOFF_SECONDS", "0.2"))
+YARA_RULE_LIST_DEFAULT_LIMIT = int(os.getenv("YARA_RULE_LIST_DEFAULT_LIMIT", "200"))
+YARA_RULE_LIST_MAX_LIMIT = int(os.getenv("YARA_RULE_LIST_MAX_LIMIT", "1000"))
+YARA_METADATA_SYNC_ENABLED = (os.getenv("YARA_METADATA_SYNC_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+YARA_METADATA_SYNC_INTERVAL_SECONDS = float(os.getenv("YARA_METADATA_SYNC_INTERVAL_SECONDS", "300"))
+YARA_METADATA_SYNC_BATCH_SIZE = int(os.getenv("YARA_METADATA_SYNC_BATCH_SIZE", "1000"))
+YARA_ARCHIVE_MAX_BYTES = int(os.getenv("YARA_ARCHIVE_MAX_BYTES", str(256 * 1024 * 1024)))
+YARA_ARCHIVE_MAX_FILES = int(os.getenv("YARA_ARCHIVE_MAX_FILES", "50000"))
+YARA_ARCHIVE_CONCURRENCY = int(os.getenv("YARA_ARCHIVE_CONCURRENCY", "8"))
+RULE_VERSION_LIST_MAX_LIMIT = int(os.getenv("RULE_VERSION_LIST_MAX_LIMIT", "200"))
+RULE_DIFF_CACHE_MAX_ENTRIES = int(os.getenv("RULE_DIFF_CACHE_MAX_ENTRIES", "256"))
+RULE_INDEX_INTERVAL_SECONDS = float(os.getenv("RULE_INDEX_INTERVAL_SECONDS", "300"))
+RULE_INDEX_BATCH_SIZE = int(os.getenv("RULE_INDEX_BATCH_SIZE", "100"))
+RULE_INDEX_CLAIM_SECONDS = int(os.getenv("RULE_INDEX_CLAIM_SECONDS", "300"))
+RULE_SEARCH_MAX_LIMIT = int(os.getenv("RULE_SEARCH_MAX_LIMIT", "200"))
+RULE_CONTENT_CACHE_MAX_BYTES = int(os.getenv("RULE_CONTENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+YARA_COMPILER_WORKERS = int(os.getenv("YARA_COMPILER_WORKERS", "4"))
+YARA_COMPILER_TIMEOUT_SECONDS = float(os.getenv("YARA_COMPILER_TIMEOUT_SECONDS", "10"))
+YARA_COMPILER_MEMORY_LIMIT_MB = int(os.getenv("YARA_COMPILER_MEMORY_LIMIT_MB", "512"))
+YARA_VALIDATE_BATCH_MAX_RULES = int(os.getenv("YARA_VALIDATE_BATCH_MAX_RULES", "1000"))
+YARA_VALIDATE_BATCH_MAX_BYTES = int(os.getenv("YARA_VALIDATE_BATCH_MAX_BYTES", str(64 * 1024 * 1024)))
+YARA_VALIDATE_BATCH_CONCURRENCY = int(os.getenv("YARA_VALIDATE_BATCH_CONCURRENCY", "16"))
+RULE_PERF_MAX_COST = float(os.getenv("RULE_PERF_MAX_COST", "0"))
+RULE_PERF_CACHE_MAX_ENTRIES = int(os.getenv("RULE_PERF_CACHE_MAX_ENTRIES", "256"))
+RULE_PROFILE_CORPUS_DIR = os.getenv("RULE_PROFILE_CORPUS_DIR", "").strip()
+RULE_PROFILE_WORKERS = int(os.getenv("RULE_PROFILE_WORKERS", "4"))
+RULE_PROFILE_FILE_TIMEOUT_SECONDS = int(os.getenv("RULE_PROFILE_FILE_TIMEOUT_SECONDS", "30"))
+RULE_PROFILE_MAX_FILES = int(os.getenv("RULE_PROFILE_MAX_FILES", "10000"))
+RULE_PROFILE_MAX_FILE_BYTES = int(os.getenv("RULE_PROFILE_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+RETROHUNT_ENABLED = (os.getenv("RETROHUNT_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+RETROHUNT_CORPUS_DIR = os.getenv("RETROHUNT_CORPUS_DIR", "").strip()
+RETROHUNT_SAMPLE_BUCKET = os.getenv("RETROHUNT_SAMPLE_BUCKET", YARA_STORAGE_BUCKET)
+RETROHUNT_WORKERS = int(os.getenv("RETROHUNT_WORKERS", "4"))
+RETROHUNT_MAX_JOBS = int(os.getenv("RETROHUNT_MAX_JOBS", "2"))
+RETROHUNT_MAX_JOBS_PER_TENANT = int(os.getenv("RETROHUNT_MAX_JOBS_PER_TENANT", "1"))
+RETROHUNT_SHARD_SIZE = int(os.getenv("RETROHUNT_SHARD_SIZE", "500"))
+RETROHUNT_MAX_SAMPLES = int(os.getenv("RETROHUNT_MAX_SAMPLES", "1000000"))
+RETROHUNT_MAX_SAMPLE_BYTES = int(os.getenv("RETROHUNT_MAX_SAMPLE_BYTES", str(128 * 1024 * 1024)))
+RETROHUNT_FILE_TIMEOUT_SECONDS = int(os.getenv("RETROHUNT_FILE_TIMEOUT_SECONDS", "60"))
+RETROHUNT_HEARTBEAT_SECONDS = float(os.getenv("RETROHUNT_HEARTBEAT_SECONDS", "10"))
+RETROHUNT_STALE_SECONDS = int(os.getenv("RETROHUNT_STALE_SECONDS", "120"))
+RETROHUNT_POLL_SECONDS = float(os.getenv("RETROHUNT_POLL_SECONDS", "5"))
+RETROHUNT_INDEX_DIR = os.getenv("RETROHUNT_INDEX_DIR", "").strip()
+RETROHUNT_INDEX_GRAM = int(os.getenv("RETROHUNT_INDEX_GRAM", "3"))
+RETROHUNT_INDEX_MAX_FILE_BYTES = int(os.getenv("RETROHUNT_INDEX_MAX_FILE_BYTES", str(32 * 1024 * 1024)))
+RETROHUNT_INDEX_INTERVAL_SECONDS = int(os.getenv("RETROHUNT_INDEX_INTERVAL_SECONDS", "0"))
+VALIDATION_CACHE_MAX_ENTRIES = int(os.getenv("VALIDATION_CACHE_MAX_ENTRIES", "4096"))
+VALIDATION_CACHE_DB_ENABLED = (os.getenv("VALIDATION_CACHE_DB_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+VALIDATION_CACHE_DB_TTL_HOURS = int(os.getenv("VALIDATION_CACHE_DB_TTL_HOURS", "168"))
+COMPILED_RULES_ENABLED = (os.getenv("COMPILED_RULES_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+COMPILED_RULE_CACHE_DIR = os.getenv("COMPILED_RULE_CACHE_DIR", "/tmp/yaragent-compiled")
+COMPILED_RULE_CACHE_MAX_BYTES = int(os.getenv("COMPILED_RULE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+COMPILED_RULE_INLINE_MAX_BYTES = int(os.getenv("COMPILED_RULE_INLINE_MAX_BYTES", str(256 * 1024)))
+POLICY_RECONCILE_ENABLED = (os.getenv("POLICY_RECONCILE_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"})
+POLICY_RECONCILE_INTERVAL_SECONDS = float(os.getenv("POLICY_RECONCILE_INTERVAL_SECONDS", "30"))
+POLICY_RECONCILE_PUSHES_PER_SECOND = float(os.getenv("POLICY_RECONCILE_PUSHES_PER_SECOND", "20"))
+POLICY_RECONCILE_MAX_IN_FLIGHT = int(os.getenv("POLICY_RECONCILE_MAX_IN_FLIGHT", "64"))
+POLICY_RECONCILE_RETRY_BASE_SECONDS = float(os.getenv("POLICY_RECONCILE_RETRY_BASE_SECONDS", "10"))
+POLICY_RECONCILE_RETRY_MAX_SECONDS = float(os.getenv("POLICY_RECONCILE_RETRY_MAX_SECONDS", "900"))
 GEMINI_API_KEY = (os.getenv("GEMINI_API_KEY", "") or os.getenv("VERTEX_API_KEY", "")).strip()
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash").strip()
 GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").strip()
 
 _db_pool: Optional[asyncpg.Pool] = None
 _cleanup_task: Optional[asyncio.Task] = None
+_agent_state_flush_task: Optional[asyncio.Task] = None
+_replica_task: Optional[asyncio.Task] = None
+_replica_listener: Optional[asyncpg.Connection] = None
+_policy_reconcile_task: Optional[asyncio.Task] = None
+_metadata_sync_task: Optional[asyncio.Task] = None
+_rule_index_task: Optional[asyncio.Task] = None
+_rule_index_wakeup = asyncio.Event()
+_minio: Optional[Minio] = None
+_minio_http: Optional[urllib3.PoolManager] = None
+_storage_executor: Optional[ThreadPoolExecutor] = None
+_yara_compiler_idle: Optional[asyncio.Queue] = None
+_yara_compiler_workers: list[dict] = []
+# blocking MinIO calls submitted to / currently running on the storage executor
+_storage_calls_queued = 0
+_storage_calls_running = 0
+# _storage_calls_running is updated from the storage executor threads
+_storage_calls_lock = threading.Lock()
+_policy_reconcile_wakeup = asyncio.Event()
+# agents/tenants to look at on the next reconcile pass; the periodic sweep covers everything else
+_policy_reconcile_agents: set[str] = set()
+_policy_reconcile_tenants: set[str] = set()
+_policy_reconcile_in_flight: set[str] = set()
+# agent_id -> (consecutive failures, loop time before which it is not retried)
+_policy_reconcile_backoff: Dict[str, Tuple[int, float]] = {}
+# tenant_id -> bundle version held back because a rule exceeds the tenant's max_rule_cost
+_policy_reconcile_blocked: Dict[str, str] = {}
+# compiled ruleset cache key -> size in bytes on local disk, least recently used first
+_compiled_disk_index: "OrderedDict[str, int]" = OrderedDict()
+_compiled_disk_loaded = False
+# guards _compiled_disk_index and _compiled_disk_loaded; the disk cache is used from worker threads
+_compiled_disk_lock = threading.Lock()
+# compiled ruleset cache key -> in-flight lookup/compile shared by concurrent callers
+_compile_inflight: Dict[str, asyncio.Future] = {}
+# (tenant_id, rule name) -> {"sha256", "etag", "size_bytes", "content"}, least recently used first
+_rule_content_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_rule_content_cache_bytes = 0
+# (from sha256, to sha256) -> unified diff hunks, least recently used first; the ---/+++ headers
+# name the tenant's rule and versions, so they are added per request
+_rule_diff_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+# validation cache key -> validation result, least recently used first
+_validation_cache: "OrderedDict[str, dict]" = OrderedDict()
+# content sha256 -> static performance analysis, least recently used first
+_rule_perf_cache: "OrderedDict[str, dict]" = OrderedDict()
+# _rule_performance runs on worker threads
+_rule_perf_cache_lock = threading.Lock()
+_retrohunt_task: Optional[asyncio.Task] = None
+_retrohunt_index_task: Optional[asyncio.Task] = None
+_retrohunt_wakeup = asyncio.Event()
+# retro-hunt job id -> runner task on this replica
+_retrohunt_running: Dict[str, asyncio.Task] = {}
+# one corpus profile at a time per replica; each already fans out over RULE_PROFILE_WORKERS processes
+_rule_profile_lock = asyncio.Lock()
+# validation cache key -> in-flight compile shared by identical concurrent requests
+_validation_inflight: Dict[str, asyncio.Future] = {}
+# tenant_id -> last built ruleset bundle (version, sha256, manifest, content, per-rule sources)
+_tenant_bundles: Dict[str, Dict[str, Any]] = {}
+_tenant_bundle_locks: Dict[str, asyncio.Lock] = {}
+# agent_id -> merged control-state fields waiting for the next batched flush
+_pending_agent_writes: Dict[str, Dict[str, Any]] = {}
+# agent_id -> latest SBOM/CVE snapshot waiting to be diffed into agent_packages/agent_cves
+_pending_inventory_writes: Dict[str, Dict[str, Any]] = {}
+_pending_agent_writes_ready = asyncio.Event()
+_agent_state_flush_lock = asyncio.Lock()
 
 
 def create_access_token(subject: str) -> str:
@@ -85,6 +251,18 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
+def _pg_connect_kwargs() -> Dict[str, Any]:
+    if DATABASE_URL:
+        return {"dsn": DATABASE_URL}
+    return {
+        "host": POSTGRES_HOST,
+        "port": POSTGRES_PORT,
+        "user": POSTGRES_USER,
+        "password": POSTGRES_PASSWORD,
+        "database": POSTGRES_DB,
+    }
+
+
 async def _db() -> asyncpg.Pool:
     if _db_pool is None:
         raise HTTPException(status_code=500, detail="database not initialized")
@@ -106,95 +284,380 @@ async def _is_initialized() -> bool:
         return bool(row and row["count"] > 0)
 
 
-async def _upsert_agent_control_state(
+_AGENT_STATE_FIELDS = (
+    "tenant_id",
+    "status_value",
+    "connected_at",
+    "last_seen",
+    "last_heartbeat",
+    "capabilities",
+    "policy_version",
+    "policy_hash",
+    "last_policy_result",
+    "is_ephemeral",
+    "instance_id",
+    "runtime_kind",
+    "lease_expires_at",
+    "asset_profile",
+    "findings_count",
+    "policy_pinned",
+)
+_AGENT_STATE_JSON_FIELDS = {"capabilities", "asset_profile"}
+_AGENT_STATE_UNNEST = """
+    unnest(
+        $1::text[], $2::text[], $3::text[], $4::timestamptz[], $5::timestamptz[], $6::timestamptz[],
+        $7::text[], $8::text[], $9::text[], $10::text[], $11::boolean[], $12::text[], $13::text[],
+        $14::timestamptz[], $15::text[], $16::int[], $17::boolean[]
+    ) AS t(
+        agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
+        capabilities_json, policy_version, policy_hash, last_policy_result,
+        is_ephemeral, instance_id, runtime_kind, lease_expires_at,
+        asset_profile_json, findings_count, policy_pinned
+    )
+"""
+_AGENT_STATE_UPDATE_SQL = f"""
+    UPDATE agents_control_state a SET
+        tenant_id = COALESCE(t.tenant_id, a.tenant_id),
+        status = COALESCE(t.status, a.status),
+        connected_at = COALESCE(t.connected_at, a.connected_at),
+        last_seen = COALESCE(t.last_seen, a.last_seen),
+        last_heartbeat = COALESCE(t.last_heartbeat, a.last_heartbeat),
+        capabilities_json = COALESCE(t.capabilities_json::jsonb, a.capabilities_json),
+        policy_version = COALESCE(t.policy_version, a.policy_version),
+        policy_hash = COALESCE(t.policy_hash, a.policy_hash),
+        last_policy_applied_at = CASE
+            WHEN t.policy_version IS NOT NULL OR t.policy_hash IS NOT NULL OR t.last_policy_result IS NOT NULL
+                THEN now()
+            ELSE a.last_policy_applied_at
+        END,
+        last_policy_result = COALESCE(t.last_policy_result, a.last_policy_result),
+        is_ephemeral = COALESCE(t.is_ephemeral, a.is_ephemeral),
+        instance_id = COALESCE(t.instance_id, a.instance_id),
+        runtime_kind = COALESCE(t.runtime_kind, a.runtime_kind),
+        lease_expires_at = COALESCE(t.lease_expires_at, a.lease_expires_at),
+        asset_profile_json = COALESCE(t.asset_profile_json::jsonb, a.asset_profile_json),
+        findings_count = COALESCE(t.findings_count, a.findings_count),
+        policy_pinned = COALESCE(t.policy_pinned, a.policy_pinned),
+        updated_at = now()
+    FROM {_AGENT_STATE_UNNEST}
+    WHERE a.agent_id = t.agent_id
+    RETURNING a.agent_id
+"""
+_AGENT_STATE_INSERT_SQL = f"""
+    INSERT INTO agents_control_state (
+        agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
+        capabilities_json, policy_version, policy_hash, last_policy_applied_at,
+        last_policy_result, is_ephemeral, instance_id, runtime_kind, lease_expires_at,
+        asset_profile_json, findings_count, policy_pinned, updated_at
+    )
+    SELECT
+        t.agent_id, COALESCE(t.tenant_id, 'default'), COALESCE(t.status, 'disconnected'),
+        t.connected_at, t.last_seen, t.last_heartbeat,
+        COALESCE(t.capabilities_json::jsonb, '{{}}'::jsonb), t.policy_version, t.policy_hash,
+        CASE
+            WHEN t.policy_version IS NOT NULL OR t.policy_hash IS NOT NULL OR t.last_policy_result IS NOT NULL THEN now()
+            ELSE NULL
+        END,
+        t.last_policy_result, COALESCE(t.is_ephemeral, false), t.instance_id, t.runtime_kind, t.lease_expires_at,
+        COALESCE(t.asset_profile_json::jsonb, '{{}}'::jsonb), COALESCE(t.findings_count, 0),
+        COALESCE(t.policy_pinned, false), now()
+    FROM {_AGENT_STATE_UNNEST}
+    ON CONFLICT (agent_id) DO NOTHING
+    RETURNING agent_id
+"""
+
+
+async def _upsert_agent_control_state_batch(rows: Dict[str, Dict[str, Any]]) -> None:
+    """Write merged control-state changes for many agents in one transaction.
+
+    Fields that are missing or None keep the value already stored for the agent.
+    """
+    if not rows:
+        return
+    agent_ids = list(rows.keys())
+    columns: Dict[str, list] = {field: [] for field in _AGENT_STATE_FIELDS}
+    for agent_id in agent_ids:
+        fields = rows[agent_id]
+        for field in _AGENT_STATE_FIELDS:
+            value = fields.get(field)
+            # Snapshots may arrive pre-encoded from _snapshot_fingerprint.
+            if field in _AGENT_STATE_JSON_FIELDS and value is not None and not isinstance(value, str):
+                value = json.dumps(value)
+            columns[field].append(value)
+    connected_ids = [
+        aid for aid in agent_ids if (rows[aid].get("status_value") or "").strip().lower() == "connected"
+    ]
+
+    index = {aid: i for i, aid in enumerate(agent_ids)}
+
+    def _args(ids: list[str]) -> list:
+        positions = [index[aid] for aid in ids]
+        return [ids, *([columns[field][i] for i in positions] for field in _AGENT_STATE_FIELDS)]
+
+    db = await _db()
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            # UPDATE re-reads the latest row version, so "None keeps the stored value" holds
+            # even when another writer touched the same agent concurrently.
+            updated = {str(r["agent_id"]) for r in await conn.fetch(_AGENT_STATE_UPDATE_SQL, *_args(agent_ids))}
+            missing = [aid for aid in agent_ids if aid not in updated]
+            if missing:
+                inserted = {str(r["agent_id"]) for r in await conn.fetch(_AGENT_STATE_INSERT_SQL, *_args(missing))}
+                raced = [aid for aid in missing if aid not in inserted]
+                if raced:
+                    await conn.fetch(_AGENT_STATE_UPDATE_SQL, *_args(raced))
+            if connected_ids:
+                await _restore_if_archived(conn, connected_ids)
+
+
+async def _upsert_agent_control_state(agent_id: str, **fields: Any) -> None:
+    unknown = set(fields) - set(_AGENT_STATE_FIELDS)
+    if unknown:
+        raise TypeError(f"unknown agent control state fields: {sorted(unknown)}")
+    await _upsert_agent_control_state_batch({agent_id: fields})
+
+
+def _merge_agent_state_fields(target: Dict[str, Any], fields: Dict[str, Any]) -> None:
+    for key, value in fields.items():
+        if value is not None:
+            target[key] = value
+
+
+def _queue_agent_control_state(agent_id: str, **fields: Any) -> None:
+    """Merge a control-state change into the write-behind buffer.
+
+    The buffer is flushed by `_agent_state_flush_loop` at most
+    AGENT_STATE_FLUSH_INTERVAL_SECONDS later, or sooner once
+    AGENT_STATE_FLUSH_MAX_PENDING agents are waiting.
+    """
+    unknown = set(fields) - set(_AGENT_STATE_FIELDS)
+    if unknown:
+        raise TypeError(f"unknown agent control state fields: {sorted(unknown)}")
+    pending = _pending_agent_writes.setdefault(agent_id, {})
+    _merge_agent_state_fields(pending, fields)
+    if len(_pending_agent_writes) >= max(1, AGENT_STATE_FLUSH_MAX_PENDING):
+        _pending_agent_writes_ready.set()
+
+
+async def _write_through_agent_control_state(agent_id: str, **fields: Any) -> None:
+    # Writes that must be visible immediately (connect) also carry whatever is still
+    # buffered for the agent, so an older buffered change can never land after them.
+    async with _agent_state_flush_lock:
+        merged = _pending_agent_writes.pop(agent_id, {})
+        _merge_agent_state_fields(merged, fields)
+        await _upsert_agent_control_state(agent_id, **merged)
+
+
+def _normalize_sbom(items: list) -> Dict[tuple, dict]:
+    packages: Dict[tuple, dict] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        name = _safe_string(item.get("name")).strip()
+        if not name:
+            continue
+        version = _safe_string(item.get("version")).strip()
+        ecosystem = _safe_string(item.get("type") or item.get("ecosystem")).strip().lower()
+        packages[(name, version, ecosystem)] = item
+    return packages
+
+
+def _normalize_cves(items: list) -> Dict[tuple, dict]:
+    cves: Dict[tuple, dict] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        cve_id = _safe_string(item.get("id") or item.get("cve_id") or item.get("cve")).strip().upper()
+        if not cve_id:
+            continue
+        package = _safe_string(item.get("package") or item.get("component") or item.get("name")).strip()
+        cves[(cve_id, package)] = item
+    return cves
+
+
+def _queue_agent_inventory(
     agent_id: str,
     *,
-    tenant_id: Optional[str] = None,
-    status_value: Optional[str] = None,
-    connected_at: Optional[datetime] = None,
-    last_seen: Optional[datetime] = None,
-    last_heartbeat: Optional[datetime] = None,
-    capabilities: Optional[dict] = None,
-    policy_version: Optional[str] = None,
-    policy_hash: Optional[str] = None,
-    last_policy_result: Optional[str] = None,
-    is_ephemeral: Optional[bool] = None,
-    instance_id: Optional[str] = None,
-    runtime_kind: Optional[str] = None,
-    lease_expires_at: Optional[datetime] = None,
-    asset_profile: Optional[dict] = None,
-    sbom_snapshot: Optional[list] = None,
-    cve_snapshot: Optional[list] = None,
-    findings_count: Optional[int] = None,
+    tenant_id: str,
+    sbom: Optional[list] = None,
+    cves: Optional[list] = None,
 ) -> None:
+    pending = _pending_inventory_writes.setdefault(agent_id, {})
+    _merge_agent_state_fields(pending, {"tenant_id": tenant_id, "sbom": sbom, "cves": cves})
+
+
+async def _sync_agent_packages(conn: asyncpg.Connection, agent_id: str, tenant_id: str, sbom: list) -> None:
+    packages = _normalize_sbom(sbom)
+    keys = list(packages.keys())
+    names = [k[0] for k in keys]
+    versions = [k[1] for k in keys]
+    ecosystems = [k[2] for k in keys]
+    await conn.execute(
+        """
+        DELETE FROM agent_packages p
+        WHERE p.agent_id = $1
+          AND NOT EXISTS (
+            SELECT 1
+            FROM unnest($2::text[], $3::text[], $4::text[]) AS t(name, version, ecosystem)
+            WHERE t.name = p.name AND t.version = p.version AND t.ecosystem = p.ecosystem
+          )
+        """,
+        agent_id,
+        names,
+        versions,
+        ecosystems,
+    )
+    if not keys:
+        return
+    # Rows whose tenant and attributes are unchanged are skipped by the WHERE clause.
+    await conn.execute(
+        """
+        INSERT INTO agent_packages (agent_id, tenant_id, name, version, ecosystem, attributes_json)
+        SELECT $1, $2, t.name, t.version, t.ecosystem, t.attributes_json::jsonb
+        FROM unnest($3::text[], $4::text[], $5::text[], $6::text[]) AS t(name, version, ecosystem, attributes_json)
+        ON CONFLICT (agent_id, name, version, ecosystem) DO UPDATE SET
+            tenant_id = EXCLUDED.tenant_id,
+            attributes_json = EXCLUDED.attributes_json,
+            updated_at = now()
+        WHERE agent_packages.tenant_id IS DISTINCT FROM EXCLUDED.tenant_id
+           OR agent_packages.attributes_json IS DISTINCT FROM EXCLUDED.attributes_json
+        """,
+        agent_id,
+        tenant_id,
+        names,
+        versions,
+        ecosystems,
+        [json.dumps(packages[k]) for k in keys],
+    )
+
+
+async def _sync_agent_cves(conn: asyncpg.Connection, agent_id: str, tenant_id: str, cve_items: list) -> None:
+    cves = _normalize_cves(cve_items)
+    keys = list(cves.keys())
+    cve_ids = [k[0] for k in keys]
+    packages = [k[1] for k in keys]
+    await conn.execute(
+        """
+        DELETE FROM agent_cves c
+        WHERE c.agent_id = $1
+          AND NOT EXISTS (
+            SELECT 1
+            FROM unnest($2::text[], $3::text[]) AS t(cve_id, package)
+            WHERE t.cve_id = c.cve_id AND t.package = c.package
+          )
+        """,
+        agent_id,
+        cve_ids,
+        packages,
+    )
+    if not keys:
+        return
+    await conn.execute(
+        """
+        INSERT INTO agent_cves (agent_id, tenant_id, cve_id, package, severity, status, attributes_json)
+        SELECT $1, $2, t.cve_id, t.package, t.severity, t.status, t.attributes_json::jsonb
+        FROM unnest($3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+            AS t(cve_id, package, severity, status, attributes_json)
+        ON CONFLICT (agent_id, cve_id, package) DO UPDATE SET
+            tenant_id = EXCLUDED.tenant_id,
+            severity = EXCLUDED.severity,
+            status = EXCLUDED.status,
+            attributes_json = EXCLUDED.attributes_json,
+            updated_at = now()
+        WHERE agent_cves.tenant_id IS DISTINCT FROM EXCLUDED.tenant_id
+           OR agent_cves.attributes_json IS DISTINCT FROM EXCLUDED.attributes_json
+        """,
+        agent_id,
+        tenant_id,
+        cve_ids,
+        packages,
+        [_safe_string(cves[k].get("severity")).strip().lower() or None for k in keys],
+        [_safe_string(cves[k].get("status")).strip().lower() or None for k in keys],
+        [json.dumps(cves[k]) for k in keys],
+    )
+
+
+async def _sync_agent_inventory_batch(rows: Dict[str, Dict[str, Any]]) -> None:
+    if not rows:
+        return
     db = await _db()
     async with db.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO agents_control_state (
-                agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
-                capabilities_json, policy_version, policy_hash, last_policy_applied_at,
-                last_policy_result, is_ephemeral, instance_id, runtime_kind, lease_expires_at,
-                asset_profile_json, sbom_json, cve_json, findings_count, updated_at
-            )
-            VALUES (
-                $1::text, COALESCE($2::text, 'default'), COALESCE($3::text, 'disconnected'),
-                $4::timestamptz, $5::timestamptz, $6::timestamptz,
-                COALESCE($7::jsonb, '{}'::jsonb), $8::text, $9::text,
-                CASE
-                    WHEN $8::text IS NOT NULL OR $9::text IS NOT NULL OR $10::text IS NOT NULL THEN now()
-                    ELSE NULL
-                END,
-                $10::text, COALESCE($11::boolean, false), $12::text, $13::text, $14::timestamptz,
-                COALESCE($15::jsonb, '{}'::jsonb), COALESCE($16::jsonb, '[]'::jsonb), COALESCE($17::jsonb, '[]'::jsonb), COALESCE($18::int, 0),
-                now()
-            )
-            ON CONFLICT (agent_id) DO UPDATE SET
-                tenant_id = COALESCE(EXCLUDED.tenant_id, agents_control_state.tenant_id),
-                status = COALESCE(EXCLUDED.status, agents_control_state.status),
-                connected_at = COALESCE(EXCLUDED.connected_at, agents_control_state.connected_at),
-                last_seen = COALESCE(EXCLUDED.last_seen, agents_control_state.last_seen),
-                last_heartbeat = COALESCE(EXCLUDED.last_heartbeat, agents_control_state.last_heartbeat),
-                capabilities_json = COALESCE(EXCLUDED.capabilities_json, agents_control_state.capabilities_json),
-                policy_version = COALESCE(EXCLUDED.policy_version, agents_control_state.policy_version),
-                policy_hash = COALESCE(EXCLUDED.policy_hash, agents_control_state.policy_hash),
-                last_policy_applied_at = CASE
-                    WHEN EXCLUDED.policy_version IS NOT NULL OR EXCLUDED.policy_hash IS NOT NULL OR EXCLUDED.last_policy_result IS NOT NULL
-                        THEN now()
-                    ELSE agents_control_state.last_policy_applied_at
-                END,
-                last_policy_result = COALESCE(EXCLUDED.last_policy_result, agents_control_state.last_policy_result),
-                is_ephemeral = COALESCE(EXCLUDED.is_ephemeral, agents_control_state.is_ephemeral),
-                instance_id = COALESCE(EXCLUDED.instance_id, agents_control_state.instance_id),
-                runtime_kind = COALESCE(EXCLUDED.runtime_kind, agents_control_state.runtime_kind),
-                lease_expires_at = COALESCE(EXCLUDED.lease_expires_at, agents_control_state.lease_expires_at),
-                asset_profile_json = COALESCE(EXCLUDED.asset_profile_json, agents_control_state.asset_profile_json),
-                sbom_json = COALESCE(EXCLUDED.sbom_json, agents_control_state.sbom_json),
-                cve_json = COALESCE(EXCLUDED.cve_json, agents_control_state.cve_json),
-                findings_count = COALESCE(EXCLUDED.findings_count, agents_control_state.findings_count),
-                updated_at = now()
-            """,
-            agent_id,
-            tenant_id,
-            status_value,
-            connected_at,
-            last_seen,
-            last_heartbeat,
-            json.dumps(capabilities) if capabilities is not None else None,
-            policy_version,
-            policy_hash,
-            last_policy_result,
-            is_ephemeral,
-            instance_id,
-            runtime_kind,
-            lease_expires_at,
-            json.dumps(asset_profile) if asset_profile is not None else None,
-            json.dumps(sbom_snapshot) if sbom_snapshot is not None else None,
-            json.dumps(cve_snapshot) if cve_snapshot is not None else None,
-            findings_count,
-        )
-        if (status_value or "").strip().lower() == "connected":
-            await _restore_if_archived(conn, agent_id)
+        async with conn.transaction():
+            for agent_id, fields in rows.items():
+                tenant_id = fields.get("tenant_id") or "default"
+                if fields.get("sbom") is not None:
+                    await _sync_agent_packages(conn, agent_id, tenant_id, fields["sbom"])
+                if fields.get("cves") is not None:
+                    await _sync_agent_cves(conn, agent_id, tenant_id, fields["cves"])
+
+
+async def _delete_agent_inventory(conn: asyncpg.Connection, agent_ids: list[str]) -> None:
+    await conn.execute("DELETE FROM agent_packages WHERE agent_id = ANY($1::text[])", agent_ids)
+    await conn.execute("DELETE FROM agent_cves WHERE agent_id = ANY($1::text[])", agent_ids)
+
+
+def _requeue_pending(pending: Dict[str, Dict[str, Any]], batch: Dict[str, Dict[str, Any]]) -> None:
+    # Put a failed batch back underneath anything queued while it was being written.
+    for agent_id, fields in batch.items():
+        newer = pending.get(agent_id)
+        if newer is not None:
+            _merge_agent_state_fields(fields, newer)
+        pending[agent_id] = fields
+
+
+async def _flush_agent_control_state() -> int:
+    async with _agent_state_flush_lock:
+        if not _pending_agent_writes and not _pending_inventory_writes:
+            return 0
+        batch = dict(_pending_agent_writes)
+        inventory = dict(_pending_inventory_writes)
+        _pending_agent_writes.clear()
+        _pending_inventory_writes.clear()
+        _pending_agent_writes_ready.clear()
+        try:
+            await _upsert_agent_control_state_batch(batch)
+        except Exception:
+            _requeue_pending(_pending_agent_writes, batch)
+            _requeue_pending(_pending_inventory_writes, inventory)
+            raise
+        try:
+            await _sync_agent_inventory_batch(inventory)
+        except Exception:
+            _requeue_pending(_pending_inventory_writes, inventory)
+            raise
+        return len(batch)
+
+
+async def _agent_state_flush_loop() -> None:
+    interval = max(0.05, AGENT_STATE_FLUSH_INTERVAL_SECONDS)
+    while True:
+        try:
+            await asyncio.wait_for(_pending_agent_writes_ready.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await _flush_agent_control_state()
+        except Exception:
+            logger.exception("agent state flush failed")
+            await asyncio.sleep(interval)
+
+
+def _snapshot_fingerprint(value: Any) -> tuple[str, str]:
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=16).hexdigest(), encoded
+
+
+def _changed_snapshots(state: Dict[str, Any], snapshots: Dict[str, Any]) -> Dict[str, str]:
+    """Return encoded snapshots whose content hash differs from the last one queued for this agent."""
+    hashes = state.setdefault("snapshot_hashes", {})
+    changed: Dict[str, str] = {}
+    for field, value in snapshots.items():
+        digest, encoded = _snapshot_fingerprint(value)
+        if hashes.get(field) == digest:
+            continue
+        hashes[field] = digest
+        changed[field] = encoded
+    return changed
 
 
 def _is_truthy(value: Any) -> bool:
@@ -216,8 +679,8 @@ def _inactive_threshold_seconds() -> int:
     return max(AGENT_STALE_SECONDS, from_heartbeat)
 
 
-async def _restore_if_archived(conn: asyncpg.Connection, agent_id: str) -> None:
-    await conn.execute("DELETE FROM agents_stale_state WHERE agent_id = $1", agent_id)
+async def _restore_if_archived(conn: asyncpg.Connection, agent_ids: list[str]) -> None:
+    await conn.execute("DELETE FROM agents_stale_state WHERE agent_id = ANY($1::text[])", agent_ids)
 
 
 async def _cleanup_expired_ephemeral_agents() -> int:
@@ -239,6 +702,8 @@ async def _cleanup_expired_ephemeral_agents() -> int:
             return 0
         candidate_ids = [str(row["agent_id"]) for row in candidate_rows]
         to_delete = [aid for aid in candidate_ids if aid not in agents]
+        remote = await _remote_agent_owners(to_delete)
+        to_delete = [aid for aid in to_delete if aid not in remote]
         if not to_delete:
             return 0
         result = await conn.fetch(
@@ -249,6 +714,7 @@ async def _cleanup_expired_ephemeral_agents() -> int:
             """,
             to_delete,
         )
+        await _delete_agent_inventory(conn, [str(r["agent_id"]) for r in result])
         return len(result)
 
 
@@ -264,8 +730,8 @@ async def _cleanup_orphan_agents() -> int:
                 is_ephemeral = true
                 OR (
                   (asset_profile_json = '{}'::jsonb OR asset_profile_json IS NULL)
-                  AND COALESCE(jsonb_array_length(sbom_json), 0) = 0
-                  AND COALESCE(jsonb_array_length(cve_json), 0) = 0
+                  AND NOT EXISTS (SELECT 1 FROM agent_packages p WHERE p.agent_id = agents_control_state.agent_id)
+                  AND NOT EXISTS (SELECT 1 FROM agent_cves c WHERE c.agent_id = agents_control_state.agent_id)
                   AND last_heartbeat IS NULL
                 )
               )
@@ -278,6 +744,8 @@ async def _cleanup_orphan_agents() -> int:
             return 0
         candidate_ids = [str(row["agent_id"]) for row in candidate_rows]
         to_delete = [aid for aid in candidate_ids if aid not in agents]
+        remote = await _remote_agent_owners(to_delete)
+        to_delete = [aid for aid in to_delete if aid not in remote]
         if not to_delete:
             return 0
         result = await conn.fetch(
@@ -288,6 +756,7 @@ async def _cleanup_orphan_agents() -> int:
             """,
             to_delete,
         )
+        await _delete_agent_inventory(conn, [str(r["agent_id"]) for r in result])
         return len(result)
 
 
@@ -321,14 +790,14 @@ async def _archive_inactive_agents() -> int:
             INSERT INTO agents_stale_state (
                 agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
                 capabilities_json, is_ephemeral, instance_id, runtime_kind, lease_expires_at,
-                asset_profile_json, sbom_json, cve_json, findings_count,
+                asset_profile_json, findings_count,
                 policy_version, policy_hash, last_policy_applied_at, last_policy_result,
                 updated_at, archived_reason, archived_at
             )
             SELECT
                 a.agent_id, a.tenant_id, a.status, a.connected_at, a.last_seen, a.last_heartbeat,
                 a.capabilities_json, a.is_ephemeral, a.instance_id, a.runtime_kind, a.lease_expires_at,
-                a.asset_profile_json, a.sbom_json, a.cve_json, a.findings_count,
+                a.asset_profile_json, a.findings_count,
                 a.policy_version, a.policy_hash, a.last_policy_applied_at, a.last_policy_result,
                 a.updated_at,
                 CASE
@@ -351,8 +820,6 @@ async def _archive_inactive_agents() -> int:
                 runtime_kind = EXCLUDED.runtime_kind,
                 lease_expires_at = EXCLUDED.lease_expires_at,
                 asset_profile_json = EXCLUDED.asset_profile_json,
-                sbom_json = EXCLUDED.sbom_json,
-                cve_json = EXCLUDED.cve_json,
                 findings_count = EXCLUDED.findings_count,
                 policy_version = EXCLUDED.policy_version,
                 policy_hash = EXCLUDED.policy_hash,
@@ -386,6 +853,14 @@ async def _purge_old_stale_agents() -> int:
             """,
             max(1, AGENT_STALE_RETENTION_DAYS),
         )
+        if rows:
+            # Archived agents keep their inventory rows until retention expires, unless they came back.
+            restored = await conn.fetch(
+                "SELECT agent_id FROM agents_control_state WHERE agent_id = ANY($1::text[])",
+                [str(r["agent_id"]) for r in rows],
+            )
+            restored_ids = {str(r["agent_id"]) for r in restored}
+            await _delete_agent_inventory(conn, [str(r["agent_id"]) for r in rows if str(r["agent_id"]) not in restored_ids])
         return len(rows)
 
 
@@ -406,11 +881,21 @@ async def _cleanup_loop() -> None:
                 orphan_deleted = await _cleanup_orphan_agents()
                 if orphan_deleted > 0:
                     logger.info("orphan cleanup removed %d stale/empty agent records", orphan_deleted)
+            pruned = await _prune_validation_cache()
+            if pruned > 0:
+                logger.info("validation cache retention removed %d results", pruned)
         except Exception:
             logger.exception("ephemeral cleanup failed")
         await asyncio.sleep(interval)
 
 
+TERMINAL_JOB_STATUSES = {"completed", "failed", "timeout"}
+_COMMAND_JOB_COLUMNS = (
+    "id, tenant_id, agent_id, command_type, payload_json, status, "
+    "created_at, started_at, completed_at, result_json, error_text"
+)
+
+
 async def _create_command_job(
     *,
     job_id: str,
@@ -435,6 +920,32 @@ async def _create_command_job(
         )
 
 
+async def _create_command_jobs_batch(
+    *,
+    tenant_id: str,
+    command_type: str,
+    jobs: list[tuple[str, str, dict]],
+) -> None:
+    """Insert (job_id, agent_id, payload) rows for one command in a single statement."""
+    if not jobs:
+        return
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO command_jobs (id, tenant_id, agent_id, command_type, payload_json, status)
+            SELECT t.id, $1, t.agent_id, $2, t.payload_json::jsonb, 'queued'
+            FROM unnest($3::text[], $4::text[], $5::text[]) AS t(id, agent_id, payload_json)
+            ON CONFLICT (id) DO NOTHING
+            """,
+            tenant_id,
+            command_type,
+            [job[0] for job in jobs],
+            [job[1] for job in jobs],
+            [json.dumps(job[2]) for job in jobs],
+        )
+
+
 async def _update_command_job(
     *,
     job_id: str,
@@ -446,8 +957,8 @@ async def _update_command_job(
 ) -> None:
     db = await _db()
     async with db.acquire() as conn:
-        await conn.execute(
-            """
+        row = await conn.fetchrow(
+            f"""
             UPDATE command_jobs
             SET status = $2,
                 result_json = COALESCE($3::jsonb, result_json),
@@ -455,6 +966,7 @@ async def _update_command_job(
                 started_at = CASE WHEN $5 THEN COALESCE(started_at, now()) ELSE started_at END,
                 completed_at = CASE WHEN $6 THEN now() ELSE completed_at END
             WHERE id = $1
+            RETURNING {_COMMAND_JOB_COLUMNS}
             """,
             job_id,
             status_value,
@@ -463,6 +975,68 @@ async def _update_command_job(
             mark_started,
             mark_completed,
         )
+        if row is not None and ORCHESTRATOR_ROUTING_ENABLED:
+            # Long-poll/SSE followers may be attached to another replica.
+            await conn.execute("SELECT pg_notify($1, $2)", JOB_EVENTS_CHANNEL, f"{ORCHESTRATOR_REPLICA_ID}|{job_id}")
+    if row is not None:
+        _publish_job_event(_command_job_to_dict(row))
+
+
+def _command_job_to_dict(row: asyncpg.Record) -> dict:
+    return {
+        "id": row["id"],
+        "tenant_id": row["tenant_id"],
+        "agent_id": row["agent_id"],
+        "command_type": row["command_type"],
+        "payload": _json_value(row["payload_json"], {}),
+        "status": row["status"],
+        "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+        "started_at": row["started_at"].isoformat() if row["started_at"] else None,
+        "completed_at": row["completed_at"].isoformat() if row["completed_at"] else None,
+        "result": _json_value(row["result_json"], {}),
+        "error": row["error_text"],
+    }
+
+
+async def _get_command_job(job_id: str) -> Optional[asyncpg.Record]:
+    db = await _db()
+    async with db.acquire() as conn:
+        return await conn.fetchrow(f"SELECT {_COMMAND_JOB_COLUMNS} FROM command_jobs WHERE id = $1", job_id)
+
+
+def _subscribe_job(job_id: str) -> asyncio.Queue:
+    q: asyncio.Queue = asyncio.Queue(maxsize=64)
+    job_listeners.setdefault(job_id, set()).add(q)
+    return q
+
+
+def _unsubscribe_job(job_id: str, q: asyncio.Queue) -> None:
+    listeners = job_listeners.get(job_id)
+    if listeners is None:
+        return
+    listeners.discard(q)
+    if not listeners:
+        job_listeners.pop(job_id, None)
+
+
+def _publish_job_event(job: dict) -> None:
+    for q in list(job_listeners.get(job["id"], ())):
+        try:
+            q.put_nowait(job)
+        except asyncio.QueueFull:
+            if job["status"] not in TERMINAL_JOB_STATUSES:
+                # A listener that stopped reading only misses intermediate states.
+                continue
+            # The terminal state ends the listener's stream, so make room for it.
+            q.get_nowait()
+            q.put_nowait(job)
+
+
+def _spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 def _tenant_for_request(user: dict, payload_tenant: Optional[str]) -> str:
@@ -491,12 +1065,81 @@ def _rule_object_key(tenant_id: str, name: str) -> str:
 
 
 def _minio_client() -> Minio:
-    return Minio(
-        YARA_STORAGE_ENDPOINT,
-        access_key=YARA_STORAGE_ACCESS_KEY,
-        secret_key=YARA_STORAGE_SECRET_KEY,
-        secure=YARA_STORAGE_USE_SSL,
-    )
+    # One client per process so the urllib3 pool (and its TCP/TLS connections) is reused.
+    global _minio, _minio_http
+    if _minio is None:
+        _minio_http = urllib3.PoolManager(
+            maxsize=max(1, YARA_STORAGE_MAX_CONNECTIONS),
+            block=True,
+            timeout=urllib3.Timeout(connect=YARA_STORAGE_CONNECT_TIMEOUT_SECONDS, read=YARA_STORAGE_READ_TIMEOUT_SECONDS),
+            retries=urllib3.Retry(
+                total=max(0, YARA_STORAGE_RETRIES),
+                backoff_factor=max(0.0, YARA_STORAGE_RETRY_BACKOFF_SECONDS),
+                status_forcelist=[500, 502, 503, 504],
+                # A conditional PUT that succeeded but got a 5xx back would be retried into a 412.
+                allowed_methods=urllib3.Retry.DEFAULT_ALLOWED_METHODS - {"PUT"},
+            ),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        )
+        _minio = Minio(
+            YARA_STORAGE_ENDPOINT,
+            access_key=YARA_STORAGE_ACCESS_KEY,
+            secret_key=YARA_STORAGE_SECRET_KEY,
+            secure=YARA_STORAGE_USE_SSL,
+            http_client=_minio_http,
+        )
+    return _minio
+
+
+async def _storage_call(fn: Any, *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking MinIO SDK call on the dedicated, bounded storage executor."""
+    global _storage_executor, _storage_calls_queued
+    if _storage_executor is None:
+        _storage_executor = ThreadPoolExecutor(max_workers=max(1, YARA_STORAGE_THREADS), thread_name_prefix="minio")
+
+    def _run() -> Any:
+        global _storage_calls_running
+        with _storage_calls_lock:
+            _storage_calls_running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with _storage_calls_lock:
+                _storage_calls_running -= 1
+
+    _storage_calls_queued += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_storage_executor, _run)
+    finally:
+        _storage_calls_queued -= 1
+
+
+def _storage_pool_stats() -> dict:
+    connections_in_use = 0
+    connections_idle = 0
+    pools = 0
+    if _minio_http is not None:
+        for key in list(_minio_http.pools.keys()):
+            pool = _minio_http.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            pools += 1
+            idle_slots = pool.pool.qsize()
+            connections_in_use += max(0, pool.pool.maxsize - idle_slots)
+            connections_idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    max_connections = max(1, YARA_STORAGE_MAX_CONNECTIONS) * max(1, pools)
+    threads = max(1, YARA_STORAGE_THREADS)
+    return {
+        "connections_max": max_connections,
+        "connections_in_use": connections_in_use,
+        "connections_idle": connections_idle,
+        "connection_utilization": round(connections_in_use / max_connections, 4),
+        "threads_max": threads,
+        "threads_busy": _storage_calls_running,
+        "calls_waiting": max(0, _storage_calls_queued - _storage_calls_running),
+        "thread_utilization": round(_storage_calls_running / threads, 4),
+    }
 
 
 def _safe_string(value: Any, fallback: str = "") -> str:
@@ -505,6 +1148,673 @@ def _safe_string(value: Any, fallback: str = "") -> str:
     return str(value)
 
 
+def _json_value(value: Any, fallback: Any) -> Any:
+    if value is None:
+        return fallback
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return fallback
+    return value
+
+
+_YARA_RULE_HEADER_RE = re.compile(r"\b((?:(?:private|global)\s+)*)rule\s+([A-Za-z_][A-Za-z0-9_]*)\s*(?::\s*([A-Za-z0-9_ \t\r\n]*?))?\s*\{")
+_YARA_IMPORT_RE = re.compile(r'(?m)^\s*import\s+"([^"\n]+)"')
+_YARA_SECTION_RE = re.compile(r"\b(meta|strings|condition)\s*:")
+_YARA_META_RE = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*=\s*("(?:[^"\\\n]|\\.)*"|-?\d+|true|false)')
+_YARA_STRING_RE = re.compile(r'(\$[A-Za-z0-9_]*)\s*=\s*("(?:[^"\\\n]|\\.)*"|\{[^}]*\}|/(?:[^/\\\n]|\\.)+/[is]*)')
+_YARA_MODIFIER_RE = re.compile(r"\b(nocase|wide|ascii|fullword|private|xor|base64wide|base64)\b")
+
+
+def _mask_yara_source(text: str) -> str:
+    """Blank out comments and quoted-string contents (same length) so structure can be matched safely."""
+    out = list(text)
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"':
+            i += 1
+            while i < n and text[i] != '"' and text[i] != "\n":
+                if text[i] == "\\":
+                    out[i] = " "
+                    i += 1
+                    if i < n:
+                        out[i] = " "
+                    i += 1
+                    continue
+                out[i] = " "
+                i += 1
+            i += 1
+        elif text.startswith("//", i) and (i == 0 or text[i - 1] != "\\"):
+            while i < n and text[i] != "\n":
+                out[i] = " "
+                i += 1
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            for j in range(i, end):
+                if out[j] != "\n":
+                    out[j] = " "
+            i = end
+        else:
+            i += 1
+    return "".join(out)
+
+
+def _unescape_yara_string(literal: str) -> str:
+    body = literal[1:-1]
+    try:
+        return body.encode("latin-1", "backslashreplace").decode("unicode_escape")
+    except UnicodeDecodeError:
+        return body
+
+
+def _parse_yara_rules(content: str) -> list[dict]:
+    """Extract names, tags, meta, string identifiers/literals and imports from a rule file.
+
+    This is a lenient structural scan for indexing, not a validator; anything it cannot
+    make sense of is skipped.
+    """
+    masked = _mask_yara_source(content)
+    imports = sorted(set(_YARA_IMPORT_RE.findall(content)))
+    rules = []
+    pos = 0
+    while True:
+        header = _YARA_RULE_HEADER_RE.search(masked, pos)
+        if header is None:
+            break
+        depth, i = 1, header.end()
+        while i < len(masked) and depth:
+            if masked[i] == "{":
+                depth += 1
+            elif masked[i] == "}":
+                depth -= 1
+            i += 1
+        body_start, body_end = header.end(), i - 1
+        pos = i
+        sections: Dict[str, Tuple[int, int]] = {}
+        found = [(m.group(1), m.start(), m.end()) for m in _YARA_SECTION_RE.finditer(masked, body_start, body_end)]
+        for idx, (section, _, start) in enumerate(found):
+            end = found[idx + 1][1] if idx + 1 < len(found) else body_end
+            sections.setdefault(section, (start, end))
+        meta: Dict[str, str] = {}
+        if "meta" in sections:
+            start, end = sections["meta"]
+            for m in _YARA_META_RE.finditer(masked, start, end):
+                value = content[m.start(2):m.end(2)]
+                meta.setdefault(m.group(1), _unescape_yara_string(value) if value.startswith('"') else value)
+        string_ids: list[str] = []
+        literals: list[str] = []
+        strings: list[dict] = []
+        if "strings" in sections:
+            start, end = sections["strings"]
+            matches = list(_YARA_STRING_RE.finditer(masked, start, end))
+            for idx, m in enumerate(matches):
+                value = content[m.start(2):m.end(2)]
+                string_ids.append(m.group(1))
+                tail_end = matches[idx + 1].start() if idx + 1 < len(matches) else end
+                strings.append(
+                    {
+                        "id": m.group(1),
+                        "kind": "text" if value.startswith('"') else ("hex" if value.startswith("{") else "regex"),
+                        "source": value,
+                        "modifiers": _YARA_MODIFIER_RE.findall(masked, m.end(), tail_end),
+                        "line": content.count("\n", 0, m.start()) + 1,
+                    }
+                )
+                if value.startswith('"'):
+                    literals.append(_unescape_yara_string(value))
+                elif value.startswith("{"):
+                    literals.append(" ".join(value[1:-1].split()).upper())
+                else:
+                    literals.append(value)
+        condition = ""
+        condition_masked = ""
+        condition_line = None
+        if "condition" in sections:
+            start, end = sections["condition"]
+            condition = " ".join(content[start:end].split())
+            condition_masked = " ".join(masked[start:end].split())
+            condition_line = content.count("\n", 0, start) + 1
+        modifiers = header.group(1).split()
+        rules.append(
+            {
+                "rule_name": header.group(2),
+                "is_private": "private" in modifiers,
+                "is_global": "global" in modifiers,
+                "tags": sorted(set((header.group(3) or "").split())),
+                "meta": meta,
+                "string_ids": string_ids,
+                "literals": literals,
+                "imports": imports,
+                "condition": condition,
+                "condition_masked": condition_masked,
+                "strings": strings,
+                "line": content.count("\n", 0, header.start()) + 1,
+                "condition_line": condition_line,
+            }
+        )
+    return rules
+
+
+# Bytes that show up everywhere in binaries (padding, NOP sleds, int3 fill), so atoms made of
+# them match constantly. Mirrors the weighting of libyara's atom quality heuristic.
+_COMMON_ATOM_BYTES = frozenset({0x00, 0x20, 0x90, 0xCC, 0xFF})
+_ATOM_MAX_LENGTH = 4
+_ATOM_GOOD_QUALITY = 60
+_HEX_TOKEN_RE = re.compile(r"\[[^\]]*\]|[()|]|~?[0-9A-Fa-f?]{2}")
+_REGEX_META = set(".^$*+?()[]{}|")
+_CONDITION_OF_THEM_RE = re.compile(r"\b(?:any|all|none|\d+)\s+of\s+(them|\([^)]*\))")
+_CONDITION_LOOP_RE = re.compile(r"\bfor\s+(?:any|all|none|\d+)\s+\w+(?:\s*,\s*\w+)?\s+in\s+\(([^)]*)\)")
+_CONDITION_WHOLE_FILE_RE = re.compile(r"\b(?:hash|math)\.\w+\(\s*0\s*,\s*filesize\s*\)")
+
+
+def _atom_quality(atom: bytes) -> int:
+    if not atom:
+        return 0
+    quality = 0
+    for b in atom:
+        if b in _COMMON_ATOM_BYTES:
+            quality += 12
+        elif chr(b).isalpha():
+            quality += 18
+        else:
+            quality += 20
+    unique = len(set(atom))
+    if unique == 1 and len(atom) > 1:
+        quality -= 10 * (len(atom) - 1)
+    else:
+        quality += 2 * unique
+    return quality
+
+
+def _best_atom(runs: list[bytes]) -> bytes:
+    best, best_quality = b"", -1
+    for run in runs:
+        for i in range(max(1, len(run) - _ATOM_MAX_LENGTH + 1)):
+            window = run[i:i + _ATOM_MAX_LENGTH]
+            quality = _atom_quality(window)
+            if quality > best_quality:
+                best, best_quality = window, quality
+    return best
+
+
+def _hex_string_runs(body: str) -> Tuple[list[bytes], int, int]:
+    """Fixed-byte runs of a hex string plus its (unbounded, wide) jump counts."""
+    runs: list[bytes] = []
+    current = bytearray()
+    unbounded = wide = depth = 0
+    for token in _HEX_TOKEN_RE.findall(body):
+        fixed = depth == 0 and len(token) == 2 and "?" not in token
+        if fixed:
+            current.append(int(token, 16))
+            continue
+        if current:
+            runs.append(bytes(current))
+            current = bytearray()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(0, depth - 1)
+        elif token.startswith("["):
+            bounds = token[1:-1].replace(" ", "").split("-")
+            if len(bounds) == 2 and not bounds[1]:
+                unbounded += 1
+            elif len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit() and int(bounds[1]) - int(bounds[0]) > 256:
+                wide += 1
+    if current:
+        runs.append(bytes(current))
+    return runs, unbounded, wide
+
+
+def _regex_literal_runs(pattern: str) -> Tuple[Optional[list[list[bytes]]], int]:
+    """Literal runs per top-level alternative of a regex plus its count of unbounded repeats.
+
+    The runs are None when the pattern has a construct this tokenizer does not understand,
+    so callers treat it as unconstrained rather than trusting a partial parse.
+    """
+    alternatives: list[list[bytes]] = [[]]
+    current = bytearray()
+    unbounded = depth = 0
+    last_atom = 0  # bytes the last literal atom added to current; a quantifier drops all of them
+    i, n = 0, len(pattern)
+
+    def _flush() -> None:
+        nonlocal current, last_atom
+        if current:
+            alternatives[-1].append(bytes(current))
+            current = bytearray()
+        last_atom = 0
+
+    def _append(atom: bytes) -> None:
+        nonlocal last_atom
+        if depth == 0:
+            current.extend(atom)
+            last_atom = len(atom)
+
+    while i < n:
+        ch = pattern[i]
+        if ch == "\\":
+            if i + 1 >= n:
+                return None, unbounded
+            nxt = pattern[i + 1]
+            if nxt == "x":
+                if not re.fullmatch(r"[0-9A-Fa-f]{2}", pattern[i + 2:i + 4]):
+                    return None, unbounded
+                _append(bytes([int(pattern[i + 2:i + 4], 16)]))
+                i += 4
+            elif not nxt.isalnum():
+                _append(nxt.encode("utf-8"))
+                i += 2
+            else:
+                _flush()
+                i += 2
+            continue
+        if ch == "[":
+            _flush()
+            # A "]" right after "[" or "[^" is a literal member, not the end of the class;
+            # escaped characters (including "\\]") never close it.
+            j = i + (2 if pattern.startswith("[^", i) else 1)
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 2 if pattern[j] == "\\" else 1
+            if j >= n:
+                return None, unbounded
+            i = j + 1
+            continue
+        if ch in "*?{" or ch == "+":
+            if ch == "{":
+                bounds = re.match(r"\{(\d*)(,?)(\d*)\}", pattern[i:])
+                if bounds is None or not (bounds.group(1) or bounds.group(3)):
+                    return None, unbounded
+                if bounds.group(2) and not bounds.group(3):
+                    unbounded += 1
+                close = i + bounds.end() - 1
+            else:
+                if ch != "?":
+                    unbounded += 1
+                close = i
+            if ch != "+" and last_atom:
+                # The preceding atom is optional, so it cannot anchor the match.
+                del current[-last_atom:]
+            _flush()
+            i = close + 1
+            continue
+        if ch == "|" and depth == 0:
+            _flush()
+            alternatives.append([])
+        elif ch == "(":
+            _flush()
+            depth += 1
+        elif ch == ")":
+            if depth == 0:
+                return None, unbounded
+            depth -= 1
+            last_atom = 0
+        elif ch in _REGEX_META:
+            _flush()
+        else:
+            _append(ch.encode("utf-8"))
+        i += 1
+    if depth:
+        return None, unbounded
+    _flush()
+    return alternatives, unbounded
+
+
+def _analyze_yara_string(string: dict) -> dict:
+    source = string["source"]
+    modifiers = set(string["modifiers"])
+    warnings: list[str] = []
+    cost = 0.0
+    if string["kind"] == "text":
+        data = _unescape_yara_string(source).encode("latin-1", "replace")
+        atom = _best_atom([data])
+    elif string["kind"] == "hex":
+        runs, unbounded, wide = _hex_string_runs(source[1:-1])
+        atom = _best_atom(runs)
+        if unbounded:
+            cost += 10 * unbounded
+            warnings.append(f"{unbounded} unbounded jump(s) [-]/[n-]")
+        if wide:
+            cost += 2 * wide
+            warnings.append(f"{wide} jump(s) spanning more than 256 bytes")
+    else:
+        body = source[1:source.rfind("/")]
+        if "i" in source[source.rfind("/") + 1:]:
+            modifiers.add("nocase")
+        alternatives, unbounded = _regex_literal_runs(body)
+        # Every alternative needs its own atom, so the weakest one sets the quality.
+        atoms = [_best_atom(runs) for runs in alternatives or []]
+        atom = min(atoms, key=_atom_quality) if atoms else b""
+        if unbounded:
+            cost += 10 * unbounded
+            warnings.append(f"{unbounded} unbounded repetition(s) (*, +, {{n,}})")
+        if not body.startswith("^") and body.lstrip("(").startswith((".*", ".+")):
+            cost += 20
+            warnings.append("regex starts with an unanchored .* / .+")
+
+    quality = _atom_quality(atom)
+    if not atom:
+        cost += 100
+        warnings.append("no usable atom; every input byte has to be checked")
+    elif len(atom) == 1:
+        cost += 40
+        warnings.append(f"1-byte atom {atom.hex()}")
+    elif len(atom) == 2:
+        cost += 12
+        warnings.append(f"2-byte atom {atom.hex()}")
+    elif quality < _ATOM_GOOD_QUALITY:
+        cost += 4 if len(atom) == 3 else 3
+        warnings.append(f"low-quality atom {atom.hex()} (quality {quality})")
+    else:
+        cost += 1
+    multiplier = 1
+    if "nocase" in modifiers:
+        multiplier *= 2
+    if "xor" in modifiers:
+        multiplier *= 16
+        warnings.append("xor generates up to 255 atom variants")
+    if "base64" in modifiers or "base64wide" in modifiers:
+        multiplier *= 3
+    if "wide" in modifiers and "ascii" in modifiers:
+        multiplier *= 2
+    return {
+        "id": string["id"],
+        "line": string["line"],
+        "kind": string["kind"],
+        "atom": atom.hex(),
+        "atom_quality": quality,
+        "cost": round(cost * multiplier, 1),
+        "warnings": warnings,
+    }
+
+
+def _analyze_yara_performance(content: str) -> dict:
+    """Static scan-cost estimate of a rule file from atom quality, regex/jump shape and condition.
+
+    Costs are relative units: a string with a distinctive 4-byte atom costs 1. Rules are
+    scored independently and the file score is their sum.
+    """
+    rules_out = []
+    for rule in _parse_yara_rules(content):
+        strings = [_analyze_yara_string(s) for s in rule["strings"]]
+        score = sum(s["cost"] for s in strings)
+        warnings: list[dict] = [
+            {"line": s["line"], "string": s["id"], "message": message} for s in strings for message in s["warnings"]
+        ]
+        condition = rule["condition"]
+        line = rule["condition_line"]
+        for m in _CONDITION_OF_THEM_RE.finditer(condition):
+            referenced = len(strings) if m.group(1) == "them" else len(re.findall(r"\$", m.group(1)))
+            if m.group(1) != "them":
+                prefixes = [p.rstrip("*") for p in re.findall(r"\$[A-Za-z0-9_]*\*?", m.group(1))]
+                referenced = sum(1 for s in strings if any(s["id"].startswith(p) for p in prefixes))
+            if referenced > 20:
+                score += referenced / 4
+                warnings.append({"line": line, "string": None, "message": f"'of' condition over {referenced} strings"})
+        for m in _CONDITION_LOOP_RE.finditer(condition):
+            if "filesize" in m.group(1):
+                score += 50
+                warnings.append({"line": line, "string": None, "message": "loop over a filesize-sized range"})
+            elif "#" in m.group(1):
+                score += 10
+                warnings.append({"line": line, "string": None, "message": "loop over every match of a string"})
+        if _CONDITION_WHOLE_FILE_RE.search(condition):
+            score += 20
+            warnings.append({"line": line, "string": None, "message": "hash/math over the whole file"})
+        score = round(score, 1)
+        rules_out.append(
+            {
+                "rule_name": rule["rule_name"],
+                "line": rule["line"],
+                "score": score,
+                "level": "ok" if score < 25 else ("warn" if score < 100 else "slow"),
+                "strings": strings,
+                "warnings": warnings,
+            }
+        )
+    return {
+        "score": round(sum(r["score"] for r in rules_out), 1),
+        "max_rule_score": max((r["score"] for r in rules_out), default=0),
+        "rules": rules_out,
+    }
+
+
+def _rule_performance(content: str) -> dict:
+    key = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    with _rule_perf_cache_lock:
+        analysis = _rule_perf_cache.get(key)
+        if analysis is not None:
+            _rule_perf_cache.move_to_end(key)
+            return analysis
+    analysis = _analyze_yara_performance(content)
+    with _rule_perf_cache_lock:
+        _rule_perf_cache[key] = analysis
+        while len(_rule_perf_cache) > max(0, RULE_PERF_CACHE_MAX_ENTRIES):
+            _rule_perf_cache.popitem(last=False)
+    return analysis
+
+
+# Retro-hunt prefilter planning. Query nodes are the ones ngram_index.NgramIndex.candidates takes:
+# None (unconstrained), ("lit", bytes), ("nocase", bytes), ("and", [...]), ("or", [...]).
+# Planning is conservative: whatever is not understood becomes None, so a plan never drops a match.
+_CONDITION_TOKEN_RE = re.compile(
+    r'"[^"\n]*"|/(?:\\.|[^/\\\n])+/[is]*|0x[0-9A-Fa-f]+|\d+(?:KB|MB)?|[<>=!]=|<<|>>|\.\.|[$#@!]\w*\*?|[A-Za-z_][\w.]*|\S'
+)
+
+
+def _prefilter_and(nodes: list) -> Any:
+    nodes = [node for node in nodes if node is not None]
+    if not nodes:
+        return None
+    return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+
+def _prefilter_or(nodes: list) -> Any:
+    if not nodes or any(node is None for node in nodes):
+        return None
+    return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+
+def _string_prefilter(string: dict) -> Any:
+    """Literals a sample must contain for one parsed YARA string to match."""
+    modifiers = set(string["modifiers"])
+    if modifiers & {"xor", "base64", "base64wide"}:
+        return None
+    source = string["source"]
+    if string["kind"] == "hex":
+        runs, _, _ = _hex_string_runs(source[1:-1])
+        return _prefilter_and([("lit", run) for run in runs])
+    if string["kind"] == "regex":
+        if "wide" in modifiers:
+            return None
+        kind = "nocase" if "nocase" in modifiers or "i" in source[source.rfind("/") + 1:] else "lit"
+        alternatives, _ = _regex_literal_runs(source[1:source.rfind("/")])
+        if alternatives is None:
+            return None
+        return _prefilter_or([_prefilter_and([(kind, run) for run in runs]) for runs in alternatives])
+    if any(ord(ch) > 0x7F for ch in source):
+        return None
+    try:
+        data = _unescape_yara_string(source).encode("latin-1")
+    except UnicodeEncodeError:
+        return None
+    kind = "nocase" if "nocase" in modifiers else "lit"
+    variants = []
+    if "wide" not in modifiers or "ascii" in modifiers:
+        variants.append((kind, data))
+    if "wide" in modifiers:
+        variants.append((kind, bytes(b for ch in data for b in (ch, 0))))
+    return _prefilter_or(variants)
+
+
+def _condition_prefilter(condition: str, strings: Dict[str, Any]) -> Any:
+    """Query node a sample must satisfy for a rule condition to hold.
+
+    Understands string references ($a, $a at/in ..., #a > n), "<quantifier> of <set>",
+    "for <quantifier> of <set> : (...)", parentheses, and/or. not, arithmetic, file
+    properties, module calls and rule references are unconstrained.
+    """
+    tokens = _CONDITION_TOKEN_RE.findall(condition)
+    pos = 0
+    anonymous: Optional[str] = None
+
+    def _peek(offset: int = 0) -> str:
+        return tokens[pos + offset] if pos + offset < len(tokens) else ""
+
+    def _skip_operand() -> None:
+        # Consume the rest of an operand, up to the next top-level and/or or closing parenthesis.
+        nonlocal pos
+        depth = 0
+        while pos < len(tokens):
+            token = tokens[pos]
+            if depth == 0 and token in ("and", "or", ")"):
+                return
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            pos += 1
+
+    def _quantifier() -> Optional[Tuple[str, bool]]:
+        nonlocal pos
+        token = _peek()
+        if token not in ("all", "any", "none") and not token.isdigit():
+            return None
+        pos += 1
+        percent = _peek() == "%"
+        if percent:
+            pos += 1
+        if _peek() != "of":
+            return None
+        pos += 1
+        return token, percent
+
+    def _string_set() -> Optional[list]:
+        nonlocal pos
+        if _peek() == "them":
+            pos += 1
+            return list(strings)
+        if _peek() != "(":
+            return None
+        pos += 1
+        ids: list = []
+        understood = True
+        while pos < len(tokens) and _peek() != ")":
+            token = tokens[pos]
+            pos += 1
+            if token == ",":
+                continue
+            if token.startswith("$") and token.endswith("*"):
+                ids.extend(sid for sid in strings if sid.startswith(token[:-1]))
+            elif token in strings:
+                ids.append(token)
+            else:
+                understood = False
+        pos += 1
+        return ids if understood else None
+
+    def _quantified(quantifier: Tuple[str, bool], nodes: list) -> Any:
+        token, percent = quantifier
+        if not nodes or token == "none":
+            return None
+        if token == "all" or (token.isdigit() and int(token) >= (100 if percent else len(nodes))):
+            return _prefilter_and(nodes)
+        if token == "any" or (token.isdigit() and int(token) >= 1):
+            return _prefilter_or(nodes)
+        return None
+
+    def _term() -> Any:
+        nonlocal pos, anonymous
+        token = _peek()
+        if token == "not":
+            pos += 1
+            _term()
+            return None
+        if token == "(":
+            pos += 1
+            node = _expr()
+            if _peek() == ")":
+                pos += 1
+            if _peek() not in ("and", "or", ")", ""):
+                _skip_operand()
+                return None
+            return node
+        if token == "for":
+            pos += 1
+            quantifier = _quantifier()
+            ids = _string_set() if quantifier else None
+            if ids is None or _peek() != ":" or _peek(1) != "(":
+                _skip_operand()
+                return None
+            pos += 2
+            start, nodes = pos, []
+            for sid in ids or [None]:
+                pos, anonymous = start, sid
+                nodes.append(_expr())
+            anonymous = None
+            if _peek() == ")":
+                pos += 1
+            _skip_operand()
+            return _quantified(quantifier, nodes if ids else [])
+        if token in ("all", "any", "none") or (token.isdigit() and _peek(1) in ("of", "%")):
+            quantifier = _quantifier()
+            ids = _string_set() if quantifier else None
+            _skip_operand()
+            return None if ids is None else _quantified(quantifier, [strings[sid] for sid in ids])
+        if token.startswith("$"):
+            pos += 1
+            node = strings.get(anonymous if token == "$" else token)
+            _skip_operand()
+            return node
+        if token.startswith("#"):
+            pos += 1
+            sid = anonymous if token == "#" else "$" + token[1:]
+            op, value = _peek(), _peek(1)
+            if op in (">", ">=", "==") and value.isdigit() and _peek(2) in ("and", "or", ")", ""):
+                pos += 2
+                return strings.get(sid) if int(value) + (op == ">") >= 1 else None
+            _skip_operand()
+            return None
+        _skip_operand()
+        return None
+
+    def _and_expr() -> Any:
+        nonlocal pos
+        nodes = [_term()]
+        while _peek() == "and":
+            pos += 1
+            nodes.append(_term())
+        return _prefilter_and(nodes)
+
+    def _expr() -> Any:
+        nonlocal pos
+        nodes = [_and_expr()]
+        while _peek() == "or":
+            pos += 1
+            nodes.append(_and_expr())
+        return _prefilter_or(nodes)
+
+    node = _expr()
+    return node if pos >= len(tokens) else None
+
+
+def _prefilter_plan(content: str) -> Any:
+    """Query node for samples that can match any non-private rule of a rule file; None when nothing narrows."""
+    reporting, required = [], []
+    for rule in _parse_yara_rules(content):
+        strings = {string["id"]: _string_prefilter(string) for string in rule["strings"]}
+        node = _condition_prefilter(rule["condition_masked"], strings)
+        if rule["is_global"]:
+            required.append(node)
+        if not rule["is_private"]:
+            reporting.append(node)
+    return _prefilter_and(required + [_prefilter_or(reporting)])
+
+
 def _parse_yarac_errors(stderr_text: str) -> list[dict]:
     errors: list[dict] = []
     for raw_line in (stderr_text or "").splitlines():
@@ -528,24 +1838,29 @@ def _parse_yarac_errors(stderr_text: str) -> list[dict]:
     return errors
 
 
-def _validate_yara_with_yarac(name: str, content: str) -> dict:
+def _validate_yara_with_yarac(content: str, externals: Optional[dict] = None) -> dict:
     if shutil.which("yarac") is None:
         raise RuntimeError("yarac binary is not available in orchestrator container")
 
     with tempfile.TemporaryDirectory(prefix="yaraval-") as tmpdir:
-        rule_path = os.path.join(tmpdir, name or "rule.yar")
+        # A fixed name and the temp dir stripped below keep the caller's file name out of the
+        # output; validation results are cached by content and shared across tenants.
+        rule_path = os.path.join(tmpdir, "rule.yar")
         out_path = os.path.join(tmpdir, "compiled.yarc")
         with open(rule_path, "w", encoding="utf-8") as f:
             f.write(content)
+        defines: list[str] = []
+        for key, value in (externals or {}).items():
+            defines += ["-d", f"{key}={str(value).lower() if isinstance(value, bool) else value}"]
         proc = subprocess.run(
-            ["yarac", rule_path, out_path],
+            ["yarac", *defines, rule_path, out_path],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
             timeout=10,
             check=False,
         )
-        combined = ((proc.stdout or "") + "\n" + (proc.stderr or "")).strip()
+        combined = ((proc.stdout or "") + "\n" + (proc.stderr or "")).strip().replace(tmpdir + os.sep, "")
         if proc.returncode == 0:
             return {
                 "valid": True,
@@ -560,68 +1875,523 @@ def _validate_yara_with_yarac(name: str, content: str) -> dict:
         }
 
 
-YARA_ASSISTANT_SYSTEM_PROMPT = """You are YARAgent Rule Assistant, an expert in writing, reviewing, and refactoring YARA rules.
-
-Your responsibilities:
-1) Help users create new YARA rules and improve existing rules.
-2) Explain detection logic clearly and concisely.
-3) Prefer safe, maintainable, and performant patterns.
-4) If user asks for edits, provide complete updated rule text unless they asked for only a diff.
-5) When giving suggestions, preserve existing intent and metadata when possible.
+def _yara_python_available() -> bool:
+    return importlib.util.find_spec("yara") is not None
 
-Constraints:
-- Focus only on YARA-related tasks.
-- Do not invent unsupported fields or syntax.
-- If context is missing, ask one concise clarifying question.
-- Keep responses actionable.
-"""
 
+def _spawn_yara_compiler() -> dict:
+    # spawn, not fork: the parent holds an event loop, DB sockets and executor threads.
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(
+        target=yara_worker.serve,
+        args=(child_conn, YARA_COMPILER_MEMORY_LIMIT_MB * 1024 * 1024),
+        name="yara-compiler",
+        daemon=True,
+    )
+    proc.start()
+    child_conn.close()
+    return {"process": proc, "conn": parent_conn}
 
-def _call_gemini_yara_assistant(user_message: str, history: list[dict], rule_name: str, rule_content: str) -> str:
-    if not GEMINI_API_KEY:
-        raise RuntimeError("GEMINI_API_KEY (or VERTEX_API_KEY) is not configured")
 
-    contents = []
-    for item in history:
-        role = str(item.get("role") or "user").strip().lower()
-        text = str(item.get("content") or "").strip()
-        if not text:
-            continue
-        if role not in {"user", "model"}:
-            role = "user"
-        contents.append({"role": role, "parts": [{"text": text}]})
+def _retire_yara_compiler(worker: dict, graceful: bool = False) -> None:
+    proc = worker["process"]
+    try:
+        if graceful and proc.is_alive():
+            worker["conn"].send(None)
+            proc.join(timeout=1)
+    except Exception:
+        pass
+    if proc.is_alive():
+        proc.kill()
+    proc.join(timeout=1)
+    worker["conn"].close()
+
+
+async def _start_yara_compiler_pool() -> None:
+    global _yara_compiler_idle
+    if _yara_compiler_idle is not None or YARA_COMPILER_WORKERS <= 0 or not _yara_python_available():
+        return
+    idle: asyncio.Queue = asyncio.Queue()
+    for _ in range(YARA_COMPILER_WORKERS):
+        worker = await asyncio.to_thread(_spawn_yara_compiler)
+        _yara_compiler_workers.append(worker)
+        idle.put_nowait(worker)
+    _yara_compiler_idle = idle
+    logger.info("yara compiler pool started with %d workers", YARA_COMPILER_WORKERS)
+
+
+async def _stop_yara_compiler_pool() -> None:
+    global _yara_compiler_idle
+    _yara_compiler_idle = None
+    workers = list(_yara_compiler_workers)
+    _yara_compiler_workers.clear()
+    for worker in workers:
+        await asyncio.to_thread(_retire_yara_compiler, worker, True)
+
+
+async def _yara_compiler_roundtrip(worker: dict, request: dict) -> dict:
+    loop = asyncio.get_running_loop()
+    conn = worker["conn"]
+    # A combined batch source can be several MB; a blocking pipe write would stall the event loop.
+    try:
+        await asyncio.to_thread(conn.send, request)
+    except OSError:
+        raise RuntimeError("yara compiler worker exited (memory limit or crash)")
+    ready = loop.create_future()
+    fd = conn.fileno()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+    try:
+        return conn.recv()
+    except (EOFError, OSError):
+        raise RuntimeError("yara compiler worker exited (memory limit or crash)")
 
-    contextual_user_text = (
-        f"Current rule file: {rule_name}\n\n"
-        f"Current rule content:\n```yara\n{rule_content}\n```\n\n"
-        f"User request:\n{user_message}"
-    )
-    contents.append({"role": "user", "parts": [{"text": contextual_user_text}]})
 
-    payload = {
-        "system_instruction": {
-            "parts": [{"text": YARA_ASSISTANT_SYSTEM_PROMPT}],
-        },
-        "contents": contents,
-        "generationConfig": {
-            "temperature": 0.2,
-            "maxOutputTokens": 2048,
-        },
-    }
+async def _compile_in_pool(source: str, externals: Optional[dict] = None) -> dict:
+    """Compile one source on a pooled worker. A worker that times out, crashes or is
+    abandoned mid-request is killed and replaced so the pool size stays fixed.
 
-    req = urllib.request.Request(
-        f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}",
-        data=json.dumps(payload).encode("utf-8"),
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
+    Waiting for a free worker is bounded by YARA_COMPILER_TIMEOUT_SECONDS as well, so a pool
+    emptied by failed respawns fails requests instead of hanging them."""
+    idle = _yara_compiler_idle
+    if idle is None:
+        raise RuntimeError("yara compiler pool is not running")
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            raw = resp.read().decode("utf-8")
-    except urllib.error.HTTPError as exc:
-        err_body = ""
+        worker = await asyncio.wait_for(idle.get(), timeout=YARA_COMPILER_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"no yara compiler worker free ({len(_yara_compiler_workers)} running)")
+    healthy = False
+    try:
+        result = await asyncio.wait_for(
+            _yara_compiler_roundtrip(worker, {"source": source, "externals": externals}), timeout=YARA_COMPILER_TIMEOUT_SECONDS
+        )
+        healthy = True
+        return result
+    finally:
+        if healthy:
+            idle.put_nowait(worker)
+        else:
+            if worker in _yara_compiler_workers:
+                _yara_compiler_workers.remove(worker)
+            # Joining the old process and spawning a new one block, so neither runs on the event
+            # loop; a background task also survives this request being cancelled.
+            _spawn_background(_replace_yara_compiler(worker, idle))
+
+
+async def _replace_yara_compiler(worker: dict, idle: asyncio.Queue) -> None:
+    await asyncio.to_thread(_retire_yara_compiler, worker)
+    delay = 1.0
+    while True:
+        if _yara_compiler_idle is not idle:
+            return
         try:
-            err_body = exc.read().decode("utf-8")
+            replacement = await asyncio.to_thread(_spawn_yara_compiler)
+            break
+        except Exception:
+            # Keep trying: giving up would shrink the pool for good.
+            logger.exception("failed to replace yara compiler worker; retrying in %.0fs", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+    if _yara_compiler_idle is not idle:
+        await asyncio.to_thread(_retire_yara_compiler, replacement, True)
+        return
+    _yara_compiler_workers.append(replacement)
+    idle.put_nowait(replacement)
+
+
+async def _validate_yara_source(content: str, externals: Optional[dict] = None) -> dict:
+    if _yara_compiler_idle is None:
+        return await asyncio.to_thread(_validate_yara_with_yarac, content, externals)
+    result = await _compile_in_pool(content, externals)
+    if result["valid"]:
+        return {
+            "valid": True,
+            "message": "YARA rule compiled successfully",
+            "errors": [],
+            "warnings": result["warnings"],
+            "rule_count": result["rule_count"],
+        }
+    return {
+        "valid": False,
+        "message": "YARA rule failed to compile",
+        "errors": result["errors"],
+        "warnings": result["warnings"],
+        "raw": "\n".join(e["message"] for e in result["errors"]),
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _yara_python_version() -> str:
+    try:
+        return importlib.metadata.version("yara-python")
+    except importlib.metadata.PackageNotFoundError:
+        return ""
+
+
+def _validation_engine() -> str:
+    if _yara_compiler_idle is not None:
+        return f"yara-python {_yara_python_version()}"
+    return f"yarac {_yara_version()}"
+
+
+def _normalize_externals(raw: Any) -> dict:
+    if raw is None:
+        return {}
+    if not isinstance(raw, dict):
+        raise HTTPException(status_code=400, detail="externals must be an object")
+    externals: dict = {}
+    for key, value in raw.items():
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]{0,127}", str(key)):
+            raise HTTPException(status_code=400, detail=f"invalid external variable name: {key}")
+        if not isinstance(value, (str, int, float, bool)):
+            raise HTTPException(status_code=400, detail=f"external variable {key} must be a string, number or boolean")
+        externals[str(key)] = value
+    return externals
+
+
+def _validation_cache_key(content: str, externals: dict) -> str:
+    material = json.dumps(
+        {
+            "sha256": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+            "engine": _validation_engine(),
+            "externals": externals,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _validation_cache_put(cache_key: str, result: dict) -> None:
+    _validation_cache[cache_key] = result
+    _validation_cache.move_to_end(cache_key)
+    while len(_validation_cache) > max(0, VALIDATION_CACHE_MAX_ENTRIES):
+        _validation_cache.popitem(last=False)
+
+
+async def _load_validation_result(cache_key: str, content: str, externals: dict) -> Tuple[dict, str]:
+    if VALIDATION_CACHE_DB_ENABLED:
+        try:
+            db = await _db()
+            async with db.acquire() as conn:
+                row = await conn.fetchrow(
+                    "SELECT result_json FROM yara_validation_cache WHERE cache_key = $1", cache_key
+                )
+            result = _json_value(row["result_json"], None) if row is not None else None
+            if isinstance(result, dict):
+                _validation_cache_put(cache_key, result)
+                return result, "db"
+        except Exception:
+            logger.exception("validation cache lookup failed")
+    result = await _validate_yara_source(content, externals)
+    _validation_cache_put(cache_key, result)
+    if VALIDATION_CACHE_DB_ENABLED:
+        try:
+            db = await _db()
+            async with db.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO yara_validation_cache (cache_key, engine, result_json)
+                    VALUES ($1, $2, $3::jsonb)
+                    ON CONFLICT (cache_key) DO NOTHING
+                    """,
+                    cache_key,
+                    _validation_engine(),
+                    json.dumps(result),
+                )
+        except Exception:
+            logger.exception("validation cache store failed")
+    return result, "miss"
+
+
+async def _validate_cached(content: str, externals: Optional[dict] = None) -> Tuple[dict, str]:
+    """Validate through the memory -> Postgres result cache; returns (result, "memory"|"db"|"miss").
+
+    Identical concurrent requests share one compile.
+    """
+    externals = externals or {}
+    cache_key = _validation_cache_key(content, externals)
+    cached = _validation_cache.get(cache_key)
+    if cached is not None:
+        _validation_cache.move_to_end(cache_key)
+        return cached, "memory"
+    inflight = _validation_inflight.get(cache_key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_load_validation_result(cache_key, content, externals))
+        _validation_inflight[cache_key] = inflight
+        inflight.add_done_callback(lambda _: _validation_inflight.pop(cache_key, None))
+    return await asyncio.shield(inflight)
+
+
+async def _prune_validation_cache() -> int:
+    if not VALIDATION_CACHE_DB_ENABLED:
+        return 0
+    db = await _db()
+    async with db.acquire() as conn:
+        result = await conn.execute(
+            "DELETE FROM yara_validation_cache WHERE created_at < now() - make_interval(hours => $1::int)",
+            VALIDATION_CACHE_DB_TTL_HOURS,
+        )
+    return int(result.split()[-1]) if result else 0
+
+
+@functools.lru_cache(maxsize=1)
+def _yara_version() -> str:
+    if shutil.which("yarac") is None:
+        return ""
+    try:
+        proc = subprocess.run(["yarac", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=5, check=False)
+    except Exception:
+        return ""
+    return (proc.stdout or proc.stderr or "").strip().splitlines()[0] if (proc.stdout or proc.stderr) else ""
+
+
+def _compile_yara_ruleset(content: str) -> bytes:
+    if shutil.which("yarac") is None:
+        raise RuntimeError("yarac binary is not available in orchestrator container")
+    with tempfile.TemporaryDirectory(prefix="yaracomp-") as tmpdir:
+        rule_path = os.path.join(tmpdir, "ruleset.yar")
+        out_path = os.path.join(tmpdir, "ruleset.yarc")
+        with open(rule_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        proc = subprocess.run(
+            ["yarac", rule_path, out_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=60,
+            check=False,
+        )
+        if proc.returncode != 0:
+            raise ValueError(((proc.stdout or "") + "\n" + (proc.stderr or "")).strip() or "yarac failed")
+        with open(out_path, "rb") as f:
+            return f.read()
+
+
+def _compiled_object_key(tenant_id: str, yara_version: str, sha256_hex: str) -> str:
+    version_slug = re.sub(r"[^A-Za-z0-9._-]+", "_", yara_version) or "unknown"
+    return f"tenants/{tenant_id}/compiled/{version_slug}/{sha256_hex}.yarc"
+
+
+def _compiled_disk_path(cache_key: str) -> str:
+    return os.path.join(COMPILED_RULE_CACHE_DIR, hashlib.sha256(cache_key.encode("utf-8")).hexdigest() + ".yarc")
+
+
+def _load_compiled_disk_index() -> None:
+    """Must be called with _compiled_disk_lock held."""
+    global _compiled_disk_loaded
+    if _compiled_disk_loaded:
+        return
+    os.makedirs(COMPILED_RULE_CACHE_DIR, exist_ok=True)
+    # Files from a previous run are indexed by their path digest, oldest first.
+    entries = []
+    for entry in os.scandir(COMPILED_RULE_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".yarc"):
+            st = entry.stat()
+            entries.append((st.st_mtime, entry.path, st.st_size))
+    for _, path, size in sorted(entries):
+        _compiled_disk_index[path] = size
+    _compiled_disk_loaded = True
+
+
+def _compiled_disk_get(cache_key: str) -> Optional[bytes]:
+    path = _compiled_disk_path(cache_key)
+    with _compiled_disk_lock:
+        _load_compiled_disk_index()
+        if path not in _compiled_disk_index:
+            return None
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        with _compiled_disk_lock:
+            _compiled_disk_index.pop(path, None)
+        return None
+    with _compiled_disk_lock:
+        if path in _compiled_disk_index:
+            _compiled_disk_index.move_to_end(path)
+    return data
+
+
+def _compiled_disk_put(cache_key: str, data: bytes) -> None:
+    path = _compiled_disk_path(cache_key)
+    with _compiled_disk_lock:
+        _load_compiled_disk_index()
+    fd, tmp_path = tempfile.mkstemp(prefix=".compiled-", suffix=".tmp", dir=COMPILED_RULE_CACHE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    with _compiled_disk_lock:
+        os.replace(tmp_path, path)
+        _compiled_disk_index[path] = len(data)
+        _compiled_disk_index.move_to_end(path)
+        total = sum(_compiled_disk_index.values())
+        limit = max(0, COMPILED_RULE_CACHE_MAX_BYTES)
+        while total > limit and len(_compiled_disk_index) > 1:
+            old_path, old_size = _compiled_disk_index.popitem(last=False)
+            total -= old_size
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+async def _load_compiled_ruleset(tenant_id: str, sha256_hex: str, yara_version: str, rule_text: Optional[str]) -> bytes:
+    cache_key = f"{tenant_id}/{yara_version}/{sha256_hex}"
+    data = await asyncio.to_thread(_compiled_disk_get, cache_key)
+    if data is not None:
+        return data
+    object_key = _compiled_object_key(tenant_id, yara_version, sha256_hex)
+    client = _minio_client()
+    try:
+        data = await _storage_call(_read_object_bytes, client, object_key)
+    except S3Error as exc:
+        if exc.code not in {"NoSuchKey", "NoSuchObject"}:
+            raise
+        if rule_text is None:
+            raise KeyError(sha256_hex)
+        data = await asyncio.to_thread(_compile_yara_ruleset, rule_text)
+        await _storage_call(
+            client.put_object,
+            YARA_STORAGE_BUCKET,
+            object_key,
+            io.BytesIO(data),
+            len(data),
+            "application/octet-stream",
+        )
+    await asyncio.to_thread(_compiled_disk_put, cache_key, data)
+    return data
+
+
+async def _get_compiled_ruleset(tenant_id: str, rule_text: Optional[str], sha256_hex: Optional[str] = None) -> Optional[dict]:
+    """Return the compiled artifact for a ruleset, compiling it at most once per (tenant, sha256, YARA version).
+
+    Lookups go local disk LRU -> MinIO -> yarac. Returns None when compiled
+    distribution is unavailable or the ruleset does not compile.
+    """
+    yara_version = _yara_version()
+    if not COMPILED_RULES_ENABLED or not YARA_STORAGE_ENABLED or not yara_version:
+        return None
+    if sha256_hex is None:
+        sha256_hex = hashlib.sha256((rule_text or "").encode("utf-8")).hexdigest()
+    cache_key = f"{tenant_id}/{yara_version}/{sha256_hex}"
+    inflight = _compile_inflight.get(cache_key)
+    if inflight is None:
+        inflight = asyncio.ensure_future(_load_compiled_ruleset(tenant_id, sha256_hex, yara_version, rule_text))
+        _compile_inflight[cache_key] = inflight
+        inflight.add_done_callback(lambda _: _compile_inflight.pop(cache_key, None))
+    try:
+        data = await asyncio.shield(inflight)
+    except KeyError:
+        return None
+    except ValueError as exc:
+        logger.info("ruleset %s does not compile server-side: %s", sha256_hex, exc)
+        return None
+    except Exception:
+        logger.exception("compiled ruleset lookup failed for %s", sha256_hex)
+        return None
+    return {
+        "sha256": sha256_hex,
+        "yara_version": yara_version,
+        "object_key": _compiled_object_key(tenant_id, yara_version, sha256_hex),
+        "size_bytes": len(data),
+        "data": data,
+    }
+
+
+def _agent_accepts_compiled(capabilities: dict, compiled: Optional[dict]) -> bool:
+    # Compiled YARA files only load on the exact YARA version that produced them.
+    if compiled is None or not isinstance(capabilities, dict):
+        return False
+    if not _is_truthy(capabilities.get("compiled_rules")):
+        return False
+    return _safe_string(capabilities.get("yara_version")).strip() == compiled["yara_version"]
+
+
+def _rule_push_message(job_id: str, encoded_source: str, capabilities: dict, compiled: Optional[dict]) -> dict:
+    if not _agent_accepts_compiled(capabilities, compiled):
+        return {"type": "rule.push", "id": job_id, "payload": encoded_source}
+    msg = {
+        "type": "rule.push",
+        "id": job_id,
+        "format": "compiled",
+        "compiled_sha256": compiled["sha256"],
+        "yara_version": compiled["yara_version"],
+    }
+    # Large artifacts are fetched by hash over the agent channel (ruleset.fetch) instead of inlined.
+    if compiled["size_bytes"] <= max(0, COMPILED_RULE_INLINE_MAX_BYTES):
+        msg["compiled"] = base64.b64encode(compiled["data"]).decode("ascii")
+    return msg
+
+
+YARA_ASSISTANT_SYSTEM_PROMPT = """You are YARAgent Rule Assistant, an expert in writing, reviewing, and refactoring YARA rules.
+
+Your responsibilities:
+1) Help users create new YARA rules and improve existing rules.
+2) Explain detection logic clearly and concisely.
+3) Prefer safe, maintainable, and performant patterns.
+4) If user asks for edits, provide complete updated rule text unless they asked for only a diff.
+5) When giving suggestions, preserve existing intent and metadata when possible.
+
+Constraints:
+- Focus only on YARA-related tasks.
+- Do not invent unsupported fields or syntax.
+- If context is missing, ask one concise clarifying question.
+- Keep responses actionable.
+"""
+
+
+def _call_gemini_yara_assistant(user_message: str, history: list[dict], rule_name: str, rule_content: str) -> str:
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY (or VERTEX_API_KEY) is not configured")
+
+    contents = []
+    for item in history:
+        role = str(item.get("role") or "user").strip().lower()
+        text = str(item.get("content") or "").strip()
+        if not text:
+            continue
+        if role not in {"user", "model"}:
+            role = "user"
+        contents.append({"role": role, "parts": [{"text": text}]})
+
+    contextual_user_text = (
+        f"Current rule file: {rule_name}\n\n"
+        f"Current rule content:\n```yara\n{rule_content}\n```\n\n"
+        f"User request:\n{user_message}"
+    )
+    contents.append({"role": "user", "parts": [{"text": contextual_user_text}]})
+
+    payload = {
+        "system_instruction": {
+            "parts": [{"text": YARA_ASSISTANT_SYSTEM_PROMPT}],
+        },
+        "contents": contents,
+        "generationConfig": {
+            "temperature": 0.2,
+            "maxOutputTokens": 2048,
+        },
+    }
+
+    req = urllib.request.Request(
+        f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            raw = resp.read().decode("utf-8")
+    except urllib.error.HTTPError as exc:
+        err_body = ""
+        try:
+            err_body = exc.read().decode("utf-8")
         except Exception:
             pass
         raise RuntimeError(f"Gemini API error {exc.code}: {err_body or exc.reason}")
@@ -643,44 +2413,191 @@ def _call_gemini_yara_assistant(user_message: str, history: list[dict], rule_nam
     return "\n\n".join(out)
 
 
-async def _upsert_rule_metadata(
+def _put_rule_object(client: Minio, object_key: str, data: bytes, *, if_none_match: bool = False, if_match: Optional[str] = None) -> Any:
+    headers = {"Content-Type": "text/plain; charset=utf-8"}
+    if if_none_match:
+        headers["If-None-Match"] = "*"
+    if if_match:
+        headers["If-Match"] = f'"{if_match}"'
+    # minio 7.2's put_object() rewrites headers it does not know (If-Match, If-None-Match)
+    # into x-amz-meta-*, so conditional writes use its single-request PutObject helper,
+    # Minio._put_object(bucket, name, data, headers). It is not public API: requirements.txt
+    # pins minio, and this check fails loudly if an upgrade drops or renames it. Rule files
+    # are far below the multipart size.
+    put = getattr(client, "_put_object", None)
+    if not callable(put):
+        raise RuntimeError(f"minio {minio.__version__} has no Minio._put_object; conditional rule writes need minio 7.2.x")
+    return put(YARA_STORAGE_BUCKET, object_key, data, headers)
+
+
+async def _record_rule_versions(conn: asyncpg.Connection, tenant_id: str, versions: list[dict]) -> None:
+    """Append rows to yara_rule_versions; each dict has name, version_id, sha256, size_bytes, etag, actor, action."""
+    if not versions:
+        return
+    await conn.execute(
+        """
+        INSERT INTO yara_rule_versions (tenant_id, name, version_id, sha256, size_bytes, etag, actor, action)
+        SELECT $1, t.name, t.version_id, t.sha256, t.size_bytes, t.etag, t.actor, t.action
+        FROM unnest($2::text[], $3::text[], $4::text[], $5::bigint[], $6::text[], $7::text[], $8::text[])
+            AS t(name, version_id, sha256, size_bytes, etag, actor, action)
+        """,
+        tenant_id,
+        [v["name"] for v in versions],
+        [v.get("version_id") for v in versions],
+        [v.get("sha256") for v in versions],
+        [int(v.get("size_bytes") or 0) for v in versions],
+        [v.get("etag") for v in versions],
+        [v.get("actor") for v in versions],
+        [v["action"] for v in versions],
+    )
+
+
+async def _write_rule_object(
     *,
     tenant_id: str,
     name: str,
     object_key: str,
-    etag: str,
-    sha256_hex: str,
-    size_bytes: int,
+    encoded: bytes,
     actor: str,
-) -> None:
+    create: bool,
+) -> str:
+    """Write a rule object and its yara_rule_files row as one unit; returns the new etag.
+
+    The row is locked (or claimed, on create) in a transaction that stays open across a
+    single conditional PutObject: If-None-Match: * on create, If-Match on the stored etag
+    on update. A failed put rolls the row back; a failed commit after a created object
+    removes the object again.
+    """
+    sha256_hex = hashlib.sha256(encoded).hexdigest()
+    client = _minio_client()
     db = await _db()
-    async with db.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO yara_rule_files (
-                id, tenant_id, name, object_key, etag, sha256, size_bytes, created_by, updated_by, updated_at
-            )
-            VALUES (
-                $8, $1, $2, $3, $4, $5, $6, $7, $7, now()
-            )
-            ON CONFLICT (tenant_id, name) DO UPDATE SET
-                object_key = EXCLUDED.object_key,
-                etag = EXCLUDED.etag,
-                sha256 = EXCLUDED.sha256,
-                size_bytes = EXCLUDED.size_bytes,
-                updated_by = EXCLUDED.updated_by,
-                updated_at = now(),
-                deleted_at = NULL
-            """,
-            tenant_id,
-            name,
-            object_key,
-            etag,
-            sha256_hex,
-            max(0, int(size_bytes)),
-            actor,
-            str(uuid.uuid4()),
-        )
+    written = False
+    try:
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                if create:
+                    claimed = await conn.fetchval(
+                        """
+                        INSERT INTO yara_rule_files (
+                            id, tenant_id, name, object_key, sha256, size_bytes, created_by, updated_by, updated_at
+                        )
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $7, now())
+                        ON CONFLICT (tenant_id, name) DO UPDATE SET
+                            object_key = EXCLUDED.object_key,
+                            sha256 = EXCLUDED.sha256,
+                            size_bytes = EXCLUDED.size_bytes,
+                            created_by = EXCLUDED.created_by,
+                            updated_by = EXCLUDED.updated_by,
+                            created_at = now(),
+                            updated_at = now(),
+                            deleted_at = NULL
+                        WHERE yara_rule_files.deleted_at IS NOT NULL
+                        RETURNING id
+                        """,
+                        str(uuid.uuid4()),
+                        tenant_id,
+                        name,
+                        object_key,
+                        sha256_hex,
+                        len(encoded),
+                        actor,
+                    )
+                    if claimed is None:
+                        raise HTTPException(status_code=409, detail="rule already exists")
+                    expected_etag = None
+                else:
+                    row = await conn.fetchrow(
+                        """
+                        SELECT etag FROM yara_rule_files
+                        WHERE tenant_id = $1 AND name = $2 AND deleted_at IS NULL
+                        FOR UPDATE
+                        """,
+                        tenant_id,
+                        name,
+                    )
+                    if row is None:
+                        # Object written straight to the bucket and not synced yet.
+                        try:
+                            stat = await _storage_call(client.stat_object, YARA_STORAGE_BUCKET, object_key)
+                        except S3Error as exc:
+                            if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchBucket"}:
+                                raise HTTPException(status_code=404, detail="rule not found")
+                            raise HTTPException(status_code=502, detail=f"yara storage stat failed: {exc}")
+                        expected_etag = _normalize_etag(getattr(stat, "etag", ""))
+                    else:
+                        expected_etag = _normalize_etag(row["etag"])
+
+                try:
+                    result = await _storage_call(
+                        _put_rule_object,
+                        client,
+                        object_key,
+                        encoded,
+                        if_none_match=create,
+                        if_match=expected_etag or None,
+                    )
+                except S3Error as exc:
+                    if exc.code == "PreconditionFailed":
+                        detail = "rule already exists" if create else "rule was modified concurrently"
+                        raise HTTPException(status_code=409, detail=detail)
+                    if exc.code in {"NoSuchKey", "NoSuchObject"} and not create:
+                        raise HTTPException(status_code=404, detail="rule not found")
+                    logger.exception("failed to write yara rule")
+                    raise HTTPException(status_code=502, detail=f"yara storage write failed: {exc}")
+                except Exception as exc:
+                    logger.exception("failed to write yara rule")
+                    raise HTTPException(status_code=502, detail=f"yara storage write failed: {exc}")
+                written = True
+                etag = _normalize_etag(getattr(result, "etag", ""))
+                await conn.execute(
+                    """
+                    INSERT INTO yara_rule_files (
+                        id, tenant_id, name, object_key, etag, sha256, size_bytes, created_by, updated_by, updated_at
+                    )
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $8, now())
+                    ON CONFLICT (tenant_id, name) DO UPDATE SET
+                        object_key = EXCLUDED.object_key,
+                        etag = EXCLUDED.etag,
+                        sha256 = EXCLUDED.sha256,
+                        size_bytes = EXCLUDED.size_bytes,
+                        updated_by = EXCLUDED.updated_by,
+                        updated_at = now(),
+                        deleted_at = NULL
+                    """,
+                    str(uuid.uuid4()),
+                    tenant_id,
+                    name,
+                    object_key,
+                    etag,
+                    sha256_hex,
+                    len(encoded),
+                    actor,
+                )
+                await _record_rule_versions(
+                    conn,
+                    tenant_id,
+                    [
+                        {
+                            "name": name,
+                            "version_id": getattr(result, "version_id", None),
+                            "sha256": sha256_hex,
+                            "size_bytes": len(encoded),
+                            "etag": etag,
+                            "actor": actor,
+                            "action": "create" if create else "update",
+                        }
+                    ],
+                )
+    except asyncpg.PostgresError:
+        logger.exception("failed to record yara rule metadata")
+        if written and create:
+            try:
+                await _storage_call(client.remove_object, YARA_STORAGE_BUCKET, object_key)
+            except Exception:
+                logger.exception("failed to roll back yara rule object %s", object_key)
+        # An updated object without its row update is picked up by the bucket sync (etag moved).
+        raise HTTPException(status_code=500, detail="failed to record rule metadata")
+    return etag
 
 
 async def _get_rule_metadata(tenant_id: str, name: str) -> Optional[asyncpg.Record]:
@@ -712,251 +2629,1375 @@ async def _list_rule_metadata(tenant_id: str) -> Dict[str, asyncpg.Record]:
     return {str(r["name"]): r for r in rows}
 
 
-async def _delete_rule_metadata(tenant_id: str, name: str) -> None:
+async def _delete_rule_metadata(tenant_id: str, name: str, actor: str) -> None:
     db = await _db()
     async with db.acquire() as conn:
-        await conn.execute(
-            """
-            DELETE FROM yara_rule_files
-            WHERE tenant_id = $1 AND name = $2
-            """,
-            tenant_id,
-            name,
-        )
+        async with conn.transaction():
+            deleted = await conn.fetchval(
+                """
+                DELETE FROM yara_rule_files
+                WHERE tenant_id = $1 AND name = $2
+                RETURNING name
+                """,
+                tenant_id,
+                name,
+            )
+            if deleted is not None:
+                await _record_rule_versions(conn, tenant_id, [{"name": name, "actor": actor, "action": "delete"}])
+                await conn.execute("DELETE FROM yara_rule_index WHERE tenant_id = $1 AND file_name = $2", tenant_id, name)
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    token = credentials.credentials
+def _bundle_version(rules: list[dict]) -> str:
+    digest = hashlib.sha256()
+    for item in rules:
+        digest.update(f"{item['name']}\0{item['sha256']}\n".encode("utf-8"))
+    return f"bundle-{digest.hexdigest()[:16]}"
 
-    if ORCHESTRATOR_API_TOKEN and token == ORCHESTRATOR_API_TOKEN:
-        return {"sub": "service", "role": "service"}
 
-    payload = decode_token(token)
-    if payload is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+def _bundle_object_key(tenant_id: str, version: str) -> str:
+    return f"tenants/{tenant_id}/bundles/{version}.yar"
 
-    if payload.get("type") != "access":
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token type")
 
-    sub = payload.get("sub")
-    if not sub:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload")
+def _render_bundle(rules: list[dict], sources: Dict[str, str]) -> str:
+    # Rules are concatenated in name order; each file keeps a header so compiler
+    # errors and scan hits can be traced back to the source rule file.
+    parts = []
+    for item in rules:
+        body = sources[item["name"]]
+        if not body.endswith("\n"):
+            body += "\n"
+        parts.append(f"// rule-file: {item['name']} sha256:{item['sha256']}\n{body}")
+    return "\n".join(parts)
 
-    user = await _fetch_user_by_username(str(sub))
-    if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
 
-    return payload
+def _read_object_bytes(client: Minio, object_key: str) -> bytes:
+    return _read_object_version(client, object_key)[0]
 
 
-@app.on_event("startup")
-async def startup() -> None:
-    global _db_pool, _cleanup_task
-    if JWT_SECRET_KEY == "change-me":
-        logger.warning("JWT_SECRET_KEY is using default value. Set it via environment secret.")
-    if DATABASE_URL:
-        _db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-    else:
-        _db_pool = await asyncpg.create_pool(
-            host=POSTGRES_HOST,
-            port=POSTGRES_PORT,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD,
-            database=POSTGRES_DB,
-            min_size=1,
-            max_size=10,
-        )
-    # Run one archival/retention sweep at startup so UI immediately hides stale/disconnected rows.
+def _read_object_version(client: Minio, object_key: str, version_id: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    response = client.get_object(YARA_STORAGE_BUCKET, object_key, version_id=version_id)
     try:
-        archived = await _archive_inactive_agents()
-        if archived > 0:
-            logger.info("startup archival moved %d agents to stale table", archived)
-        purged = await _purge_old_stale_agents()
-        if purged > 0:
-            logger.info("startup stale retention purge removed %d agents", purged)
-    except Exception:
-        logger.exception("startup archival sweep failed")
-    _cleanup_task = asyncio.create_task(_cleanup_loop())
-
+        return response.read(), response.headers.get("x-amz-version-id")
+    finally:
+        response.close()
+        response.release_conn()
 
-@app.on_event("shutdown")
-async def shutdown() -> None:
-    global _db_pool, _cleanup_task
-    if _cleanup_task is not None:
-        _cleanup_task.cancel()
-        try:
-            await _cleanup_task
-        except asyncio.CancelledError:
-            pass
-        _cleanup_task = None
-    if _db_pool is not None:
-        await _db_pool.close()
-        _db_pool = None
 
+def _bundle_sources(content: str, manifest_rules: list[dict]) -> Dict[str, Tuple[str, str]]:
+    """Recover name -> (sha256, text) from a rendered bundle; rules whose text does not hash back are left out."""
+    sources: Dict[str, Tuple[str, str]] = {}
+    headers = [f"// rule-file: {item['name']} sha256:{item['sha256']}\n" for item in manifest_rules]
+    pos = 0
+    starts = []
+    for header in headers:
+        start = content.find(header, pos)
+        if start == -1:
+            return sources
+        starts.append(start)
+        pos = start + len(header)
+    for idx, item in enumerate(manifest_rules):
+        body_start = starts[idx] + len(headers[idx])
+        # _render_bundle joins parts with "\n" and adds a trailing newline when the file had none.
+        body = content[body_start:starts[idx + 1] - 1] if idx + 1 < len(starts) else content[body_start:]
+        for text in (body, body[:-1]):
+            if hashlib.sha256(text.encode("utf-8")).hexdigest() == item["sha256"]:
+                sources[item["name"]] = (item["sha256"], text)
+                break
+    return sources
+
+
+async def _read_rule_source(client: Minio, object_key: str) -> str:
+    return (await _storage_call(_read_object_bytes, client, object_key)).decode("utf-8")
+
+
+async def _load_stored_bundle(tenant_id: str, version: str) -> Optional[Dict[str, Any]]:
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT version, bundle_sha256, object_key, rule_count, size_bytes, manifest_json, created_at
+            FROM tenant_ruleset_bundles
+            WHERE tenant_id = $1 AND version = $2
+            """,
+            tenant_id,
+            version,
+        )
+    if row is None:
+        return None
+    try:
+        content = await _read_rule_source(_minio_client(), row["object_key"])
+    except S3Error as exc:
+        if exc.code in {"NoSuchKey", "NoSuchObject"}:
+            return None
+        raise
+    if hashlib.sha256(content.encode("utf-8")).hexdigest() != row["bundle_sha256"]:
+        return None
+    manifest = _json_value(row["manifest_json"], {})
+    return {
+        "version": row["version"],
+        "sha256": row["bundle_sha256"],
+        "object_key": row["object_key"],
+        "rule_count": int(row["rule_count"] or 0),
+        "size_bytes": int(row["size_bytes"] or 0),
+        "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+        "manifest": manifest,
+        "content": content,
+        # Lets the next rebuild re-read only rules that changed since this bundle.
+        "sources": _bundle_sources(content, manifest.get("rules") or []),
+    }
 
-@app.get("/health")
-async def health() -> JSONResponse:
-    return JSONResponse({"status": "healthy"})
 
+async def _get_tenant_bundle(tenant_id: str) -> Dict[str, Any]:
+    """Return the tenant's current ruleset bundle, rebuilding it only when a rule hash changed.
 
-@app.get("/setup/status")
-async def setup_status() -> JSONResponse:
-    initialized = await _is_initialized()
-    setup_token_required = bool(INITIAL_SETUP_TOKEN.strip())
-    return JSONResponse({"initialized": initialized, "setup_token_required": setup_token_required})
+    The bundle version is derived from the (name, sha256) pairs in yara_rule_files, so an
+    unchanged tenant costs one indexed metadata query. On rebuild only rules whose sha256
+    differs from the previous bundle are read from MinIO.
+    """
+    _ensure_yara_storage_enabled()
+    metadata = await _list_rule_metadata(tenant_id)
+    rules = sorted(
+        (
+            {"name": name, "sha256": _safe_string(row["sha256"]), "object_key": row["object_key"], "size_bytes": int(row["size_bytes"] or 0)}
+            for name, row in metadata.items()
+            if name.endswith(".yar") and row["sha256"]
+        ),
+        key=lambda item: item["name"],
+    )
+    if not rules:
+        raise HTTPException(status_code=404, detail="tenant has no rules")
+    # While metadata lags the objects, the built bundle carries the re-read version; the
+    # metadata version it was built from still identifies it until metadata catches up.
+    metadata_version = _bundle_version(rules)
+    cached = _tenant_bundles.get(tenant_id)
+    if cached and metadata_version in (cached["version"], cached.get("metadata_version")):
+        return cached
+
+    lock = _tenant_bundle_locks.setdefault(tenant_id, asyncio.Lock())
+    async with lock:
+        cached = _tenant_bundles.get(tenant_id)
+        if cached and metadata_version in (cached["version"], cached.get("metadata_version")):
+            return cached
+        stored = await _load_stored_bundle(tenant_id, metadata_version)
+        if stored is not None:
+            _tenant_bundles[tenant_id] = stored
+            return stored
+
+        previous = (cached or {}).get("sources") or {}
+        sources: Dict[str, Tuple[str, str]] = {}
+        client = _minio_client()
+        try:
+            for item in rules:
+                prior = previous.get(item["name"])
+                if prior and prior[0] == item["sha256"]:
+                    sources[item["name"]] = prior
+                    continue
+                text = await _read_rule_source(client, item["object_key"])
+                actual = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                if actual != item["sha256"]:
+                    # Metadata lags the object; the rule changed mid-build, so take what is stored.
+                    item["sha256"] = actual
+                sources[item["name"]] = (item["sha256"], text)
+        except S3Error as exc:
+            logger.exception("failed to read rules for tenant bundle")
+            raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="rule content is not valid UTF-8")
+
+        version = _bundle_version(rules)
+        if version != metadata_version:
+            stored = await _load_stored_bundle(tenant_id, version)
+            if stored is not None:
+                stored["metadata_version"] = metadata_version
+                _tenant_bundles[tenant_id] = stored
+                return stored
+        content = _render_bundle(rules, {name: text for name, (_, text) in sources.items()})
+        encoded = content.encode("utf-8")
+        bundle_sha256 = hashlib.sha256(encoded).hexdigest()
+        object_key = _bundle_object_key(tenant_id, version)
+        manifest = {
+            "tenant_id": tenant_id,
+            "version": version,
+            "sha256": bundle_sha256,
+            "rules": [{"name": item["name"], "sha256": item["sha256"], "size_bytes": item["size_bytes"]} for item in rules],
+        }
+        try:
+            await _storage_call(
+                client.put_object,
+                YARA_STORAGE_BUCKET,
+                object_key,
+                io.BytesIO(encoded),
+                len(encoded),
+                "text/plain; charset=utf-8",
+            )
+        except Exception as exc:
+            logger.exception("failed to store tenant bundle")
+            raise HTTPException(status_code=502, detail=f"yara storage write failed: {exc}")
+        db = await _db()
+        async with db.acquire() as conn:
+            created_at = await conn.fetchval(
+                """
+                INSERT INTO tenant_ruleset_bundles (
+                    tenant_id, version, bundle_sha256, object_key, rule_count, size_bytes, manifest_json
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb)
+                ON CONFLICT (tenant_id, version) DO UPDATE SET
+                    bundle_sha256 = EXCLUDED.bundle_sha256,
+                    object_key = EXCLUDED.object_key,
+                    rule_count = EXCLUDED.rule_count,
+                    size_bytes = EXCLUDED.size_bytes,
+                    manifest_json = EXCLUDED.manifest_json
+                RETURNING created_at
+                """,
+                tenant_id,
+                version,
+                bundle_sha256,
+                object_key,
+                len(rules),
+                len(encoded),
+                json.dumps(manifest),
+            )
+        bundle = {
+            "version": version,
+            "sha256": bundle_sha256,
+            "object_key": object_key,
+            "rule_count": len(rules),
+            "size_bytes": len(encoded),
+            "created_at": created_at.isoformat() if created_at else None,
+            "manifest": manifest,
+            "content": content,
+            "sources": sources,
+            "metadata_version": metadata_version,
+        }
+        _tenant_bundles[tenant_id] = bundle
+        return bundle
+
+
+def _bundle_summary(tenant_id: str, bundle: Dict[str, Any]) -> dict:
+    return {
+        "tenant_id": tenant_id,
+        "version": bundle["version"],
+        "sha256": bundle["sha256"],
+        "object_key": bundle["object_key"],
+        "rule_count": bundle["rule_count"],
+        "size_bytes": bundle["size_bytes"],
+        "created_at": bundle["created_at"],
+        "rules": (bundle.get("manifest") or {}).get("rules") or [],
+    }
 
 
-@app.post("/auth/setup")
-async def setup_admin(payload: dict) -> JSONResponse:
-    if await _is_initialized():
-        raise HTTPException(status_code=409, detail="already initialized")
+_METADATA_SYNC_LOCK_KEY = 0x79617261  # pg advisory lock id shared by all replicas
+_RULE_OBJECT_RE = re.compile(r"tenants/([^/]+)/yara/([A-Za-z0-9._-]+\.yar)")
 
-    username = (payload.get("username") or "").strip()
-    password = payload.get("password") or ""
-    setup_token = payload.get("setup_token") or ""
-    settings = payload.get("settings") or {}
 
-    if INITIAL_SETUP_TOKEN and setup_token != INITIAL_SETUP_TOKEN:
-        raise HTTPException(status_code=401, detail="invalid setup token")
+def _normalize_etag(value: Any) -> str:
+    return _safe_string(value).strip().strip('"')
 
-    if len(username) < 3:
-        raise HTTPException(status_code=400, detail="username must be at least 3 characters")
 
-    if len(password) < 8:
-        raise HTTPException(status_code=400, detail="password must be at least 8 characters")
+def _list_bucket_page(client: Minio, start_after: str, limit: int) -> list:
+    """Up to limit objects under tenants/*/yara/ after start_after, in key order.
 
-    if not isinstance(settings, dict):
-        raise HTTPException(status_code=400, detail="settings must be an object")
+    Tenants are listed non-recursively and only their yara/ prefix recursively, so samples,
+    compiled rules and bundles sharing the bucket are never paged through.
+    """
+    page = []
+    for tenant in client.list_objects(YARA_STORAGE_BUCKET, prefix="tenants/", recursive=False):
+        if not tenant.is_dir:
+            continue
+        prefix = f"{tenant.object_name}yara/"
+        resume = start_after if start_after and start_after.startswith(prefix) else None
+        if start_after and resume is None and start_after > prefix:
+            # The cursor is past every key under this prefix.
+            continue
+        for obj in client.list_objects(YARA_STORAGE_BUCKET, prefix=prefix, recursive=True, start_after=resume):
+            page.append(obj)
+            if len(page) >= limit:
+                return page
+    return page
+
+
+async def _sync_rule_metadata_page(conn: asyncpg.Connection, start_after: str, started_at: datetime) -> Tuple[str, int, bool]:
+    """Reconcile one listing page after `start_after`; returns (next cursor, changed rows, cycle done)."""
+    limit = max(1, YARA_METADATA_SYNC_BATCH_SIZE)
+    client = _minio_client()
+    page = await _storage_call(_list_bucket_page, client, start_after, limit)
+    done = len(page) < limit
+    last_key = _safe_string(getattr(page[-1], "object_name", "")) if page else None
+
+    listed: Dict[str, Any] = {}
+    for obj in page:
+        key = _safe_string(getattr(obj, "object_name", ""))
+        if _RULE_OBJECT_RE.fullmatch(key):
+            listed[key] = obj
+    known = {
+        r["object_key"]: _normalize_etag(r["etag"])
+        for r in await conn.fetch(
+            "SELECT object_key, etag FROM yara_rule_files WHERE object_key = ANY($1::text[]) AND deleted_at IS NULL",
+            list(listed),
+        )
+    }
+
+    changed = 0
+    touched_tenants: set[str] = set()
+    for key, obj in listed.items():
+        etag = _normalize_etag(getattr(obj, "etag", ""))
+        if key in known and known[key] == etag:
+            continue
+        # Only objects whose etag moved are downloaded and hashed.
+        try:
+            data, version_id = await _storage_call(_read_object_version, client, key)
+        except S3Error as exc:
+            if exc.code in {"NoSuchKey", "NoSuchObject"}:
+                continue
+            raise
+        tenant_id, name = _RULE_OBJECT_RE.fullmatch(key).groups()
+        sha256_hex = hashlib.sha256(data).hexdigest()
+        updated = await conn.fetchval(
+            """
+            INSERT INTO yara_rule_files (
+                id, tenant_id, name, object_key, etag, sha256, size_bytes, created_by, updated_by, updated_at
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7, 'system:sync', 'system:sync', COALESCE($8, now()))
+            ON CONFLICT (tenant_id, name) DO UPDATE SET
+                object_key = EXCLUDED.object_key,
+                etag = EXCLUDED.etag,
+                sha256 = EXCLUDED.sha256,
+                size_bytes = EXCLUDED.size_bytes,
+                updated_by = EXCLUDED.updated_by,
+                updated_at = now(),
+                deleted_at = NULL
+            WHERE yara_rule_files.etag IS DISTINCT FROM EXCLUDED.etag OR yara_rule_files.deleted_at IS NOT NULL
+            RETURNING name
+            """,
+            str(uuid.uuid4()),
+            tenant_id,
+            name,
+            key,
+            etag,
+            sha256_hex,
+            len(data),
+            getattr(obj, "last_modified", None),
+        )
+        if updated is None:
+            continue
+        await _record_rule_versions(
+            conn,
+            tenant_id,
+            [
+                {
+                    "name": name,
+                    "version_id": version_id,
+                    "sha256": sha256_hex,
+                    "size_bytes": len(data),
+                    "etag": etag,
+                    "actor": "system:sync",
+                    "action": "sync",
+                }
+            ],
+        )
+        changed += 1
+        touched_tenants.add(tenant_id)
+
+    # Rows in the listed key range whose object is gone were deleted behind our back.
+    # Rows written after this pass started may belong to objects the listing has not seen yet.
+    removed = await conn.fetch(
+        """
+        DELETE FROM yara_rule_files
+        WHERE object_key COLLATE "C" > $1
+          AND ($2::text IS NULL OR object_key COLLATE "C" <= $2)
+          AND NOT (object_key = ANY($3::text[]))
+          AND updated_at < $4
+        RETURNING tenant_id, name
+        """,
+        start_after or "",
+        None if done else last_key,
+        list(listed),
+        started_at,
+    )
+    changed += len(removed)
+    for row in removed:
+        touched_tenants.add(row["tenant_id"])
+        await _record_rule_versions(conn, row["tenant_id"], [{"name": row["name"], "actor": "system:sync", "action": "delete"}])
+        await conn.execute("DELETE FROM yara_rule_index WHERE tenant_id = $1 AND file_name = $2", row["tenant_id"], row["name"])
+    for tenant_id in touched_tenants:
+        _on_rules_changed(tenant_id)
+    return ("" if done else (last_key or "")), changed, done
 
+
+async def _sync_rule_metadata() -> int:
+    """Bring yara_rule_files in line with the bucket, resuming from the persisted listing cursor.
+
+    Runs on one replica at a time (advisory lock). Returns the number of rows changed.
+    """
     db = await _db()
-    password_hash = pwd_context.hash(password)
+    changed_total = 0
+    async with db.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", _METADATA_SYNC_LOCK_KEY):
+            return 0
+        try:
+            state = await conn.fetchrow(
+                "SELECT cursor, cycle_started_at FROM yara_metadata_sync_state WHERE bucket = $1",
+                YARA_STORAGE_BUCKET,
+            )
+            cursor = _safe_string(state["cursor"]) if state else ""
+            while True:
+                started_at = datetime.now(timezone.utc)
+                cursor_before = cursor
+                cursor, changed, done = await _sync_rule_metadata_page(conn, cursor, started_at)
+                changed_total += changed
+                await conn.execute(
+                    """
+                    INSERT INTO yara_metadata_sync_state (bucket, cursor, cycle_started_at, last_cycle_completed_at, updated_at)
+                    VALUES ($1, $2, $3, CASE WHEN $4 THEN now() END, now())
+                    ON CONFLICT (bucket) DO UPDATE SET
+                        cursor = EXCLUDED.cursor,
+                        cycle_started_at = CASE WHEN $5 = '' THEN EXCLUDED.cycle_started_at ELSE yara_metadata_sync_state.cycle_started_at END,
+                        last_cycle_completed_at = COALESCE(EXCLUDED.last_cycle_completed_at, yara_metadata_sync_state.last_cycle_completed_at),
+                        updated_at = now()
+                    """,
+                    YARA_STORAGE_BUCKET,
+                    cursor,
+                    started_at,
+                    done,
+                    cursor_before,
+                )
+                if done:
+                    break
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", _METADATA_SYNC_LOCK_KEY)
+    return changed_total
 
-    try:
+
+async def _metadata_sync_loop() -> None:
+    while True:
+        try:
+            changed = await _sync_rule_metadata()
+            if changed > 0:
+                logger.info("rule metadata sync updated %d rows from bucket", changed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("rule metadata sync failed")
+        await asyncio.sleep(max(10.0, YARA_METADATA_SYNC_INTERVAL_SECONDS))
+
+
+def _rule_search_text(rule: dict) -> str:
+    parts = [rule["rule_name"], *rule["tags"], *rule["imports"], *rule["string_ids"], *rule["literals"]]
+    for key, value in rule["meta"].items():
+        parts.extend((key, value))
+    return "\n".join(parts)
+
+
+async def _index_rule_file(conn: asyncpg.Connection, tenant_id: str, name: str, content: str) -> int:
+    rules = _parse_yara_rules(content)
+    await conn.execute("DELETE FROM yara_rule_index WHERE tenant_id = $1 AND file_name = $2", tenant_id, name)
+    if not rules:
+        return 0
+    await conn.execute(
+        """
+        INSERT INTO yara_rule_index (
+            tenant_id, file_name, rule_name, is_private, is_global, tags, imports, meta,
+            string_ids, literals, condition_text, literals_text, search_text
+        )
+        SELECT $1, $2, t.rule_name, t.is_private, t.is_global,
+               ARRAY(SELECT jsonb_array_elements_text(t.tags)),
+               ARRAY(SELECT jsonb_array_elements_text(t.imports)),
+               t.meta,
+               ARRAY(SELECT jsonb_array_elements_text(t.string_ids)),
+               ARRAY(SELECT jsonb_array_elements_text(t.literals)),
+               t.condition_text, t.literals_text, t.search_text
+        FROM unnest($3::text[], $4::bool[], $5::bool[], $6::jsonb[], $7::jsonb[], $8::jsonb[], $9::jsonb[], $10::jsonb[], $11::text[], $12::text[], $13::text[])
+            AS t(rule_name, is_private, is_global, tags, imports, meta, string_ids, literals, condition_text, literals_text, search_text)
+        ON CONFLICT (tenant_id, file_name, rule_name) DO NOTHING
+        """,
+        tenant_id,
+        name,
+        [r["rule_name"] for r in rules],
+        [r["is_private"] for r in rules],
+        [r["is_global"] for r in rules],
+        [json.dumps(r["tags"]) for r in rules],
+        [json.dumps(r["imports"]) for r in rules],
+        [json.dumps(r["meta"]) for r in rules],
+        [json.dumps(r["string_ids"]) for r in rules],
+        [json.dumps(r["literals"]) for r in rules],
+        [r["condition"] for r in rules],
+        ["\n".join(r["literals"]) for r in rules],
+        [_rule_search_text(r) for r in rules],
+    )
+    return len(rules)
+
+
+async def _index_rule_row(db: asyncpg.Pool, row: asyncpg.Record, content: str) -> bool:
+    """Write one file's index if its sha256 is still the one that was read; False otherwise."""
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            # Compare-and-set: a rule rewritten since the claim is left for the next pass.
+            updated = await conn.fetchval(
+                """
+                UPDATE yara_rule_files SET indexed_sha256 = $3, index_claimed_at = NULL
+                WHERE tenant_id = $1 AND name = $2 AND sha256 = $3 AND deleted_at IS NULL
+                RETURNING name
+                """,
+                row["tenant_id"],
+                row["name"],
+                row["sha256"],
+            )
+            if updated is not None:
+                await _index_rule_file(conn, row["tenant_id"], row["name"], content)
+                return True
+        await conn.execute(
+            "UPDATE yara_rule_files SET index_claimed_at = NULL WHERE tenant_id = $1 AND name = $2",
+            row["tenant_id"],
+            row["name"],
+        )
+    return False
+
+
+async def _index_pending_rules() -> int:
+    """Re-index rule files whose sha256 moved since they were last parsed; returns files indexed.
+
+    Rows are claimed (index_claimed_at) and committed before any object is read, so rule writes
+    never wait on storage reads here. A file that cannot be read keeps its claim and is retried
+    after RULE_INDEX_CLAIM_SECONDS without holding up the rest.
+    """
+    db = await _db()
+    client = _minio_client()
+    indexed = 0
+    while True:
         async with db.acquire() as conn:
-            await conn.execute(
+            # SKIP LOCKED plus the claim lease lets every replica run the indexer without doing the same file twice.
+            rows = await conn.fetch(
                 """
-                INSERT INTO users (username, password_hash, role, settings_json)
-                VALUES ($1, $2, 'admin', $3::jsonb)
+                UPDATE yara_rule_files f SET index_claimed_at = now()
+                FROM (
+                    SELECT tenant_id, name
+                    FROM yara_rule_files
+                    WHERE deleted_at IS NULL
+                      AND sha256 IS NOT NULL
+                      AND indexed_sha256 IS DISTINCT FROM sha256
+                      AND (index_claimed_at IS NULL OR index_claimed_at < now() - make_interval(secs => $2::int))
+                    ORDER BY updated_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                ) c
+                WHERE f.tenant_id = c.tenant_id AND f.name = c.name
+                RETURNING f.tenant_id, f.name, f.object_key, f.sha256
                 """,
-                username,
-                password_hash,
-                json.dumps(settings),
+                max(1, RULE_INDEX_BATCH_SIZE),
+                max(1, RULE_INDEX_CLAIM_SECONDS),
             )
-    except asyncpg.UniqueViolationError:
-        raise HTTPException(status_code=409, detail="already initialized")
+        if not rows:
+            return indexed
+        for row in rows:
+            entry = _rule_cache_get(row["tenant_id"], row["name"], row["sha256"])
+            if entry is not None:
+                content = entry["content"]
+            else:
+                try:
+                    content = (await _storage_call(_read_object_bytes, client, row["object_key"])).decode("utf-8", "replace")
+                except S3Error as exc:
+                    if exc.code not in {"NoSuchKey", "NoSuchObject"}:
+                        logger.warning("rule index skipped %s: %s", row["object_key"], exc.code)
+                        continue
+                    content = ""
+                except Exception:
+                    logger.exception("rule index skipped %s", row["object_key"])
+                    continue
+            if await _index_rule_row(db, row, content):
+                indexed += 1
+
+
+async def _rule_index_loop() -> None:
+    while True:
+        sweep = False
+        try:
+            await asyncio.wait_for(_rule_index_wakeup.wait(), timeout=max(10.0, RULE_INDEX_INTERVAL_SECONDS))
+        except asyncio.TimeoutError:
+            sweep = True
+        _rule_index_wakeup.clear()
+        try:
+            indexed = await _index_pending_rules()
+            if indexed > 0:
+                logger.info("rule search index refreshed %d files", indexed)
+            if sweep:
+                db = await _db()
+                async with db.acquire() as conn:
+                    await conn.execute(
+                        """
+                        DELETE FROM yara_rule_index i
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM yara_rule_files f
+                            WHERE f.tenant_id = i.tenant_id AND f.name = i.file_name AND f.deleted_at IS NULL
+                        )
+                        """
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("rule search indexing failed")
 
-    token = create_access_token(subject=username)
-    return JSONResponse(
-        {
-            "access_token": token,
-            "token_type": "bearer",
-            "username": username,
-            "settings": settings,
-        }
-    )
 
+_RETROHUNT_CLAIM_LOCK_KEY = 0x72657472  # pg advisory lock id serializing per-tenant admission across replicas
+_RETROHUNT_TERMINAL = {"completed", "failed", "cancelled"}
+_RETROHUNT_JOB_COLUMNS = (
+    "id, tenant_id, rule_sha256, source, prefix, status, sample_count, shard_count, shards_done, "
+    "candidate_count, files_scanned, bytes_scanned, match_count, error_text, created_by, created_at, started_at, "
+    "completed_at"
+)
 
-@app.post("/auth/login")
-async def login(payload: dict) -> JSONResponse:
-    if not await _is_initialized():
-        raise HTTPException(status_code=412, detail="setup required")
 
-    username = (payload.get("username") or "").strip()
-    password = payload.get("password") or ""
+def _retrohunt_job_to_dict(row: asyncpg.Record) -> dict:
+    out = {key: row[key] for key in _RETROHUNT_JOB_COLUMNS.split(", ")}
+    for key in ("created_at", "started_at", "completed_at"):
+        out[key] = out[key].isoformat() if out[key] else None
+    return out
 
-    user = await _fetch_user_by_username(username)
-    if user is None or not pwd_context.verify(password, user.get("password_hash", "")):
-        raise HTTPException(status_code=401, detail="invalid username or password")
 
-    db = await _db()
-    async with db.acquire() as conn:
-        await conn.execute("UPDATE users SET last_login = now() WHERE username = $1", username)
+def _retrohunt_sample_prefix(tenant_id: str, prefix: str) -> str:
+    return f"tenants/{tenant_id}/samples/{prefix}"
 
-    token = create_access_token(subject=username)
-    return JSONResponse(
-        {
-            "access_token": token,
-            "token_type": "bearer",
-            "username": username,
-            "settings": user.get("settings_json") or {},
-        }
-    )
 
+def _list_local_samples(prefix: str) -> list[str]:
+    root = os.path.realpath(RETROHUNT_CORPUS_DIR)
+    base = os.path.realpath(os.path.join(root, prefix))
+    if base != root and not base.startswith(root + os.sep):
+        raise ValueError("prefix escapes the retro-hunt corpus directory")
+    if not os.path.isdir(base):
+        return []
+    files = yara_profiler.corpus_files(base, RETROHUNT_MAX_SAMPLES, RETROHUNT_MAX_SAMPLE_BYTES)
+    return [os.path.relpath(path, root) for path in files]
 
-@app.get("/auth/validate")
-async def validate_auth(user: dict = Depends(get_current_user)) -> JSONResponse:
-    username = str(user.get("sub", "user"))
-    headers = {
-        "X-Auth-Request-User": username,
-        "X-Auth-Request-Email": username,
-    }
-    return JSONResponse({"ok": True, "user": username}, headers=headers)
 
+def _prefilter_local_samples(rule_source: str, rule_count: Optional[int], samples: list[str]) -> Optional[list[str]]:
+    """Local samples the n-gram index cannot rule out, or None when the index does not narrow this hunt.
 
-@app.get("/settings")
-async def get_settings(user: dict = Depends(get_current_user)) -> JSONResponse:
-    username = str(user["sub"])
-    row = await _fetch_user_by_username(username)
-    if row is None:
-        raise HTTPException(status_code=404, detail="user not found")
-    return JSONResponse({"settings": row.get("settings_json") or {}})
+    rule_count is the compiler's count for rule_source (None when unknown). Samples the index
+    does not cover, or that changed since they were indexed, are always kept.
+    """
+    if not RETROHUNT_INDEX_DIR or not samples or rule_count is None:
+        return None
+    plan = _prefilter_plan(rule_source)
+    # The planner is a lenient parse; only trust it when it saw every rule the compiler did.
+    if plan is None or len(_parse_yara_rules(rule_source)) != rule_count:
+        return None
+    try:
+        index = ngram_index.NgramIndex(RETROHUNT_INDEX_DIR)
+    except FileNotFoundError:
+        return None
+    try:
+        if index.corpus != os.path.realpath(RETROHUNT_CORPUS_DIR):
+            logger.warning("retro-hunt index %s covers %s, not the corpus directory", RETROHUNT_INDEX_DIR, index.corpus)
+            return None
+        candidates = index.candidates(plan)
+        if candidates is None:
+            return None
+        hits = {index.files[file_id][0] for file_id in candidates if file_id in index.files}
+        kept = []
+        for relpath in samples:
+            entry = index.entry(relpath)
+            if entry is None or relpath in hits:
+                kept.append(relpath)
+                continue
+            try:
+                st = os.stat(os.path.join(index.corpus, relpath))
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != (entry[1], entry[2]):
+                kept.append(relpath)
+        return kept
+    finally:
+        index.close()
 
 
-@app.put("/settings")
-async def update_settings(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
-    settings = payload.get("settings")
-    if not isinstance(settings, dict):
-        raise HTTPException(status_code=400, detail="settings must be an object")
+def _list_minio_samples(client: Minio, prefix: str) -> list[str]:
+    keys: list[str] = []
+    for obj in client.list_objects(RETROHUNT_SAMPLE_BUCKET, prefix=prefix, recursive=True):
+        if obj.is_dir or (obj.size or 0) > RETROHUNT_MAX_SAMPLE_BYTES:
+            continue
+        keys.append(obj.object_name)
+        if len(keys) >= RETROHUNT_MAX_SAMPLES:
+            break
+    return keys
 
-    username = str(user["sub"])
+
+async def _claim_retrohunt_job(exclude: list[str]) -> Optional[asyncpg.Record]:
+    """Take the oldest queued job (or one whose runner stopped heartbeating) whose tenant is below its running limit.
+
+    Jobs in exclude (those this replica is still running) are never re-claimed. Each claim gets a new
+    claim_token; a runner only writes while the job still carries its token.
+    """
     db = await _db()
     async with db.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET settings_json = $2::jsonb WHERE username = $1",
-            username,
-            json.dumps(settings),
-        )
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _RETROHUNT_CLAIM_LOCK_KEY)
+            return await conn.fetchrow(
+                f"""
+                UPDATE retrohunt_jobs
+                SET status = 'running', owner_replica = $1, claim_token = $4, heartbeat_at = now(),
+                    started_at = COALESCE(started_at, now())
+                WHERE id = (
+                    SELECT j.id FROM retrohunt_jobs j
+                    WHERE (j.status = 'queued'
+                           OR (j.status = 'running' AND j.heartbeat_at < now() - make_interval(secs => $2::int)))
+                      AND NOT (j.id = ANY($5::text[]))
+                      AND (
+                        SELECT count(*) FROM retrohunt_jobs r
+                        WHERE r.tenant_id = j.tenant_id AND r.id <> j.id AND r.status = 'running'
+                          AND r.heartbeat_at >= now() - make_interval(secs => $2::int)
+                      ) < $3
+                    ORDER BY j.created_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {_RETROHUNT_JOB_COLUMNS}, rule_source, rule_count, planned_at, claim_token
+                """,
+                ORCHESTRATOR_REPLICA_ID,
+                RETROHUNT_STALE_SECONDS,
+                max(1, RETROHUNT_MAX_JOBS_PER_TENANT),
+                uuid.uuid4().hex,
+                exclude,
+            )
 
-    return JSONResponse({"settings": settings})
 
+async def _with_retrohunt_heartbeat(job: dict, awaitable):
+    """Await a long planning step while heartbeating the job, so it is not taken over as stale meanwhile."""
 
-@app.get("/agents")
-async def list_agents(_: dict = Depends(get_current_user)):
+    async def _beat() -> None:
+        while True:
+            await asyncio.sleep(max(1.0, RETROHUNT_HEARTBEAT_SECONDS))
+            try:
+                if not await _retrohunt_heartbeat(job):
+                    return
+            except Exception:
+                logger.warning("retro-hunt %s: heartbeat failed during planning", job["id"], exc_info=True)
+
+    beater = asyncio.create_task(_beat())
+    try:
+        return await awaitable
+    finally:
+        beater.cancel()
+
+
+async def _plan_retrohunt_shards(job: dict) -> bool:
+    """Split the job's samples into shards; returns False once the job is no longer ours to run."""
+    if job["planned_at"] is not None:
+        return True
+    candidates: Optional[list[str]] = None
+    if job["source"] == "local":
+        samples = await _with_retrohunt_heartbeat(job, asyncio.to_thread(_list_local_samples, job["prefix"]))
+        try:
+            rule_count = job["rule_count"]
+            if rule_count is None and RETROHUNT_INDEX_DIR and _yara_compiler_idle is not None:
+                # Jobs queued before rule_count was recorded; the compile stays in the limited pool.
+                rule_count = (await _compile_in_pool(job["rule_source"])).get("rule_count")
+            candidates = await _with_retrohunt_heartbeat(
+                job, asyncio.to_thread(_prefilter_local_samples, job["rule_source"], rule_count, samples)
+            )
+        except Exception:
+            logger.exception("retro-hunt %s: n-gram prefilter failed; scanning every sample", job["id"])
+        if candidates is not None:
+            logger.info("retro-hunt %s: n-gram prefilter kept %d of %d samples", job["id"], len(candidates), len(samples))
+    else:
+        samples = await _with_retrohunt_heartbeat(
+            job,
+            _storage_call(_list_minio_samples, _minio_client(), _retrohunt_sample_prefix(job["tenant_id"], job["prefix"])),
+        )
+    size = max(1, RETROHUNT_SHARD_SIZE)
+    scan = samples if candidates is None else candidates
+    shards = [scan[i:i + size] for i in range(0, len(scan), size)]
     db = await _db()
-    rows = []
     async with db.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
-                   capabilities_json, is_ephemeral, instance_id, runtime_kind, lease_expires_at,
-                   asset_profile_json, findings_count
-            FROM agents_control_state
-            ORDER BY updated_at DESC
+        async with conn.transaction():
+            # Fenced first: this also locks the job row against a concurrent re-claim while shards are replaced.
+            updated = await conn.fetchval(
+                """
+                UPDATE retrohunt_jobs
+                SET sample_count = $2, shard_count = $3, candidate_count = $4, planned_at = now(), heartbeat_at = now()
+                WHERE id = $1 AND status = 'running' AND claim_token = $5
+                RETURNING id
+                """,
+                job["id"],
+                len(samples),
+                len(shards),
+                None if candidates is None else len(candidates),
+                job["claim_token"],
+            )
+            if updated is None:
+                return False
+            await conn.execute("DELETE FROM retrohunt_shards WHERE job_id = $1", job["id"])
+            await conn.execute(
+                """
+                INSERT INTO retrohunt_shards (job_id, shard_index, sample_keys)
+                SELECT $1, t.shard_index, t.sample_keys
+                FROM unnest($2::int[], $3::jsonb[]) AS t(shard_index, sample_keys)
+                """,
+                job["id"],
+                list(range(len(shards))),
+                [json.dumps(keys) for keys in shards],
+            )
+    return True
+
+
+async def _retrohunt_heartbeat(job: dict) -> bool:
+    db = await _db()
+    async with db.acquire() as conn:
+        updated = await conn.fetchval(
             """
+            UPDATE retrohunt_jobs SET heartbeat_at = now()
+            WHERE id = $1 AND status = 'running' AND claim_token = $2
+            RETURNING id
+            """,
+            job["id"],
+            job["claim_token"],
         )
+    return updated is not None
+
+
+async def _scan_retrohunt_shard(job: dict, shard_index: int, keys: list[str], pool, spool_dir: Optional[str]) -> bool:
+    """Scan one shard and checkpoint it; returns False once the job is no longer ours to run."""
+    loop = asyncio.get_running_loop()
+    gate = asyncio.Semaphore(max(1, RETROHUNT_WORKERS) * 2)
+    client = _minio_client() if job["source"] == "minio" else None
+
+    async def _scan_one(key: str) -> dict:
+        async with gate:
+            if client is None:
+                path = os.path.join(RETROHUNT_CORPUS_DIR, key)
+            else:
+                path = os.path.join(spool_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+                try:
+                    await _storage_call(client.fget_object, RETROHUNT_SAMPLE_BUCKET, key, path)
+                except S3Error as exc:
+                    return {"key": key, "size_bytes": 0, "rules": [], "error": exc.code}
+            try:
+                result = await loop.run_in_executor(pool, yara_profiler.scan_file, path, RETROHUNT_FILE_TIMEOUT_SECONDS)
+            finally:
+                if client is not None:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        result["key"] = key
+        return result
 
-    now = datetime.now(timezone.utc)
-    out = []
-    for row in rows:
-        aid = row["agent_id"]
-        connected_at = row["connected_at"]
-        last_seen = row["last_seen"]
-        last_heartbeat = row["last_heartbeat"]
-        capabilities = row.get("capabilities_json") or {}
-        tenant_id = row["tenant_id"]
-        status_value = row["status"] or "disconnected"
-        is_ephemeral = bool(row.get("is_ephemeral"))
-        instance_id = row.get("instance_id")
-        runtime_kind = row.get("runtime_kind")
-        lease_expires_at = row.get("lease_expires_at")
-        asset_profile = row.get("asset_profile_json") or {}
-        findings_count = int(row.get("findings_count") or 0)
-
-        status = status_value
-        freshness_ts = last_heartbeat or last_seen or connected_at
-        if freshness_ts is not None and (now - freshness_ts).total_seconds() > AGENT_STALE_SECONDS:
-            if status_value == "connected":
-                status = "stale"
+    db = await _db()
+    files_scanned = bytes_scanned = 0
+    last_beat = loop.time()
+    tasks = [asyncio.create_task(_scan_one(key)) for key in keys]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            files_scanned += 1
+            if result["error"] is None:
+                bytes_scanned += result["size_bytes"]
+            if result["rules"]:
+                # Streamed as found; a re-scan after resume hits the unique key instead of duplicating.
+                async with db.acquire() as conn:
+                    await conn.execute(
+                        """
+                        INSERT INTO retrohunt_matches (job_id, shard_index, sample_key, rule_name, string_matches, size_bytes)
+                        SELECT $1, $2, $3, t.rule_name, t.string_matches, $4
+                        FROM unnest($5::text[], $6::int[]) AS t(rule_name, string_matches)
+                        ON CONFLICT (job_id, sample_key, rule_name) DO NOTHING
+                        """,
+                        job["id"],
+                        shard_index,
+                        result["key"],
+                        result["size_bytes"],
+                        [rule for rule, _ in result["rules"]],
+                        [hits for _, hits in result["rules"]],
+                    )
+            if loop.time() - last_beat >= RETROHUNT_HEARTBEAT_SECONDS:
+                last_beat = loop.time()
+                if not await _retrohunt_heartbeat(job):
+                    return False
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            updated = await conn.fetchval(
+                """
+                UPDATE retrohunt_jobs
+                SET shards_done = shards_done + 1,
+                    files_scanned = files_scanned + $3,
+                    bytes_scanned = bytes_scanned + $4,
+                    match_count = (SELECT count(*) FROM retrohunt_matches WHERE job_id = $1),
+                    heartbeat_at = now()
+                WHERE id = $1 AND status = 'running' AND claim_token = $2
+                RETURNING id
+                """,
+                job["id"],
+                job["claim_token"],
+                files_scanned,
+                bytes_scanned,
+            )
+            if updated is None:
+                return False
+            await conn.execute(
+                """
+                UPDATE retrohunt_shards
+                SET status = 'done', files_scanned = $3, bytes_scanned = $4, completed_at = now()
+                WHERE job_id = $1 AND shard_index = $2
+                """,
+                job["id"],
+                shard_index,
+                files_scanned,
+                bytes_scanned,
+            )
+    return True
+
+
+async def _run_retrohunt_job(job: dict) -> None:
+    job_id = job["id"]
+    pool: Optional[ProcessPoolExecutor] = None
+    spool_dir: Optional[str] = None
+    try:
+        if not await _plan_retrohunt_shards(job):
+            logger.info("retro-hunt %s stopped: cancelled or taken over", job_id)
+            return
+        db = await _db()
+        async with db.acquire() as conn:
+            shards = await conn.fetch(
+                """
+                SELECT shard_index, sample_keys FROM retrohunt_shards
+                WHERE job_id = $1 AND status <> 'done'
+                ORDER BY shard_index
+                """,
+                job_id,
+            )
+        if shards:
+            pool = ProcessPoolExecutor(
+                max_workers=max(1, RETROHUNT_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=yara_profiler.init_worker,
+                initargs=(job["rule_source"], YARA_COMPILER_MEMORY_LIMIT_MB * 1024 * 1024 + RETROHUNT_MAX_SAMPLE_BYTES),
+            )
+            if job["source"] == "minio":
+                spool_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="retrohunt-")
+            for shard in shards:
+                keys = _json_value(shard["sample_keys"], [])
+                if not await _scan_retrohunt_shard(job, shard["shard_index"], keys, pool, spool_dir):
+                    logger.info("retro-hunt %s stopped: cancelled or taken over", job_id)
+                    return
+        async with db.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE retrohunt_jobs SET status = 'completed', completed_at = now(), heartbeat_at = now()
+                WHERE id = $1 AND status = 'running' AND claim_token = $2
+                """,
+                job_id,
+                job["claim_token"],
+            )
+        logger.info("retro-hunt %s completed", job_id)
+    except asyncio.CancelledError:
+        # Shutdown or cancel: checkpointed shards stay done and another pass resumes the rest.
+        raise
+    except Exception as exc:
+        logger.exception("retro-hunt %s failed", job_id)
+        try:
+            db = await _db()
+            async with db.acquire() as conn:
+                await conn.execute(
+                    """
+                    UPDATE retrohunt_jobs SET status = 'failed', error_text = $2, completed_at = now()
+                    WHERE id = $1 AND status = 'running' AND claim_token = $3
+                    """,
+                    job_id,
+                    str(exc)[:2000],
+                    job["claim_token"],
+                )
+        except Exception:
+            logger.exception("failed to record retro-hunt %s failure", job_id)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        _retrohunt_running.pop(job_id, None)
+        _retrohunt_wakeup.set()
+
+
+async def _retrohunt_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_retrohunt_wakeup.wait(), timeout=max(1.0, RETROHUNT_POLL_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        _retrohunt_wakeup.clear()
+        try:
+            while len(_retrohunt_running) < max(1, RETROHUNT_MAX_JOBS):
+                row = await _claim_retrohunt_job(list(_retrohunt_running))
+                if row is None:
+                    break
+                logger.info("retro-hunt %s claimed by replica %s", row["id"], ORCHESTRATOR_REPLICA_ID)
+                _retrohunt_running[row["id"]] = _spawn_background(_run_retrohunt_job(dict(row)))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("retro-hunt scheduling failed")
+
+
+async def _retrohunt_index_loop() -> None:
+    while True:
+        try:
+            result = await asyncio.to_thread(
+                ngram_index.update_index,
+                RETROHUNT_CORPUS_DIR,
+                RETROHUNT_INDEX_DIR,
+                gram=RETROHUNT_INDEX_GRAM,
+                workers=max(1, RETROHUNT_WORKERS),
+                max_file_bytes=RETROHUNT_INDEX_MAX_FILE_BYTES,
+            )
+            if result.get("added") or result.get("removed"):
+                logger.info("retro-hunt n-gram index updated: %s", result)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("retro-hunt n-gram index update failed")
+        await asyncio.sleep(RETROHUNT_INDEX_INTERVAL_SECONDS)
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    token = credentials.credentials
+
+    if ORCHESTRATOR_API_TOKEN and token == ORCHESTRATOR_API_TOKEN:
+        return {"sub": "service", "role": "service"}
+
+    payload = decode_token(token)
+    if payload is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+
+    if payload.get("type") != "access":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token type")
+
+    sub = payload.get("sub")
+    if not sub:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload")
+
+    user = await _fetch_user_by_username(str(sub))
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+
+    return payload
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    global _db_pool, _cleanup_task, _agent_state_flush_task, _replica_task, _policy_reconcile_task, _metadata_sync_task
+    global _rule_index_task, _retrohunt_task, _retrohunt_index_task
+    if JWT_SECRET_KEY == "change-me":
+        logger.warning("JWT_SECRET_KEY is using default value. Set it via environment secret.")
+    _db_pool = await asyncpg.create_pool(**_pg_connect_kwargs(), min_size=1, max_size=10)
+    # Run one archival/retention sweep at startup so UI immediately hides stale/disconnected rows.
+    try:
+        archived = await _archive_inactive_agents()
+        if archived > 0:
+            logger.info("startup archival moved %d agents to stale table", archived)
+        purged = await _purge_old_stale_agents()
+        if purged > 0:
+            logger.info("startup stale retention purge removed %d agents", purged)
+    except Exception:
+        logger.exception("startup archival sweep failed")
+    _cleanup_task = asyncio.create_task(_cleanup_loop())
+    _agent_state_flush_task = asyncio.create_task(_agent_state_flush_loop())
+    if ORCHESTRATOR_ROUTING_ENABLED:
+        try:
+            db = await _db()
+            async with db.acquire() as conn:
+                # Routes left behind by a previous process with the same replica id are stale.
+                await conn.execute("DELETE FROM agent_routes WHERE replica_id = $1", ORCHESTRATOR_REPLICA_ID)
+        except Exception:
+            logger.exception("failed to reset agent routes for replica %s", ORCHESTRATOR_REPLICA_ID)
+        _replica_task = asyncio.create_task(_replica_loop())
+        logger.info("agent routing enabled as replica %s", ORCHESTRATOR_REPLICA_ID)
+    if YARA_METADATA_SYNC_ENABLED and YARA_STORAGE_ENABLED:
+        # First pass runs right away so seeded or externally written rules are listed.
+        _metadata_sync_task = asyncio.create_task(_metadata_sync_loop())
+    if YARA_STORAGE_ENABLED:
+        _rule_index_task = asyncio.create_task(_rule_index_loop())
+        # Picks up files written before the index existed.
+        _rule_index_wakeup.set()
+    if POLICY_RECONCILE_ENABLED and YARA_STORAGE_ENABLED:
+        _policy_reconcile_task = asyncio.create_task(_policy_reconcile_loop())
+    try:
+        await _start_yara_compiler_pool()
+    except Exception:
+        logger.exception("yara compiler pool failed to start; validation falls back to yarac")
+    if RETROHUNT_ENABLED and _yara_python_available():
+        # Also resumes jobs whose previous runner stopped heartbeating.
+        _retrohunt_task = asyncio.create_task(_retrohunt_loop())
+    if RETROHUNT_INDEX_INTERVAL_SECONDS > 0 and RETROHUNT_INDEX_DIR and RETROHUNT_CORPUS_DIR:
+        # Replicas sharing an index directory serialize on its lock; the others skip the pass.
+        _retrohunt_index_task = asyncio.create_task(_retrohunt_index_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    global _db_pool, _cleanup_task, _agent_state_flush_task, _replica_task, _replica_listener, _policy_reconcile_task, _metadata_sync_task
+    global _storage_executor, _minio, _minio_http, _rule_index_task, _retrohunt_task, _retrohunt_index_task
+    if _retrohunt_index_task is not None:
+        _retrohunt_index_task.cancel()
+        try:
+            await _retrohunt_index_task
+        except asyncio.CancelledError:
+            pass
+        _retrohunt_index_task = None
+    if _retrohunt_task is not None:
+        _retrohunt_task.cancel()
+        try:
+            await _retrohunt_task
+        except asyncio.CancelledError:
+            pass
+        _retrohunt_task = None
+    if _rule_index_task is not None:
+        _rule_index_task.cancel()
+        try:
+            await _rule_index_task
+        except asyncio.CancelledError:
+            pass
+        _rule_index_task = None
+    if _metadata_sync_task is not None:
+        _metadata_sync_task.cancel()
+        try:
+            await _metadata_sync_task
+        except asyncio.CancelledError:
+            pass
+        _metadata_sync_task = None
+    if _policy_reconcile_task is not None:
+        _policy_reconcile_task.cancel()
+        try:
+            await _policy_reconcile_task
+        except asyncio.CancelledError:
+            pass
+        _policy_reconcile_task = None
+    if _replica_task is not None:
+        _replica_task.cancel()
+        try:
+            await _replica_task
+        except asyncio.CancelledError:
+            pass
+        _replica_task = None
+    if _replica_listener is not None:
+        try:
+            await _replica_listener.close()
+        except Exception:
+            pass
+        _replica_listener = None
+    if ORCHESTRATOR_ROUTING_ENABLED and _db_pool is not None:
+        try:
+            async with _db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM agent_routes WHERE replica_id = $1", ORCHESTRATOR_REPLICA_ID)
+                await conn.execute("DELETE FROM orchestrator_replicas WHERE replica_id = $1", ORCHESTRATOR_REPLICA_ID)
+        except Exception:
+            logger.exception("failed to release agent routes on shutdown")
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        try:
+            await _cleanup_task
+        except asyncio.CancelledError:
+            pass
+        _cleanup_task = None
+    if _agent_state_flush_task is not None:
+        _agent_state_flush_task.cancel()
+        try:
+            await _agent_state_flush_task
+        except asyncio.CancelledError:
+            pass
+        _agent_state_flush_task = None
+    for task in list(_background_tasks):
+        task.cancel()
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    if _db_pool is not None:
+        try:
+            flushed = await _flush_agent_control_state()
+            if flushed > 0:
+                logger.info("shutdown flushed pending state for %d agents", flushed)
+        except Exception:
+            logger.exception("shutdown agent state flush failed")
+    if _db_pool is not None:
+        await _db_pool.close()
+        _db_pool = None
+    if _storage_executor is not None:
+        _storage_executor.shutdown(wait=False, cancel_futures=True)
+        _storage_executor = None
+    await _stop_yara_compiler_pool()
+    if _minio_http is not None:
+        _minio_http.clear()
+        _minio_http = None
+        _minio = None
+
+
+@app.get("/health")
+async def health() -> JSONResponse:
+    return JSONResponse({"status": "healthy"})
+
+
+@app.get("/metrics/storage")
+async def storage_metrics(user: dict = Depends(get_current_user)) -> JSONResponse:
+    return JSONResponse(_storage_pool_stats())
+
+
+@app.get("/setup/status")
+async def setup_status() -> JSONResponse:
+    initialized = await _is_initialized()
+    setup_token_required = bool(INITIAL_SETUP_TOKEN.strip())
+    return JSONResponse({"initialized": initialized, "setup_token_required": setup_token_required})
+
+
+@app.post("/auth/setup")
+async def setup_admin(payload: dict) -> JSONResponse:
+    if await _is_initialized():
+        raise HTTPException(status_code=409, detail="already initialized")
+
+    username = (payload.get("username") or "").strip()
+    password = payload.get("password") or ""
+    setup_token = payload.get("setup_token") or ""
+    settings = payload.get("settings") or {}
+
+    if INITIAL_SETUP_TOKEN and setup_token != INITIAL_SETUP_TOKEN:
+        raise HTTPException(status_code=401, detail="invalid setup token")
+
+    if len(username) < 3:
+        raise HTTPException(status_code=400, detail="username must be at least 3 characters")
+
+    if len(password) < 8:
+        raise HTTPException(status_code=400, detail="password must be at least 8 characters")
+
+    if not isinstance(settings, dict):
+        raise HTTPException(status_code=400, detail="settings must be an object")
+
+    db = await _db()
+    password_hash = pwd_context.hash(password)
+
+    try:
+        async with db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO users (username, password_hash, role, settings_json)
+                VALUES ($1, $2, 'admin', $3::jsonb)
+                """,
+                username,
+                password_hash,
+                json.dumps(settings),
+            )
+    except asyncpg.UniqueViolationError:
+        raise HTTPException(status_code=409, detail="already initialized")
+
+    token = create_access_token(subject=username)
+    return JSONResponse(
+        {
+            "access_token": token,
+            "token_type": "bearer",
+            "username": username,
+            "settings": settings,
+        }
+    )
+
+
+@app.post("/auth/login")
+async def login(payload: dict) -> JSONResponse:
+    if not await _is_initialized():
+        raise HTTPException(status_code=412, detail="setup required")
+
+    username = (payload.get("username") or "").strip()
+    password = payload.get("password") or ""
+
+    user = await _fetch_user_by_username(username)
+    if user is None or not pwd_context.verify(password, user.get("password_hash", "")):
+        raise HTTPException(status_code=401, detail="invalid username or password")
+
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute("UPDATE users SET last_login = now() WHERE username = $1", username)
+
+    token = create_access_token(subject=username)
+    return JSONResponse(
+        {
+            "access_token": token,
+            "token_type": "bearer",
+            "username": username,
+            "settings": user.get("settings_json") or {},
+        }
+    )
+
+
+@app.get("/auth/validate")
+async def validate_auth(user: dict = Depends(get_current_user)) -> JSONResponse:
+    username = str(user.get("sub", "user"))
+    headers = {
+        "X-Auth-Request-User": username,
+        "X-Auth-Request-Email": username,
+    }
+    return JSONResponse({"ok": True, "user": username}, headers=headers)
+
+
+@app.get("/settings")
+async def get_settings(user: dict = Depends(get_current_user)) -> JSONResponse:
+    username = str(user["sub"])
+    row = await _fetch_user_by_username(username)
+    if row is None:
+        raise HTTPException(status_code=404, detail="user not found")
+    return JSONResponse({"settings": row.get("settings_json") or {}})
+
+
+@app.put("/settings")
+async def update_settings(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    settings = payload.get("settings")
+    if not isinstance(settings, dict):
+        raise HTTPException(status_code=400, detail="settings must be an object")
+
+    username = str(user["sub"])
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            "UPDATE users SET settings_json = $2::jsonb WHERE username = $1",
+            username,
+            json.dumps(settings),
+        )
+
+    return JSONResponse({"settings": settings})
+
+
+@app.get("/agents")
+async def list_agents(_: dict = Depends(get_current_user)):
+    db = await _db()
+    rows = []
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT agent_id, tenant_id, status, connected_at, last_seen, last_heartbeat,
+                   capabilities_json, is_ephemeral, instance_id, runtime_kind, lease_expires_at,
+                   asset_profile_json, findings_count
+            FROM agents_control_state
+            ORDER BY updated_at DESC
+            """
+        )
+
+    now = datetime.now(timezone.utc)
+    out = []
+    for row in rows:
+        aid = row["agent_id"]
+        connected_at = row["connected_at"]
+        last_seen = row["last_seen"]
+        last_heartbeat = row["last_heartbeat"]
+        capabilities = row.get("capabilities_json") or {}
+        tenant_id = row["tenant_id"]
+        status_value = row["status"] or "disconnected"
+        is_ephemeral = bool(row.get("is_ephemeral"))
+        instance_id = row.get("instance_id")
+        runtime_kind = row.get("runtime_kind")
+        lease_expires_at = row.get("lease_expires_at")
+        asset_profile = row.get("asset_profile_json") or {}
+        findings_count = int(row.get("findings_count") or 0)
+
+        status = status_value
+        freshness_ts = last_heartbeat or last_seen or connected_at
+        if freshness_ts is not None and (now - freshness_ts).total_seconds() > AGENT_STALE_SECONDS:
+            if status_value == "connected":
+                status = "stale"
 
         out.append(
             {
@@ -975,331 +4016,2039 @@ async def list_agents(_: dict = Depends(get_current_user)):
                 "findings_count": findings_count,
             }
         )
-    return JSONResponse(out)
+    return JSONResponse(out)
+
+
+@app.get("/agents/{agent_id}/profile")
+async def get_agent_profile(agent_id: str, _: dict = Depends(get_current_user)) -> JSONResponse:
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT agent_id, tenant_id, connected_at, last_seen, last_heartbeat,
+                   asset_profile_json, findings_count
+            FROM agents_control_state
+            WHERE agent_id = $1
+            """,
+            agent_id,
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail="agent not found")
+        package_rows = await conn.fetch(
+            """
+            SELECT attributes_json
+            FROM agent_packages
+            WHERE agent_id = $1
+            ORDER BY name, version, ecosystem
+            """,
+            agent_id,
+        )
+        cve_rows = await conn.fetch(
+            """
+            SELECT attributes_json
+            FROM agent_cves
+            WHERE agent_id = $1
+            ORDER BY cve_id, package
+            """,
+            agent_id,
+        )
+    return JSONResponse(
+        {
+            "agent_id": row["agent_id"],
+            "tenant_id": row["tenant_id"],
+            "connected_at": row["connected_at"].isoformat() if row["connected_at"] else None,
+            "last_seen": row["last_seen"].isoformat() if row["last_seen"] else None,
+            "last_heartbeat": row["last_heartbeat"].isoformat() if row["last_heartbeat"] else None,
+            "asset_profile": row.get("asset_profile_json") or {},
+            "sbom": [_json_value(r["attributes_json"], {}) for r in package_rows],
+            "cves": [_json_value(r["attributes_json"], {}) for r in cve_rows],
+            "findings_count": int(row.get("findings_count") or 0),
+        }
+    )
+
+
+def _inventory_page_limit(limit: int) -> int:
+    return max(1, min(int(limit), max(1, INVENTORY_QUERY_MAX_LIMIT)))
+
+
+@app.get("/agents/by-package")
+async def list_agents_by_package(
+    name: str,
+    version: Optional[str] = None,
+    ecosystem: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    package_name = (name or "").strip()
+    if not package_name:
+        raise HTTPException(status_code=400, detail="name is required")
+    page_limit = _inventory_page_limit(limit)
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT p.agent_id, a.status, a.last_seen, a.last_heartbeat,
+                   array_agg(p.version ORDER BY p.version) AS versions,
+                   array_agg(p.ecosystem ORDER BY p.version) AS ecosystems
+            FROM agent_packages p
+            JOIN agents_control_state a ON a.agent_id = p.agent_id
+            WHERE p.tenant_id = $1
+              AND p.name = $2
+              AND ($3::text IS NULL OR p.version = $3)
+              AND ($4::text IS NULL OR p.ecosystem = $4)
+              AND ($5::text IS NULL OR p.agent_id > $5)
+            GROUP BY p.agent_id, a.status, a.last_seen, a.last_heartbeat
+            ORDER BY p.agent_id
+            LIMIT $6
+            """,
+            tenant_id,
+            package_name,
+            (version or "").strip() or None,
+            (ecosystem or "").strip().lower() or None,
+            (cursor or "").strip() or None,
+            page_limit,
+        )
+    items = [
+        {
+            "agent_id": row["agent_id"],
+            "status": row["status"],
+            "last_seen": row["last_seen"].isoformat() if row["last_seen"] else None,
+            "last_heartbeat": row["last_heartbeat"].isoformat() if row["last_heartbeat"] else None,
+            "packages": [
+                {"name": package_name, "version": v, "ecosystem": e}
+                for v, e in zip(row["versions"] or [], row["ecosystems"] or [])
+            ],
+        }
+        for row in rows
+    ]
+    next_cursor = items[-1]["agent_id"] if len(items) == page_limit else None
+    return JSONResponse({"items": items, "next_cursor": next_cursor})
+
+
+@app.get("/agents/by-cve")
+async def list_agents_by_cve(
+    cve_id: str,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    wanted = (cve_id or "").strip().upper()
+    if not wanted:
+        raise HTTPException(status_code=400, detail="cve_id is required")
+    page_limit = _inventory_page_limit(limit)
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT c.agent_id, a.status, a.last_seen, a.last_heartbeat,
+                   array_agg(c.package ORDER BY c.package) AS packages,
+                   array_agg(c.severity ORDER BY c.package) AS severities,
+                   array_agg(c.status ORDER BY c.package) AS finding_statuses
+            FROM agent_cves c
+            JOIN agents_control_state a ON a.agent_id = c.agent_id
+            WHERE c.tenant_id = $1
+              AND c.cve_id = $2
+              AND ($3::text IS NULL OR c.agent_id > $3)
+            GROUP BY c.agent_id, a.status, a.last_seen, a.last_heartbeat
+            ORDER BY c.agent_id
+            LIMIT $4
+            """,
+            tenant_id,
+            wanted,
+            (cursor or "").strip() or None,
+            page_limit,
+        )
+    items = [
+        {
+            "agent_id": row["agent_id"],
+            "status": row["status"],
+            "last_seen": row["last_seen"].isoformat() if row["last_seen"] else None,
+            "last_heartbeat": row["last_heartbeat"].isoformat() if row["last_heartbeat"] else None,
+            "findings": [
+                {"cve_id": wanted, "package": pkg, "severity": sev, "status": st}
+                for pkg, sev, st in zip(row["packages"] or [], row["severities"] or [], row["finding_statuses"] or [])
+            ],
+        }
+        for row in rows
+    ]
+    next_cursor = items[-1]["agent_id"] if len(items) == page_limit else None
+    return JSONResponse({"items": items, "next_cursor": next_cursor})
+
+
+def _encode_rule_cursor(updated_at: datetime, name: str) -> str:
+    raw = f"{updated_at.isoformat()}|{name}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_rule_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        updated_at, name = raw.split("|", 1)
+        return datetime.fromisoformat(updated_at), name
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+def _like_prefix(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+@app.get("/yara/rules")
+async def list_yara_rules(
+    prefix: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    """List rule files newest first from yara_rule_files.
+
+    Keyset paginated on (updated_at, name); the cursor for the next page is returned in
+    the X-Next-Cursor header so the body stays a plain list.
+    """
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    page_limit = max(1, min(int(limit or YARA_RULE_LIST_DEFAULT_LIMIT), max(1, YARA_RULE_LIST_MAX_LIMIT)))
+    after_updated_at, after_name = _decode_rule_cursor(cursor.strip()) if (cursor or "").strip() else (None, None)
+    name_prefix = (prefix or "").strip()
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT tenant_id, name, object_key, etag, sha256, size_bytes, created_at, updated_at, created_by, updated_by
+            FROM yara_rule_files
+            WHERE tenant_id = $1
+              AND deleted_at IS NULL
+              AND ($2::text IS NULL OR name LIKE $2)
+              AND ($3::timestamptz IS NULL OR (updated_at, name) < ($3, $4::text))
+            ORDER BY updated_at DESC, name DESC
+            LIMIT $5
+            """,
+            tenant_id,
+            _like_prefix(name_prefix) if name_prefix else None,
+            after_updated_at,
+            after_name,
+            page_limit + 1,
+        )
+
+    has_more = len(rows) > page_limit
+    rows = rows[:page_limit]
+    items = [
+        {
+            "name": row["name"],
+            "tenant_id": row["tenant_id"],
+            "object_key": row["object_key"],
+            "etag": _safe_string(row["etag"]),
+            "sha256": _safe_string(row["sha256"]),
+            "size_bytes": int(row["size_bytes"] or 0),
+            "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+            "updated_at": row["updated_at"].isoformat() if row["updated_at"] else None,
+            "created_by": _safe_string(row["created_by"]) or None,
+            "updated_by": _safe_string(row["updated_by"]) or None,
+        }
+        for row in rows
+    ]
+    headers = {}
+    if has_more and rows:
+        headers["X-Next-Cursor"] = _encode_rule_cursor(rows[-1]["updated_at"], rows[-1]["name"])
+    return JSONResponse(items, headers=headers)
+
+
+def _rule_cache_get(tenant_id: str, name: str, sha256_hex: str) -> Optional[Dict[str, Any]]:
+    entry = _rule_content_cache.get((tenant_id, name))
+    if entry is None:
+        return None
+    if entry["sha256"] != sha256_hex:
+        _rule_cache_invalidate(tenant_id, name)
+        return None
+    _rule_content_cache.move_to_end((tenant_id, name))
+    return entry
+
+
+def _rule_cache_put(tenant_id: str, name: str, entry: Dict[str, Any]) -> None:
+    global _rule_content_cache_bytes
+    size = len(entry["content"].encode("utf-8"))
+    if size > RULE_CONTENT_CACHE_MAX_BYTES:
+        return
+    _rule_cache_invalidate(tenant_id, name)
+    _rule_content_cache[(tenant_id, name)] = {**entry, "cached_bytes": size}
+    _rule_content_cache_bytes += size
+    while _rule_content_cache_bytes > RULE_CONTENT_CACHE_MAX_BYTES and _rule_content_cache:
+        _, old = _rule_content_cache.popitem(last=False)
+        _rule_content_cache_bytes -= old["cached_bytes"]
+
+
+def _rule_cache_invalidate(tenant_id: str, name: str) -> None:
+    global _rule_content_cache_bytes
+    old = _rule_content_cache.pop((tenant_id, name), None)
+    if old is not None:
+        _rule_content_cache_bytes -= old["cached_bytes"]
+
+
+def _etag_matches(if_none_match: Optional[str], sha256_hex: str) -> bool:
+    if not if_none_match or not sha256_hex:
+        return False
+    for candidate in if_none_match.split(","):
+        tag = candidate.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"') == sha256_hex:
+            return True
+    return False
+
+
+_ARCHIVE_FORMATS = {"tar": "application/x-tar", "tgz": "application/gzip", "zip": "application/zip"}
+
+
+class _ArchiveSink:
+    """Write-only file object; the archive writer fills it and the response drains it."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+@app.get("/yara/rules/export")
+async def export_yara_rules(format: str = "tar", user: dict = Depends(get_current_user)) -> StreamingResponse:
+    """Stream the tenant's rule library as a tar, tar.gz or zip archive.
+
+    Objects are read from MinIO a few at a time ahead of the writer and written into the
+    archive as they arrive, so neither the archive nor the library is held in memory.
+    """
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    archive_format = (format or "tar").strip().lower()
+    if archive_format not in _ARCHIVE_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be tar, tgz or zip")
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT name, object_key, updated_at
+            FROM yara_rule_files
+            WHERE tenant_id = $1 AND deleted_at IS NULL
+            ORDER BY name
+            """,
+            tenant_id,
+        )
+    client = _minio_client()
+    window = max(1, YARA_ARCHIVE_CONCURRENCY)
+
+    async def _stream():
+        sink = _ArchiveSink()
+        if archive_format == "zip":
+            archive: Any = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            archive = tarfile.open(fileobj=sink, mode="w|gz" if archive_format == "tgz" else "w|")
+        pending: list[asyncio.Task] = []
+        next_index = 0
+        try:
+            for row in rows:
+                while next_index < len(rows) and len(pending) < window:
+                    pending.append(asyncio.ensure_future(_storage_call(_read_object_bytes, client, rows[next_index]["object_key"])))
+                    next_index += 1
+                try:
+                    data = await pending.pop(0)
+                except S3Error as exc:
+                    if exc.code in {"NoSuchKey", "NoSuchObject"}:
+                        continue
+                    raise
+                mtime = row["updated_at"] or datetime.now(timezone.utc)
+                if archive_format == "zip":
+                    info = zipfile.ZipInfo(row["name"], date_time=mtime.timetuple()[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    archive.writestr(info, data)
+                else:
+                    info = tarfile.TarInfo(row["name"])
+                    info.size = len(data)
+                    info.mtime = int(mtime.timestamp())
+                    info.mode = 0o644
+                    archive.addfile(info, io.BytesIO(data))
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+            archive.close()
+            yield sink.drain()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    suffix = {"tar": "tar", "tgz": "tar.gz", "zip": "zip"}[archive_format]
+    return StreamingResponse(
+        _stream(),
+        media_type=_ARCHIVE_FORMATS[archive_format],
+        headers={"Content-Disposition": f'attachment; filename="yara-rules-{tenant_id}.{suffix}"'},
+    )
+
+
+@app.get("/yara/rules/{name}")
+async def get_yara_rule(name: str, request: Request, user: dict = Depends(get_current_user)) -> Response:
+    """Return a rule file with its content.
+
+    The response ETag is the content sha256 from yara_rule_files; a matching If-None-Match
+    gets 304 without touching MinIO, and repeat reads are served from an in-memory LRU.
+    """
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    safe_name = _validate_yara_rule_name(name)
+    object_key = _rule_object_key(tenant_id, safe_name)
+    row = await _get_rule_metadata(tenant_id, safe_name)
+    known_sha256 = _safe_string(row["sha256"]) if row else ""
+
+    if known_sha256 and _etag_matches(request.headers.get("if-none-match"), known_sha256):
+        return Response(status_code=304, headers={"ETag": f'"{known_sha256}"'})
+
+    entry = _rule_cache_get(tenant_id, safe_name, known_sha256) if known_sha256 else None
+    if entry is None:
+        client = _minio_client()
+        try:
+            data = await _storage_call(_read_object_bytes, client, object_key)
+            stat = None if row else await _storage_call(client.stat_object, YARA_STORAGE_BUCKET, object_key)
+        except S3Error as exc:
+            if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchBucket"}:
+                raise HTTPException(status_code=404, detail="rule not found")
+            logger.exception("failed to fetch yara rule")
+            raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        except Exception as exc:
+            logger.exception("failed to fetch yara rule")
+            raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+
+        try:
+            content = data.decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="rule content is not valid UTF-8")
+        entry = {
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "etag": _safe_string(row["etag"]) if row else _safe_string(getattr(stat, "etag", "")),
+            "size_bytes": len(data),
+            "content": content,
+        }
+        # Only cache what matches the metadata row, so the row stays the validator.
+        if entry["sha256"] == known_sha256:
+            _rule_cache_put(tenant_id, safe_name, entry)
+
+    return JSONResponse(
+        {
+            "name": safe_name,
+            "tenant_id": tenant_id,
+            "object_key": object_key,
+            "etag": entry["etag"],
+            "sha256": entry["sha256"],
+            "size_bytes": entry["size_bytes"],
+            "created_at": row["created_at"].isoformat() if row and row.get("created_at") else None,
+            "updated_at": row["updated_at"].isoformat() if row and row.get("updated_at") else None,
+            "created_by": _safe_string(row["created_by"]) if row else None,
+            "updated_by": _safe_string(row["updated_by"]) if row else None,
+            "content": entry["content"],
+        },
+        headers={"ETag": f'"{entry["sha256"]}"', "Cache-Control": "private, no-cache"},
+    )
+
+
+@app.post("/yara/rules")
+async def create_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    actor = str(user.get("sub") or "system")
+    safe_name = _validate_yara_rule_name(str(payload.get("name") or ""))
+    content = str(payload.get("content") or "")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="rule content must not be empty")
+    encoded = content.encode("utf-8")
+    if len(encoded) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+
+    object_key = _rule_object_key(tenant_id, safe_name)
+    etag = await _write_rule_object(
+        tenant_id=tenant_id,
+        name=safe_name,
+        object_key=object_key,
+        encoded=encoded,
+        actor=actor,
+        create=True,
+    )
+    _rule_cache_invalidate(tenant_id, safe_name)
+    _on_rules_changed(tenant_id)
+
+    return JSONResponse(
+        {
+            "ok": True,
+            "name": safe_name,
+            "tenant_id": tenant_id,
+            "object_key": object_key,
+            "etag": etag,
+            "sha256": hashlib.sha256(encoded).hexdigest(),
+            "size_bytes": len(encoded),
+        },
+        status_code=201,
+    )
+
+
+@app.put("/yara/rules/{name}")
+async def update_yara_rule(name: str, payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    actor = str(user.get("sub") or "system")
+    safe_name = _validate_yara_rule_name(name)
+    content = str(payload.get("content") or "")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="rule content must not be empty")
+    encoded = content.encode("utf-8")
+    if len(encoded) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+
+    object_key = _rule_object_key(tenant_id, safe_name)
+    etag = await _write_rule_object(
+        tenant_id=tenant_id,
+        name=safe_name,
+        object_key=object_key,
+        encoded=encoded,
+        actor=actor,
+        create=False,
+    )
+    _rule_cache_invalidate(tenant_id, safe_name)
+    _on_rules_changed(tenant_id)
+    return JSONResponse(
+        {
+            "ok": True,
+            "name": safe_name,
+            "tenant_id": tenant_id,
+            "object_key": object_key,
+            "etag": etag,
+            "sha256": hashlib.sha256(encoded).hexdigest(),
+            "size_bytes": len(encoded),
+        }
+    )
+
+
+def _iter_archive_rules(spool: Any) -> Any:
+    """Yield (name, bytes | None, error) for each regular file in a tar or zip archive."""
+    spool.seek(0)
+    if zipfile.is_zipfile(spool):
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                name = os.path.basename(info.filename)
+                if info.file_size > 1024 * 1024:
+                    yield name, None, "rule content exceeds 1MB limit"
+                    continue
+                yield name, archive.read(info), None
+        return
+    spool.seek(0)
+    try:
+        archive = tarfile.open(fileobj=spool, mode="r:*")
+    except tarfile.TarError:
+        raise ValueError("body is not a tar or zip archive")
+    with archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            if member.size > 1024 * 1024:
+                yield name, None, "rule content exceeds 1MB limit"
+                continue
+            handle = archive.extractfile(member)
+            yield name, handle.read() if handle else b"", None
+
+
+async def _record_imported_rules(tenant_id: str, actor: str, written: list[dict]) -> None:
+    db = await _db()
+    async with db.acquire() as conn, conn.transaction():
+        await conn.execute(
+            """
+            INSERT INTO yara_rule_files (
+                id, tenant_id, name, object_key, etag, sha256, size_bytes, created_by, updated_by, updated_at
+            )
+            SELECT t.id, $1, t.name, t.object_key, t.etag, t.sha256, t.size_bytes, $2, $2, now()
+            FROM unnest($3::uuid[], $4::text[], $5::text[], $6::text[], $7::text[], $8::bigint[])
+                AS t(id, name, object_key, etag, sha256, size_bytes)
+            ON CONFLICT (tenant_id, name) DO UPDATE SET
+                object_key = EXCLUDED.object_key,
+                etag = EXCLUDED.etag,
+                sha256 = EXCLUDED.sha256,
+                size_bytes = EXCLUDED.size_bytes,
+                updated_by = EXCLUDED.updated_by,
+                updated_at = now(),
+                deleted_at = NULL
+            """,
+            tenant_id,
+            actor,
+            [uuid.uuid4() for _ in written],
+            [w["name"] for w in written],
+            [w["object_key"] for w in written],
+            [w["etag"] for w in written],
+            [w["sha256"] for w in written],
+            [w["size_bytes"] for w in written],
+        )
+        await _record_rule_versions(conn, tenant_id, [{**w, "actor": actor, "action": "import"} for w in written])
+
+
+@app.post("/yara/rules/import")
+async def import_yara_rules(request: Request, overwrite: bool = True, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Import a tar, tar.gz or zip archive of .yar files into the tenant library.
+
+    The body is spooled to a temporary file (not memory) while it streams in. Files whose
+    sha256 already matches yara_rule_files are skipped; the rest are uploaded with a bounded
+    concurrency window and recorded in one batched metadata statement.
+    """
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    actor = str(user.get("sub") or "system")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    try:
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > YARA_ARCHIVE_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="archive exceeds size limit")
+            spool.write(chunk)
+        if received == 0:
+            raise HTTPException(status_code=400, detail="empty archive")
+
+        existing = {name: _safe_string(row["sha256"]) for name, row in (await _list_rule_metadata(tenant_id)).items()}
+        client = _minio_client()
+        loop = asyncio.get_running_loop()
+        window = max(1, YARA_ARCHIVE_CONCURRENCY)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=window * 2)
+        written: list[dict] = []
+        unchanged: list[str] = []
+        rejected: list[dict] = []
+        seen: set[str] = set()
+        abandoned = threading.Event()
+
+        def _produce() -> None:
+            # Runs on a worker thread; put() blocks when uploads fall behind, bounding memory.
+            try:
+                count = 0
+                for item in _iter_archive_rules(spool):
+                    if abandoned.is_set():
+                        return
+                    count += 1
+                    if count > YARA_ARCHIVE_MAX_FILES:
+                        raise ValueError("archive has too many files")
+                    asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            except Exception as exc:
+                # Not just ValueError/BadZipFile/TarError: a truncated gzip stream raises EOFError,
+                # a corrupt deflate entry zlib.error. The consumer must see it, not a clean end.
+                asyncio.run_coroutine_threadsafe(queue.put(exc), loop).result()
+            finally:
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+        async def _upload(name: str, data: bytes, sha256_hex: str) -> None:
+            object_key = _rule_object_key(tenant_id, name)
+            try:
+                result = await _storage_call(_put_rule_object, client, object_key, data, if_none_match=not overwrite)
+            except S3Error as exc:
+                reason = "rule already exists" if exc.code == "PreconditionFailed" else f"yara storage write failed: {exc}"
+                rejected.append({"name": name, "error": reason})
+                return
+            except Exception as exc:
+                rejected.append({"name": name, "error": f"yara storage write failed: {exc}"})
+                return
+            written.append(
+                {
+                    "name": name,
+                    "object_key": object_key,
+                    "etag": _normalize_etag(getattr(result, "etag", "")),
+                    "version_id": getattr(result, "version_id", None),
+                    "sha256": sha256_hex,
+                    "size_bytes": len(data),
+                }
+            )
+
+        producer = loop.run_in_executor(None, _produce)
+        slots = asyncio.Semaphore(window)
+        uploads: set[asyncio.Task] = set()
+        archive_error: Optional[Exception] = None
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    archive_error = item
+                    continue
+                name, data, error = item
+                if not name.endswith(".yar"):
+                    continue
+                if error is None and not re.fullmatch(r"[A-Za-z0-9._-]+\.yar", name):
+                    error = "invalid rule name; expected <name>.yar"
+                if error is None and name in seen:
+                    error = "duplicate file name in archive"
+                if error is None:
+                    try:
+                        if not data.decode("utf-8").strip():
+                            error = "rule content must not be empty"
+                    except UnicodeDecodeError:
+                        error = "rule content is not valid UTF-8"
+                if error is not None:
+                    rejected.append({"name": name, "error": error})
+                    continue
+                seen.add(name)
+                sha256_hex = hashlib.sha256(data).hexdigest()
+                if existing.get(name) == sha256_hex:
+                    unchanged.append(name)
+                    continue
+                if name in existing and not overwrite:
+                    rejected.append({"name": name, "error": "rule already exists"})
+                    continue
+                await slots.acquire()
+                task = asyncio.ensure_future(_upload(name, data, sha256_hex))
+                task.add_done_callback(lambda _: slots.release())
+                uploads.add(task)
+                task.add_done_callback(uploads.discard)
+        finally:
+            if not producer.done():
+                # Unblock the producer thread before the spool is closed underneath it.
+                abandoned.set()
+                while not producer.done():
+                    while not queue.empty():
+                        queue.get_nowait()
+                    await asyncio.sleep(0.01)
+        if uploads:
+            await asyncio.gather(*uploads)
+        # Surfaces anything the producer could not hand over instead of reporting success.
+        await producer
+    finally:
+        spool.close()
+
+    if archive_error is not None and not (written or unchanged or rejected):
+        raise HTTPException(status_code=400, detail=str(archive_error))
+    if written:
+        try:
+            await _record_imported_rules(tenant_id, actor, written)
+        except asyncpg.PostgresError:
+            # Objects are in the bucket; the metadata sync will record them on its next pass.
+            logger.exception("failed to record imported rule metadata")
+            raise HTTPException(status_code=500, detail="rules uploaded but metadata write failed")
+        for item in written:
+            _rule_cache_invalidate(tenant_id, item["name"])
+        _on_rules_changed(tenant_id)
+
+    return JSONResponse(
+        {
+            "ok": not rejected and archive_error is None,
+            "tenant_id": tenant_id,
+            "imported": sorted(item["name"] for item in written),
+            "unchanged": sorted(unchanged),
+            "rejected": rejected,
+            "error": str(archive_error) if archive_error else None,
+        }
+    )
+
+
+@app.delete("/yara/rules/{name}")
+async def delete_yara_rule(name: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    safe_name = _validate_yara_rule_name(name)
+    object_key = _rule_object_key(tenant_id, safe_name)
+    client = _minio_client()
+    try:
+        await _storage_call(client.remove_object, YARA_STORAGE_BUCKET, object_key)
+    except Exception as exc:
+        logger.exception("failed to delete yara rule")
+        raise HTTPException(status_code=502, detail=f"yara storage delete failed: {exc}")
 
+    await _delete_rule_metadata(tenant_id, safe_name, str(user.get("sub") or "system"))
+    _rule_cache_invalidate(tenant_id, safe_name)
+    _on_rules_changed(tenant_id)
+    return JSONResponse({"ok": True, "name": safe_name, "tenant_id": tenant_id})
 
-@app.get("/agents/{agent_id}/profile")
-async def get_agent_profile(agent_id: str, _: dict = Depends(get_current_user)) -> JSONResponse:
+
+def _rule_version_to_dict(row: asyncpg.Record) -> dict:
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "version_id": row["version_id"],
+        "sha256": row["sha256"],
+        "size_bytes": int(row["size_bytes"] or 0),
+        "etag": row["etag"],
+        "actor": row["actor"],
+        "action": row["action"],
+        "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+    }
+
+
+async def _get_rule_version(tenant_id: str, name: str, version_id: str) -> asyncpg.Record:
     db = await _db()
     async with db.acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT agent_id, tenant_id, connected_at, last_seen, last_heartbeat,
-                   asset_profile_json, sbom_json, cve_json, findings_count
-            FROM agents_control_state
-            WHERE agent_id = $1
+            SELECT id, name, version_id, sha256, size_bytes, etag, actor, action, created_at
+            FROM yara_rule_versions
+            WHERE tenant_id = $1 AND name = $2 AND version_id = $3
+            ORDER BY id DESC
+            LIMIT 1
             """,
-            agent_id,
+            tenant_id,
+            name,
+            version_id,
         )
     if row is None:
-        raise HTTPException(status_code=404, detail="agent not found")
+        raise HTTPException(status_code=404, detail="rule version not found")
+    return row
+
+
+async def _rule_version_content(tenant_id: str, name: str, version_id: str, sha256_hex: str) -> str:
+    # Object versions are immutable, so they share the rule content LRU under a versioned key.
+    cache_name = f"{name}@{version_id}"
+    entry = _rule_cache_get(tenant_id, cache_name, sha256_hex) if sha256_hex else None
+    if entry is not None:
+        return entry["content"]
+    try:
+        data, _ = await _storage_call(_read_object_version, _minio_client(), _rule_object_key(tenant_id, name), version_id)
+    except S3Error as exc:
+        if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchVersion"}:
+            raise HTTPException(status_code=404, detail="rule version not found")
+        raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+    try:
+        content = data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="rule content is not valid UTF-8")
+    actual = hashlib.sha256(data).hexdigest()
+    _rule_cache_put(tenant_id, cache_name, {"sha256": actual, "etag": "", "size_bytes": len(data), "content": content})
+    return content
+
+
+@app.get("/yara/rules/{name}/versions")
+async def list_yara_rule_versions(
+    name: str,
+    cursor: Optional[int] = None,
+    limit: int = 50,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    safe_name = _validate_yara_rule_name(name)
+    page_limit = max(1, min(int(limit), max(1, RULE_VERSION_LIST_MAX_LIMIT)))
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT id, name, version_id, sha256, size_bytes, etag, actor, action, created_at
+            FROM yara_rule_versions
+            WHERE tenant_id = $1 AND name = $2 AND ($3::bigint IS NULL OR id < $3)
+            ORDER BY id DESC
+            LIMIT $4
+            """,
+            tenant_id,
+            safe_name,
+            cursor,
+            page_limit,
+        )
+    items = [_rule_version_to_dict(row) for row in rows]
+    next_cursor = items[-1]["id"] if len(items) == page_limit else None
+    return JSONResponse({"items": items, "next_cursor": next_cursor})
+
+
+@app.get("/yara/rules/{name}/versions/{version_id}")
+async def get_yara_rule_version(name: str, version_id: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    safe_name = _validate_yara_rule_name(name)
+    row = await _get_rule_version(tenant_id, safe_name, version_id)
+    content = await _rule_version_content(tenant_id, safe_name, version_id, _safe_string(row["sha256"]))
+    return JSONResponse({**_rule_version_to_dict(row), "tenant_id": tenant_id, "content": content})
+
+
+@app.get("/yara/rules/{name}/diff")
+async def diff_yara_rule_versions(
+    name: str,
+    from_version: str,
+    to_version: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    """Unified diff between two versions; to_version defaults to the current content."""
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, None)
+    safe_name = _validate_yara_rule_name(name)
+    old_row = await _get_rule_version(tenant_id, safe_name, from_version)
+    if to_version:
+        new_row = await _get_rule_version(tenant_id, safe_name, to_version)
+    else:
+        current = await _get_rule_metadata(tenant_id, safe_name)
+        if current is None:
+            raise HTTPException(status_code=404, detail="rule not found")
+        db = await _db()
+        async with db.acquire() as conn:
+            new_row = await conn.fetchrow(
+                """
+                SELECT id, name, version_id, sha256, size_bytes, etag, actor, action, created_at
+                FROM yara_rule_versions
+                WHERE tenant_id = $1 AND name = $2 AND sha256 = $3 AND version_id IS NOT NULL
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                tenant_id,
+                safe_name,
+                current["sha256"],
+            )
+        if new_row is None:
+            raise HTTPException(status_code=404, detail="current rule content has no recorded version")
+
+    cache_key = (_safe_string(old_row["sha256"]), _safe_string(new_row["sha256"]))
+    hunks = _rule_diff_cache.get(cache_key) if all(cache_key) else None
+    if hunks is None:
+        old_content, new_content = await asyncio.gather(
+            _rule_version_content(tenant_id, safe_name, old_row["version_id"], cache_key[0]),
+            _rule_version_content(tenant_id, safe_name, new_row["version_id"], cache_key[1]),
+        )
+        # The first two lines are the ---/+++ file headers, present only when the contents differ.
+        hunks = "".join(
+            list(difflib.unified_diff(old_content.splitlines(keepends=True), new_content.splitlines(keepends=True)))[2:]
+        )
+        if all(cache_key):
+            _rule_diff_cache[cache_key] = hunks
+            while len(_rule_diff_cache) > max(0, RULE_DIFF_CACHE_MAX_ENTRIES):
+                _rule_diff_cache.popitem(last=False)
+    else:
+        _rule_diff_cache.move_to_end(cache_key)
+    diff_text = (
+        f"--- {safe_name}@{old_row['version_id']}\n+++ {safe_name}@{new_row['version_id']}\n{hunks}" if hunks else ""
+    )
     return JSONResponse(
         {
-            "agent_id": row["agent_id"],
-            "tenant_id": row["tenant_id"],
-            "connected_at": row["connected_at"].isoformat() if row["connected_at"] else None,
-            "last_seen": row["last_seen"].isoformat() if row["last_seen"] else None,
-            "last_heartbeat": row["last_heartbeat"].isoformat() if row["last_heartbeat"] else None,
-            "asset_profile": row.get("asset_profile_json") or {},
-            "sbom": row.get("sbom_json") or [],
-            "cves": row.get("cve_json") or [],
-            "findings_count": int(row.get("findings_count") or 0),
+            "name": safe_name,
+            "tenant_id": tenant_id,
+            "from": _rule_version_to_dict(old_row),
+            "to": _rule_version_to_dict(new_row),
+            "diff": diff_text,
+        }
+    )
+
+
+@app.post("/yara/rules/{name}/rollback")
+async def rollback_yara_rule(name: str, payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Make an earlier version current again with a server-side copy; nothing is re-uploaded."""
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    actor = str(user.get("sub") or "system")
+    safe_name = _validate_yara_rule_name(name)
+    version_id = str(payload.get("version_id") or "").strip()
+    if not version_id:
+        raise HTTPException(status_code=400, detail="missing version_id")
+    target = await _get_rule_version(tenant_id, safe_name, version_id)
+    if target["action"] == "delete":
+        raise HTTPException(status_code=400, detail="cannot roll back to a delete marker")
+    object_key = _rule_object_key(tenant_id, safe_name)
+    client = _minio_client()
+    db = await _db()
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            # Serializes against concurrent writes of the same rule.
+            await conn.execute(
+                "SELECT 1 FROM yara_rule_files WHERE tenant_id = $1 AND name = $2 FOR UPDATE",
+                tenant_id,
+                safe_name,
+            )
+            try:
+                result = await _storage_call(
+                    client.copy_object,
+                    YARA_STORAGE_BUCKET,
+                    object_key,
+                    CopySource(YARA_STORAGE_BUCKET, object_key, version_id=version_id),
+                )
+            except S3Error as exc:
+                if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchVersion"}:
+                    raise HTTPException(status_code=404, detail="rule version not found")
+                logger.exception("failed to roll back yara rule")
+                raise HTTPException(status_code=502, detail=f"yara storage copy failed: {exc}")
+            etag = _normalize_etag(getattr(result, "etag", ""))
+            await conn.execute(
+                """
+                INSERT INTO yara_rule_files (
+                    id, tenant_id, name, object_key, etag, sha256, size_bytes, created_by, updated_by, updated_at
+                )
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $8, now())
+                ON CONFLICT (tenant_id, name) DO UPDATE SET
+                    etag = EXCLUDED.etag,
+                    sha256 = EXCLUDED.sha256,
+                    size_bytes = EXCLUDED.size_bytes,
+                    updated_by = EXCLUDED.updated_by,
+                    updated_at = now(),
+                    deleted_at = NULL
+                """,
+                str(uuid.uuid4()),
+                tenant_id,
+                safe_name,
+                object_key,
+                etag,
+                target["sha256"],
+                int(target["size_bytes"] or 0),
+                actor,
+            )
+            await _record_rule_versions(
+                conn,
+                tenant_id,
+                [
+                    {
+                        "name": safe_name,
+                        "version_id": getattr(result, "version_id", None),
+                        "sha256": target["sha256"],
+                        "size_bytes": target["size_bytes"],
+                        "etag": etag,
+                        "actor": actor,
+                        "action": "rollback",
+                    }
+                ],
+            )
+    _rule_cache_invalidate(tenant_id, safe_name)
+    _on_rules_changed(tenant_id)
+    return JSONResponse(
+        {
+            "ok": True,
+            "name": safe_name,
+            "tenant_id": tenant_id,
+            "restored_version_id": version_id,
+            "version_id": getattr(result, "version_id", None),
+            "etag": etag,
+            "sha256": target["sha256"],
+            "size_bytes": int(target["size_bytes"] or 0),
+        }
+    )
+
+
+@app.get("/yara/search")
+async def search_yara_rules(
+    q: Optional[str] = None,
+    tag: Optional[str] = None,
+    module: Optional[str] = None,
+    meta_key: Optional[str] = None,
+    meta_value: Optional[str] = None,
+    string: Optional[str] = None,
+    rule: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    user: dict = Depends(get_current_user),
+) -> JSONResponse:
+    """Search parsed rules in yara_rule_index.
+
+    q matches words (full text) or any substring (trigram) across names, tags, meta,
+    string identifiers and literals; the other filters narrow by structure. Results are
+    ordered by (file, rule) with a keyset cursor.
+    """
+    tenant_id = _tenant_for_request(user, None)
+    page_limit = max(1, min(int(limit), max(1, RULE_SEARCH_MAX_LIMIT)))
+    after_file, after_rule = None, None
+    if (cursor or "").strip():
+        after_file, _, after_rule = cursor.strip().partition("/")
+    query = (q or "").strip()
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT file_name, rule_name, is_private, is_global, tags, imports, meta, string_ids, literals
+            FROM yara_rule_index
+            WHERE tenant_id = $1
+              AND ($2::text IS NULL OR search_tsv @@ websearch_to_tsquery('simple', $2) OR search_text ILIKE $3)
+              AND ($4::text IS NULL OR tags @> ARRAY[$4::text])
+              AND ($5::text IS NULL OR imports @> ARRAY[$5::text])
+              AND ($6::text IS NULL OR ($7::text IS NULL AND meta ? $6) OR meta @> jsonb_build_object($6, $7))
+              AND ($8::text IS NULL OR literals_text ILIKE $8)
+              AND ($9::text IS NULL OR rule_name ILIKE $9)
+              AND ($10::text IS NULL OR (file_name, rule_name) > ($10, $11::text))
+            ORDER BY file_name, rule_name
+            LIMIT $12
+            """,
+            tenant_id,
+            query or None,
+            f"%{_like_prefix(query)}" if query else None,
+            (tag or "").strip() or None,
+            (module or "").strip() or None,
+            (meta_key or "").strip() or None,
+            meta_value if meta_value is not None and (meta_key or "").strip() else None,
+            f"%{_like_prefix(string)}" if string else None,
+            f"%{_like_prefix(rule.strip())}" if (rule or "").strip() else None,
+            after_file,
+            after_rule,
+            page_limit,
+        )
+    items = [
+        {
+            "name": row["file_name"],
+            "rule": row["rule_name"],
+            "is_private": row["is_private"],
+            "is_global": row["is_global"],
+            "tags": list(row["tags"] or []),
+            "imports": list(row["imports"] or []),
+            "meta": _json_value(row["meta"], {}),
+            "string_ids": list(row["string_ids"] or []),
+            "literals": list(row["literals"] or []),
+        }
+        for row in rows
+    ]
+    next_cursor = f"{items[-1]['name']}/{items[-1]['rule']}" if len(items) == page_limit else None
+    return JSONResponse({"items": items, "next_cursor": next_cursor})
+
+
+@app.post("/yara/validate")
+async def validate_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    _ = _tenant_for_request(user, payload.get("tenant_id"))
+    # Still rejected when malformed, but the result does not depend on it: it is cached by content.
+    _validate_yara_rule_name(str(payload.get("name") or "rule.yar"))
+    content = str(payload.get("content") or "")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="rule content must not be empty")
+    encoded = content.encode("utf-8")
+    if len(encoded) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+    externals = _normalize_externals(payload.get("externals"))
+
+    try:
+        result, cache_state = await _validate_cached(content, externals)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    except (subprocess.TimeoutExpired, asyncio.TimeoutError):
+        raise HTTPException(status_code=504, detail="validation timed out")
+    except Exception as exc:
+        logger.exception("yara validation failed")
+        raise HTTPException(status_code=502, detail=f"validation failed: {exc}")
+
+    performance = await asyncio.to_thread(_rule_performance, content)
+    return JSONResponse({**result, "performance": performance}, headers={"X-Validation-Cache": cache_state})
+
+
+@app.post("/yara/analyze")
+async def analyze_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Static performance analysis of a rule file, with the tenant's push threshold and the
+    latest corpus profile stored for this exact content."""
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    content = str(payload.get("content") or "")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="rule content must not be empty")
+    if len(content.encode("utf-8")) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+    analysis = await asyncio.to_thread(_rule_performance, content)
+    threshold = await _tenant_max_rule_cost(tenant_id)
+    blocked = threshold is not None and analysis["max_rule_score"] > threshold
+    profile = await _latest_rule_profile(tenant_id, hashlib.sha256(content.encode("utf-8")).hexdigest())
+    return JSONResponse({**analysis, "max_rule_cost": threshold, "push_blocked": blocked, "profile": profile})
+
+
+def _profile_row(row: asyncpg.Record) -> dict:
+    return {
+        "sha256": row["sha256"],
+        "name": row["name"],
+        "corpus_id": row["corpus_id"],
+        "engine": row["engine"],
+        "profiled_at": row["created_at"].isoformat() if row["created_at"] else None,
+        **(_json_value(row["result_json"], {}) or {}),
+    }
+
+
+async def _latest_rule_profile(tenant_id: str, sha256_hex: str) -> Optional[dict]:
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT sha256, name, corpus_id, engine, result_json, created_at
+            FROM yara_rule_profiles
+            WHERE tenant_id = $1 AND sha256 = $2
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            tenant_id,
+            sha256_hex,
+        )
+    return _profile_row(row) if row is not None else None
+
+
+@app.post("/yara/profile")
+async def profile_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Scan a rule, stored rule file or the tenant bundle over the local sample corpus.
+
+    JSON body: { "content": "..." } | { "name": "a.yar" } | { "bundle": true }, optional "refresh".
+    Results are stored per (rule sha256, corpus fingerprint, engine) and reused unless
+    "refresh" is set or the corpus changed.
+    """
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    if not RULE_PROFILE_CORPUS_DIR or not os.path.isdir(RULE_PROFILE_CORPUS_DIR):
+        raise HTTPException(status_code=503, detail="rule profiling corpus is not configured")
+    if not _yara_python_available():
+        raise HTTPException(status_code=503, detail="yara-python is not available in orchestrator container")
+    name: Optional[str] = None
+    content = payload.get("content")
+    if content:
+        content = str(content)
+    elif payload.get("name"):
+        _ensure_yara_storage_enabled()
+        name = _validate_yara_rule_name(str(payload.get("name")))
+        try:
+            data = await _storage_call(_read_object_bytes, _minio_client(), _rule_object_key(tenant_id, name))
+        except S3Error as exc:
+            if exc.code in {"NoSuchKey", "NoSuchObject"}:
+                raise HTTPException(status_code=404, detail="rule not found")
+            raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        content = data.decode("utf-8", errors="replace")
+    elif _is_truthy(payload.get("bundle")):
+        bundle = await _get_tenant_bundle(tenant_id)
+        content, name = bundle["content"], bundle["version"]
+    else:
+        raise HTTPException(status_code=400, detail="missing content, name or bundle")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail="rule content must not be empty")
+
+    validation, _ = await _validate_cached(content)
+    if not validation.get("valid"):
+        raise HTTPException(status_code=400, detail={"message": "rule does not compile", "errors": validation.get("errors")})
+
+    sha256_hex = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    engine = f"yara-python {_yara_python_version()}"
+    files = await asyncio.to_thread(
+        yara_profiler.corpus_files, RULE_PROFILE_CORPUS_DIR, RULE_PROFILE_MAX_FILES, RULE_PROFILE_MAX_FILE_BYTES
+    )
+    corpus_id = await asyncio.to_thread(yara_profiler.corpus_fingerprint, files)
+    db = await _db()
+    if not _is_truthy(payload.get("refresh")):
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT sha256, name, corpus_id, engine, result_json, created_at
+                FROM yara_rule_profiles
+                WHERE tenant_id = $1 AND sha256 = $2 AND corpus_id = $3 AND engine = $4
+                """,
+                tenant_id,
+                sha256_hex,
+                corpus_id,
+                engine,
+            )
+        if row is not None:
+            return JSONResponse({**_profile_row(row), "cached": True})
+
+    async with _rule_profile_lock:
+        try:
+            report = await asyncio.to_thread(
+                functools.partial(
+                    yara_profiler.profile_ruleset,
+                    content,
+                    files,
+                    workers=RULE_PROFILE_WORKERS,
+                    timeout_seconds=RULE_PROFILE_FILE_TIMEOUT_SECONDS,
+                    # The address-space limit has to leave room for the mapped sample.
+                    memory_limit_bytes=YARA_COMPILER_MEMORY_LIMIT_MB * 1024 * 1024 + RULE_PROFILE_MAX_FILE_BYTES,
+                    # Validated above; a compile here would run in this process without limits.
+                    precompile=False,
+                )
+            )
+        except Exception as exc:
+            logger.exception("rule profiling failed")
+            raise HTTPException(status_code=502, detail=f"profiling failed: {exc}")
+    # Local paths are useful to whoever runs the corpus, but only relative to it.
+    for item in report["slowest_files"]:
+        item["path"] = os.path.relpath(item["path"], RULE_PROFILE_CORPUS_DIR)
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            INSERT INTO yara_rule_profiles (tenant_id, sha256, corpus_id, engine, name, result_json, created_by)
+            VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7)
+            ON CONFLICT (tenant_id, sha256, corpus_id, engine) DO UPDATE
+            SET name = EXCLUDED.name, result_json = EXCLUDED.result_json,
+                created_by = EXCLUDED.created_by, created_at = now()
+            RETURNING sha256, name, corpus_id, engine, result_json, created_at
+            """,
+            tenant_id,
+            sha256_hex,
+            corpus_id,
+            engine,
+            name,
+            json.dumps(report),
+            str(user.get("sub") or ""),
+        )
+    return JSONResponse({**_profile_row(row), "cached": False})
+
+
+@app.get("/yara/profile/{sha256_hex}")
+async def get_yara_rule_profile(sha256_hex: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256_hex):
+        raise HTTPException(status_code=400, detail="sha256 must be 64 lowercase hex characters")
+    profile = await _latest_rule_profile(tenant_id, sha256_hex)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="no profile for this rule")
+    return JSONResponse(profile)
+
+
+async def _load_retrohunt_job(job_id: str, tenant_id: str) -> dict:
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT {_RETROHUNT_JOB_COLUMNS} FROM retrohunt_jobs WHERE id = $1 AND tenant_id = $2", job_id, tenant_id
+        )
+    if row is None:
+        raise HTTPException(status_code=404, detail="retro-hunt job not found")
+    return _retrohunt_job_to_dict(row)
+
+
+async def _fetch_retrohunt_matches(job_id: str, after: int, limit: int) -> list[dict]:
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT id, sample_key, rule_name, string_matches, size_bytes, created_at
+            FROM retrohunt_matches
+            WHERE job_id = $1 AND id > $2
+            ORDER BY id
+            LIMIT $3
+            """,
+            job_id,
+            after,
+            limit,
+        )
+    return [
+        {
+            "id": row["id"],
+            "sample": row["sample_key"],
+            "rule": row["rule_name"],
+            "string_matches": row["string_matches"],
+            "size_bytes": row["size_bytes"],
+            "matched_at": row["created_at"].isoformat() if row["created_at"] else None,
         }
+        for row in rows
+    ]
+
+
+@app.post("/retrohunt/jobs")
+async def create_retrohunt_job(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Queue a retro-hunt of a rule over historical samples.
+
+    JSON body: { "content": "..." | "name": "a.yar", "source": "minio" | "local", "prefix": "" }
+
+    "minio" scans tenants/<tenant>/samples/<prefix> in RETROHUNT_SAMPLE_BUCKET, "local" scans
+    RETROHUNT_CORPUS_DIR/<prefix>. Follow progress with GET /retrohunt/jobs/{id} and matches
+    with GET /retrohunt/jobs/{id}/matches or /events.
+    """
+    if not RETROHUNT_ENABLED or not _yara_python_available():
+        raise HTTPException(status_code=503, detail="retro-hunt is not available")
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    source = str(payload.get("source") or "minio").strip().lower()
+    if source == "local":
+        if not RETROHUNT_CORPUS_DIR or not os.path.isdir(RETROHUNT_CORPUS_DIR):
+            raise HTTPException(status_code=503, detail="local retro-hunt corpus is not configured")
+    elif source == "minio":
+        _ensure_yara_storage_enabled()
+    else:
+        raise HTTPException(status_code=400, detail="source must be minio or local")
+    prefix = str(payload.get("prefix") or "").strip().lstrip("/")
+    if ".." in prefix.split("/"):
+        raise HTTPException(status_code=400, detail="invalid prefix")
+
+    content = payload.get("content")
+    if content:
+        content = str(content)
+    elif payload.get("name"):
+        _ensure_yara_storage_enabled()
+        name = _validate_yara_rule_name(str(payload.get("name")))
+        try:
+            data = await _storage_call(_read_object_bytes, _minio_client(), _rule_object_key(tenant_id, name))
+        except S3Error as exc:
+            if exc.code in {"NoSuchKey", "NoSuchObject"}:
+                raise HTTPException(status_code=404, detail="rule not found")
+            raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        content = data.decode("utf-8", errors="replace")
+    else:
+        raise HTTPException(status_code=400, detail="missing content or name")
+    if not content.strip() or len(content.encode("utf-8")) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content must be non-empty and at most 1MB")
+    validation, _ = await _validate_cached(content)
+    if not validation.get("valid"):
+        raise HTTPException(status_code=400, detail={"message": "rule does not compile", "errors": validation.get("errors")})
+
+    job_id = str(uuid.uuid4())
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            f"""
+            INSERT INTO retrohunt_jobs (id, tenant_id, rule_sha256, rule_source, rule_count, source, prefix, created_by)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            RETURNING {_RETROHUNT_JOB_COLUMNS}
+            """,
+            job_id,
+            tenant_id,
+            hashlib.sha256(content.encode("utf-8")).hexdigest(),
+            content,
+            # Known when the compiler pool validated the rule; the n-gram prefilter needs it.
+            validation.get("rule_count"),
+            source,
+            prefix,
+            str(user.get("sub") or ""),
+        )
+    _retrohunt_wakeup.set()
+    return JSONResponse(_retrohunt_job_to_dict(row), status_code=202)
+
+
+@app.get("/retrohunt/jobs")
+async def list_retrohunt_jobs(limit: int = 50, user: dict = Depends(get_current_user)) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            f"""
+            SELECT {_RETROHUNT_JOB_COLUMNS} FROM retrohunt_jobs
+            WHERE tenant_id = $1
+            ORDER BY created_at DESC
+            LIMIT $2
+            """,
+            tenant_id,
+            max(1, min(limit, 500)),
+        )
+    return JSONResponse([_retrohunt_job_to_dict(row) for row in rows])
+
+
+@app.get("/retrohunt/jobs/{job_id}")
+async def get_retrohunt_job(job_id: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+    return JSONResponse(await _load_retrohunt_job(job_id, _tenant_for_request(user, None)))
+
+
+@app.post("/retrohunt/jobs/{job_id}/cancel")
+async def cancel_retrohunt_job(job_id: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    await _load_retrohunt_job(job_id, tenant_id)
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE retrohunt_jobs SET status = 'cancelled', completed_at = now()
+            WHERE id = $1 AND tenant_id = $2 AND status IN ('queued', 'running')
+            """,
+            job_id,
+            tenant_id,
+        )
+    # A runner on another replica notices at its next heartbeat or shard checkpoint.
+    task = _retrohunt_running.get(job_id)
+    if task is not None:
+        task.cancel()
+    return JSONResponse(await _load_retrohunt_job(job_id, tenant_id))
+
+
+@app.get("/retrohunt/jobs/{job_id}/matches")
+async def list_retrohunt_matches(
+    job_id: str, after: int = 0, limit: int = 500, user: dict = Depends(get_current_user)
+) -> JSONResponse:
+    await _load_retrohunt_job(job_id, _tenant_for_request(user, None))
+    items = await _fetch_retrohunt_matches(job_id, after, max(1, min(limit, 5000)))
+    return JSONResponse({"items": items, "next_after": items[-1]["id"] if items else after})
+
+
+@app.get("/retrohunt/jobs/{job_id}/events")
+async def stream_retrohunt_events(job_id: str, after: int = 0, user: dict = Depends(get_current_user)) -> StreamingResponse:
+    """Server-sent events: `match` for every new match and `status` whenever progress moves."""
+    tenant_id = _tenant_for_request(user, None)
+    job = await _load_retrohunt_job(job_id, tenant_id)
+
+    async def _events():
+        nonlocal job, after
+        yield f"event: status\ndata: {json.dumps(job)}\n\n"
+        idle = 0.0
+        while True:
+            matches = await _fetch_retrohunt_matches(job_id, after, 1000)
+            for match in matches:
+                yield f"event: match\ndata: {json.dumps(match)}\n\n"
+            if matches:
+                after = matches[-1]["id"]
+                continue
+            latest = await _load_retrohunt_job(job_id, tenant_id)
+            if latest != job:
+                job = latest
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            if job["status"] in _RETROHUNT_TERMINAL:
+                break
+            await asyncio.sleep(1.0)
+            idle += 1.0
+            if idle >= max(1.0, JOB_EVENTS_KEEPALIVE_SECONDS):
+                idle = 0.0
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/rulesets/performance-policy")
+async def get_rule_performance_policy(user: dict = Depends(get_current_user)) -> JSONResponse:
+    tenant_id = _tenant_for_request(user, None)
+    return JSONResponse({"tenant_id": tenant_id, "max_rule_cost": await _tenant_max_rule_cost(tenant_id)})
+
+
+@app.put("/rulesets/performance-policy")
+async def update_rule_performance_policy(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    """Set the per-rule cost above which pushes are rejected; null disables the check."""
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    raw = payload.get("max_rule_cost")
+    if raw is not None:
+        try:
+            raw = float(raw)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="max_rule_cost must be a number or null")
+        if raw <= 0:
+            raise HTTPException(status_code=400, detail="max_rule_cost must be positive")
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO tenant_rule_policies (tenant_id, max_rule_cost, updated_by, updated_at)
+            VALUES ($1, $2, $3, now())
+            ON CONFLICT (tenant_id) DO UPDATE
+            SET max_rule_cost = EXCLUDED.max_rule_cost, updated_by = EXCLUDED.updated_by, updated_at = now()
+            """,
+            tenant_id,
+            raw,
+            str(user.get("sub") or ""),
+        )
+    # A changed threshold can release (or hold back) the tenant bundle.
+    _request_policy_reconcile(tenant_id=tenant_id)
+    return JSONResponse({"tenant_id": tenant_id, "max_rule_cost": raw})
+
+
+def _locate_combined_line(offsets: list[Tuple[int, str]], line_no: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
+    if line_no is None:
+        return None, None
+    owner: Optional[Tuple[int, str]] = None
+    for start, name in offsets:
+        if start > line_no:
+            break
+        owner = (start, name)
+    if owner is None:
+        return None, line_no
+    return owner[1], line_no - owner[0] + 1
+
+
+@app.post("/yara/validate/batch")
+async def validate_yara_rules_batch(payload: dict, user: dict = Depends(get_current_user)) -> StreamingResponse:
+    """Validate many rules and stream per-rule results as they finish.
+
+    JSON body: { "rules": [{"name": "a.yar", "content": "..."} | {"name": "b.yar", "stored": true}],
+    "externals": {...}, "combined": true, "format": "ndjson" | "sse" }
+
+    Stored references are read from the tenant's library. With "combined" (default) the
+    individually valid rules are also compiled together once, which catches duplicate
+    rule identifiers across files; its errors are mapped back to file name and line.
+    """
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    raw_rules = payload.get("rules")
+    if not isinstance(raw_rules, list) or not raw_rules:
+        raise HTTPException(status_code=400, detail="rules must be a non-empty list")
+    if len(raw_rules) > YARA_VALIDATE_BATCH_MAX_RULES:
+        raise HTTPException(status_code=400, detail=f"at most {YARA_VALIDATE_BATCH_MAX_RULES} rules per batch")
+    stream_format = str(payload.get("format") or "ndjson").strip().lower()
+    if stream_format not in {"ndjson", "sse"}:
+        raise HTTPException(status_code=400, detail="format must be ndjson or sse")
+    externals = _normalize_externals(payload.get("externals"))
+    combined = _is_truthy(payload.get("combined", True))
+
+    items: list[Dict[str, Any]] = []
+    total_bytes = 0
+    for raw in raw_rules:
+        if not isinstance(raw, dict):
+            raise HTTPException(status_code=400, detail="each rule must be an object")
+        name = _validate_yara_rule_name(str(raw.get("name") or ""))
+        content = raw.get("content")
+        if content is None:
+            if not _is_truthy(raw.get("stored", True)):
+                raise HTTPException(status_code=400, detail=f"rule {name} has no content")
+        else:
+            content = str(content)
+            size = len(content.encode("utf-8"))
+            if size > 1024 * 1024:
+                raise HTTPException(status_code=400, detail=f"rule {name} exceeds 1MB limit")
+            total_bytes += size
+        items.append({"index": len(items), "name": name, "content": content})
+    if total_bytes > YARA_VALIDATE_BATCH_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="batch exceeds size limit")
+    if any(item["content"] is None for item in items):
+        # Only stored references need the rule library.
+        _ensure_yara_storage_enabled()
+
+    gate = asyncio.Semaphore(max(1, YARA_VALIDATE_BATCH_CONCURRENCY))
+
+    async def _validate_item(item: Dict[str, Any]) -> dict:
+        nonlocal total_bytes
+        frame = {"type": "result", "index": item["index"], "name": item["name"]}
+        async with gate:
+            try:
+                if item["content"] is None:
+                    data = await _storage_call(
+                        _read_object_bytes, _minio_client(), _rule_object_key(tenant_id, item["name"])
+                    )
+                    # Stored rules count against the same per-rule and per-batch limits as inline ones.
+                    if len(data) > 1024 * 1024:
+                        return {**frame, "status": "error", "error": "rule exceeds 1MB limit"}
+                    total_bytes += len(data)
+                    if total_bytes > YARA_VALIDATE_BATCH_MAX_BYTES:
+                        return {**frame, "status": "error", "error": "batch exceeds size limit"}
+                    item["content"] = data.decode("utf-8")
+                result, cache_state = await _validate_cached(item["content"], externals)
+            except S3Error as exc:
+                if exc.code in {"NoSuchKey", "NoSuchObject"}:
+                    return {**frame, "status": "error", "error": "rule not found"}
+                return {**frame, "status": "error", "error": f"yara storage read failed: {exc.code}"}
+            except UnicodeDecodeError:
+                return {**frame, "status": "error", "error": "rule content is not valid UTF-8"}
+            except (subprocess.TimeoutExpired, asyncio.TimeoutError):
+                return {**frame, "status": "error", "error": "validation timed out"}
+            except Exception as exc:
+                logger.exception("batch validation of %s failed", item["name"])
+                return {**frame, "status": "error", "error": str(exc)}
+        item["valid"] = bool(result.get("valid"))
+        return {**frame, "status": "valid" if item["valid"] else "invalid", "cache": cache_state, **result}
+
+    def _frame(item: dict) -> str:
+        if stream_format == "sse":
+            return f"event: {item['type']}\ndata: {json.dumps(item)}\n\n"
+        return json.dumps(item) + "\n"
+
+    async def _stream():
+        counts = {"valid": 0, "invalid": 0, "error": 0}
+        yield _frame({"type": "started", "tenant_id": tenant_id, "total": len(items), "combined": combined})
+        tasks = [asyncio.create_task(_validate_item(item)) for item in items]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                frame = await next_done
+                counts[frame["status"]] += 1
+                yield _frame(frame)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if combined:
+            parts: list[str] = []
+            offsets: list[Tuple[int, str]] = []
+            line = 1
+            for item in items:
+                if not item.get("valid"):
+                    continue
+                text = item["content"] if item["content"].endswith("\n") else item["content"] + "\n"
+                offsets.append((line, item["name"]))
+                parts.append(text)
+                line += text.count("\n")
+            frame: Dict[str, Any] = {"type": "combined", "rules": len(offsets)}
+            if offsets:
+                try:
+                    result, cache_state = await _validate_cached("".join(parts), externals)
+                    errors = []
+                    for error in result.get("errors") or []:
+                        name, line_no = _locate_combined_line(offsets, error.get("line"))
+                        errors.append({**error, "name": name, "line": line_no})
+                    frame.update(
+                        {
+                            "status": "valid" if result.get("valid") else "invalid",
+                            "valid": bool(result.get("valid")),
+                            "errors": errors,
+                            "cache": cache_state,
+                        }
+                    )
+                except (subprocess.TimeoutExpired, asyncio.TimeoutError):
+                    frame.update({"status": "error", "error": "combined validation timed out"})
+                except Exception as exc:
+                    logger.exception("combined batch validation failed")
+                    frame.update({"status": "error", "error": str(exc)})
+            else:
+                frame.update({"status": "skipped"})
+            yield _frame(frame)
+        yield _frame({"type": "summary", "total": len(items), **counts})
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream" if stream_format == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
-@app.get("/yara/rules")
-async def list_yara_rules(user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
+@app.get("/rulesets/bundle")
+async def get_ruleset_bundle(user: dict = Depends(get_current_user)) -> JSONResponse:
     tenant_id = _tenant_for_request(user, None)
-    client = _minio_client()
-    prefix = f"tenants/{tenant_id}/yara/"
-    actor = str(user.get("sub") or "system")
-    metadata_by_name = await _list_rule_metadata(tenant_id)
+    bundle = await _get_tenant_bundle(tenant_id)
+    return JSONResponse(_bundle_summary(tenant_id, bundle))
 
-    def _list_objects() -> list:
-        return list(client.list_objects(YARA_STORAGE_BUCKET, prefix=prefix, recursive=True))
 
-    try:
-        objects = await asyncio.to_thread(_list_objects)
-    except Exception as exc:
-        logger.exception("failed to list yara rules")
-        raise HTTPException(status_code=502, detail=f"yara storage list failed: {exc}")
+@app.get("/rulesets/bundle/content")
+async def get_ruleset_bundle_content(user: dict = Depends(get_current_user)) -> Response:
+    tenant_id = _tenant_for_request(user, None)
+    bundle = await _get_tenant_bundle(tenant_id)
+    return Response(
+        content=bundle["content"],
+        media_type="text/plain; charset=utf-8",
+        headers={"X-Policy-Version": bundle["version"], "X-Policy-Hash": bundle["sha256"]},
+    )
 
-    items = []
-    for obj in objects:
-        object_name = _safe_string(getattr(obj, "object_name", ""))
-        if not object_name or not object_name.endswith(".yar"):
-            continue
-        name = object_name.split("/")[-1]
-        row = metadata_by_name.get(name)
-        etag = _safe_string(getattr(obj, "etag", ""))
-        size_bytes = int(getattr(obj, "size", 0) or 0)
-        updated_at_obj = getattr(obj, "last_modified", None)
-        items.append(
-            {
-                "name": name,
-                "tenant_id": tenant_id,
-                "object_key": object_name,
-                "etag": etag,
-                "sha256": _safe_string(row["sha256"]) if row else "",
-                "size_bytes": size_bytes,
-                "created_at": row["created_at"].isoformat() if row and row.get("created_at") else None,
-                "updated_at": row["updated_at"].isoformat() if row and row.get("updated_at") else (updated_at_obj.isoformat() if updated_at_obj else None),
-                "created_by": _safe_string(row["created_by"]) if row else actor,
-                "updated_by": _safe_string(row["updated_by"]) if row else actor,
-            }
-        )
 
-    items.sort(key=lambda x: x.get("updated_at") or "", reverse=True)
-    return JSONResponse(items)
+@app.post("/rulesets/compile")
+async def compile_ruleset(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
+    _ensure_yara_storage_enabled()
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    rule_text = str(payload.get("rule_text") or "")
+    if not rule_text.strip():
+        raise HTTPException(status_code=400, detail="rule_text must not be empty")
+    if not _yara_version():
+        raise HTTPException(status_code=503, detail="yarac binary is not available in orchestrator container")
+    compiled = await _get_compiled_ruleset(tenant_id, rule_text)
+    if compiled is None:
+        raise HTTPException(status_code=422, detail="ruleset could not be compiled")
+    return JSONResponse({k: v for k, v in compiled.items() if k != "data"})
 
 
-@app.get("/yara/rules/{name}")
-async def get_yara_rule(name: str, user: dict = Depends(get_current_user)) -> JSONResponse:
+@app.post("/yara/assistant")
+async def yara_assistant(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
     _ensure_yara_storage_enabled()
-    tenant_id = _tenant_for_request(user, None)
-    safe_name = _validate_yara_rule_name(name)
-    object_key = _rule_object_key(tenant_id, safe_name)
-    client = _minio_client()
-    row = await _get_rule_metadata(tenant_id, safe_name)
+    _ = _tenant_for_request(user, payload.get("tenant_id"))
+    rule_name = _validate_yara_rule_name(str(payload.get("rule_name") or "rule.yar"))
+    rule_content = str(payload.get("rule_content") or "")
+    if len(rule_content.encode("utf-8")) > 1024 * 1024:
+        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+    message = str(payload.get("message") or "").strip()
+    if not message:
+        raise HTTPException(status_code=400, detail="message is required")
+    history = payload.get("history")
+    if not isinstance(history, list):
+        history = []
+    clean_history = []
+    for item in history[:20]:
+        if not isinstance(item, dict):
+            continue
+        role = str(item.get("role") or "").strip().lower()
+        content = str(item.get("content") or "").strip()
+        if role not in {"user", "model"} or not content:
+            continue
+        clean_history.append({"role": role, "content": content})
 
     try:
-        response = await asyncio.to_thread(client.get_object, YARA_STORAGE_BUCKET, object_key)
-        data = response.read()
-        response.close()
-        response.release_conn()
-        stat = await asyncio.to_thread(client.stat_object, YARA_STORAGE_BUCKET, object_key)
-    except S3Error as exc:
-        if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchBucket"}:
-            raise HTTPException(status_code=404, detail="rule not found")
-        logger.exception("failed to fetch yara rule")
-        raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        reply = await asyncio.to_thread(_call_gemini_yara_assistant, message, clean_history, rule_name, rule_content)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=502, detail=str(exc))
     except Exception as exc:
-        logger.exception("failed to fetch yara rule")
-        raise HTTPException(status_code=502, detail=f"yara storage read failed: {exc}")
+        logger.exception("yara assistant request failed")
+        raise HTTPException(status_code=502, detail=f"assistant error: {exc}")
+    return JSONResponse({"reply": reply})
 
-    try:
-        content = data.decode("utf-8")
-    except UnicodeDecodeError:
-        raise HTTPException(status_code=400, detail="rule content is not valid UTF-8")
 
-    return JSONResponse(
-        {
-            "name": safe_name,
-            "tenant_id": tenant_id,
-            "object_key": object_key,
-            "etag": _safe_string(getattr(stat, "etag", "")),
-            "sha256": _safe_string(row["sha256"]) if row else hashlib.sha256(data).hexdigest(),
-            "size_bytes": int(getattr(stat, "size", 0) or len(data)),
-            "created_at": row["created_at"].isoformat() if row and row.get("created_at") else None,
-            "updated_at": row["updated_at"].isoformat() if row and row.get("updated_at") else None,
-            "created_by": _safe_string(row["created_by"]) if row else None,
-            "updated_by": _safe_string(row["updated_by"]) if row else None,
-            "content": content,
-        }
-    )
+JOB_RESULT_MESSAGE_TYPES = {"rule.compile.result"}
 
 
-@app.post("/yara/rules")
-async def create_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
-    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
-    actor = str(user.get("sub") or "system")
-    safe_name = _validate_yara_rule_name(str(payload.get("name") or ""))
-    content = str(payload.get("content") or "")
-    if not content.strip():
-        raise HTTPException(status_code=400, detail="rule content must not be empty")
-    encoded = content.encode("utf-8")
-    if len(encoded) > 1024 * 1024:
-        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+def _register_job_waiter(job_id: str, agent_id: str) -> asyncio.Future:
+    waiter = asyncio.get_running_loop().create_future()
+    job_waiters[job_id] = waiter
+    job_agents[job_id] = agent_id
+    return waiter
 
-    object_key = _rule_object_key(tenant_id, safe_name)
-    client = _minio_client()
 
-    try:
-        await asyncio.to_thread(client.stat_object, YARA_STORAGE_BUCKET, object_key)
-        raise HTTPException(status_code=409, detail="rule already exists")
-    except S3Error as exc:
-        if exc.code not in {"NoSuchKey", "NoSuchObject", "NoSuchBucket"}:
-            logger.exception("failed to check existing rule")
-            raise HTTPException(status_code=502, detail=f"yara storage stat failed: {exc}")
-    except HTTPException:
-        raise
+def _discard_job_waiter(job_id: str) -> None:
+    job_waiters.pop(job_id, None)
+    job_agents.pop(job_id, None)
 
-    try:
-        await asyncio.to_thread(
-            client.put_object,
-            YARA_STORAGE_BUCKET,
-            object_key,
-            io.BytesIO(encoded),
-            len(encoded),
-            "text/plain; charset=utf-8",
+
+def _resolve_job_waiter(agent_id: str, msg: dict) -> bool:
+    job_id = _safe_string(msg.get("id"))
+    relay = relayed_jobs.get(job_id)
+    if relay is not None and relay[1] == agent_id:
+        relayed_jobs.pop(job_id, None)
+        _spawn_background(
+            _notify_replica(relay[0], "job.result", {"job_id": job_id, "agent_id": agent_id, "message": msg})
+        )
+        return True
+    waiter = job_waiters.get(job_id)
+    # Only the agent the job was sent to may complete it.
+    if waiter is None or waiter.done() or job_agents.get(job_id) != agent_id:
+        return False
+    waiter.set_result(msg)
+    return True
+
+
+def _fail_agent_job_waiters(agent_id: str) -> None:
+    for job_id, owner in list(job_agents.items()):
+        if owner != agent_id:
+            continue
+        waiter = job_waiters.get(job_id)
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(ConnectionError(f"agent {agent_id} disconnected"))
+    for job_id, (origin, owner, _) in list(relayed_jobs.items()):
+        if owner != agent_id:
+            continue
+        relayed_jobs.pop(job_id, None)
+        _spawn_background(
+            _notify_replica(
+                origin,
+                "job.failed",
+                {"job_id": job_id, "agent_id": agent_id, "error": f"agent {agent_id} disconnected"},
+            )
         )
-        stat = await asyncio.to_thread(client.stat_object, YARA_STORAGE_BUCKET, object_key)
-    except Exception as exc:
-        logger.exception("failed to create yara rule")
-        raise HTTPException(status_code=502, detail=f"yara storage write failed: {exc}")
 
-    sha256_hex = hashlib.sha256(encoded).hexdigest()
-    await _upsert_rule_metadata(
-        tenant_id=tenant_id,
-        name=safe_name,
-        object_key=object_key,
-        etag=_safe_string(getattr(stat, "etag", "")),
-        sha256_hex=sha256_hex,
-        size_bytes=int(getattr(stat, "size", len(encoded)) or len(encoded)),
-        actor=actor,
-    )
 
-    return JSONResponse(
-        {
-            "ok": True,
-            "name": safe_name,
-            "tenant_id": tenant_id,
-            "object_key": object_key,
-            "etag": _safe_string(getattr(stat, "etag", "")),
-            "sha256": sha256_hex,
-            "size_bytes": int(getattr(stat, "size", len(encoded)) or len(encoded)),
-        },
-        status_code=201,
-    )
+def _replica_channel(replica_id: str) -> str:
+    # NOTIFY channels are identifiers (max 63 bytes), so address replicas by a digest.
+    return "orch_replica_" + hashlib.sha1(replica_id.encode("utf-8")).hexdigest()[:32]
 
 
-@app.put("/yara/rules/{name}")
-async def update_yara_rule(name: str, payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
-    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
-    actor = str(user.get("sub") or "system")
-    safe_name = _validate_yara_rule_name(name)
-    content = str(payload.get("content") or "")
-    if not content.strip():
-        raise HTTPException(status_code=400, detail="rule content must not be empty")
-    encoded = content.encode("utf-8")
-    if len(encoded) > 1024 * 1024:
-        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+JOB_EVENTS_CHANNEL = "orch_job_events"
+
+
+async def _publish_replica_message(target_replica: str, kind: str, body: dict) -> None:
+    # Bodies can exceed NOTIFY's 8000-byte payload limit (rule text), so they go through
+    # replica_messages and the notification only carries the row id.
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            WITH m AS (
+                INSERT INTO replica_messages (target_replica, source_replica, kind, body_json)
+                VALUES ($1, $2, $3, $4::jsonb)
+                RETURNING id
+            )
+            SELECT pg_notify($5, m.id::text) FROM m
+            """,
+            target_replica,
+            ORCHESTRATOR_REPLICA_ID,
+            kind,
+            json.dumps(body),
+            _replica_channel(target_replica),
+        )
 
-    object_key = _rule_object_key(tenant_id, safe_name)
-    client = _minio_client()
-    try:
-        await asyncio.to_thread(client.stat_object, YARA_STORAGE_BUCKET, object_key)
-    except S3Error as exc:
-        if exc.code in {"NoSuchKey", "NoSuchObject", "NoSuchBucket"}:
-            raise HTTPException(status_code=404, detail="rule not found")
-        logger.exception("failed to check rule before update")
-        raise HTTPException(status_code=502, detail=f"yara storage stat failed: {exc}")
 
+async def _notify_replica(target_replica: str, kind: str, body: dict) -> None:
     try:
-        await asyncio.to_thread(
-            client.put_object,
-            YARA_STORAGE_BUCKET,
-            object_key,
-            io.BytesIO(encoded),
-            len(encoded),
-            "text/plain; charset=utf-8",
+        await _publish_replica_message(target_replica, kind, body)
+    except Exception:
+        logger.exception("failed to publish %s to replica %s", kind, target_replica)
+
+
+async def _claim_agent_route(agent_id: str) -> Optional[str]:
+    """Record this replica as the owner of agent_id; returns the previous live owner, if another replica."""
+    if not ORCHESTRATOR_ROUTING_ENABLED:
+        return None
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            WITH previous AS (
+                SELECT r.replica_id
+                FROM agent_routes r
+                JOIN orchestrator_replicas o ON o.replica_id = r.replica_id
+                WHERE r.agent_id = $1
+                  AND r.replica_id <> $2
+                  AND o.last_seen >= now() - make_interval(secs => $3::int)
+            ), claimed AS (
+                INSERT INTO agent_routes (agent_id, replica_id, connected_at)
+                VALUES ($1, $2, now())
+                ON CONFLICT (agent_id) DO UPDATE SET
+                    replica_id = EXCLUDED.replica_id,
+                    connected_at = EXCLUDED.connected_at
+            )
+            SELECT replica_id FROM previous
+            """,
+            agent_id,
+            ORCHESTRATOR_REPLICA_ID,
+            max(5, ORCHESTRATOR_REPLICA_TTL_SECONDS),
         )
-        stat = await asyncio.to_thread(client.stat_object, YARA_STORAGE_BUCKET, object_key)
-    except Exception as exc:
-        logger.exception("failed to update yara rule")
-        raise HTTPException(status_code=502, detail=f"yara storage write failed: {exc}")
+    return str(row["replica_id"]) if row else None
 
-    sha256_hex = hashlib.sha256(encoded).hexdigest()
-    await _upsert_rule_metadata(
-        tenant_id=tenant_id,
-        name=safe_name,
-        object_key=object_key,
-        etag=_safe_string(getattr(stat, "etag", "")),
-        sha256_hex=sha256_hex,
-        size_bytes=int(getattr(stat, "size", len(encoded)) or len(encoded)),
-        actor=actor,
-    )
-    return JSONResponse(
-        {
-            "ok": True,
-            "name": safe_name,
-            "tenant_id": tenant_id,
-            "object_key": object_key,
-            "etag": _safe_string(getattr(stat, "etag", "")),
-            "sha256": sha256_hex,
-            "size_bytes": int(getattr(stat, "size", len(encoded)) or len(encoded)),
-        }
-    )
 
+async def _release_agent_route(agent_id: str) -> bool:
+    """Drop this replica's route for agent_id; False when another replica has already taken the agent over."""
+    if not ORCHESTRATOR_ROUTING_ENABLED:
+        return True
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            "DELETE FROM agent_routes WHERE agent_id = $1 AND replica_id = $2",
+            agent_id,
+            ORCHESTRATOR_REPLICA_ID,
+        )
+        owner = await conn.fetchval("SELECT replica_id FROM agent_routes WHERE agent_id = $1", agent_id)
+    return owner is None
 
-@app.delete("/yara/rules/{name}")
-async def delete_yara_rule(name: str, user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
-    tenant_id = _tenant_for_request(user, None)
-    safe_name = _validate_yara_rule_name(name)
-    object_key = _rule_object_key(tenant_id, safe_name)
-    client = _minio_client()
-    try:
-        await asyncio.to_thread(client.remove_object, YARA_STORAGE_BUCKET, object_key)
-    except Exception as exc:
-        logger.exception("failed to delete yara rule")
-        raise HTTPException(status_code=502, detail=f"yara storage delete failed: {exc}")
 
-    await _delete_rule_metadata(tenant_id, safe_name)
-    return JSONResponse({"ok": True, "name": safe_name, "tenant_id": tenant_id})
+async def _remote_agent_owners(agent_ids: list[str]) -> Dict[str, str]:
+    """Map agent ids held by other live replicas to the replica that owns them."""
+    if not ORCHESTRATOR_ROUTING_ENABLED or not agent_ids:
+        return {}
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT r.agent_id, r.replica_id
+            FROM agent_routes r
+            JOIN orchestrator_replicas o ON o.replica_id = r.replica_id
+            WHERE r.agent_id = ANY($1::text[])
+              AND r.replica_id <> $2
+              AND o.last_seen >= now() - make_interval(secs => $3::int)
+            """,
+            agent_ids,
+            ORCHESTRATOR_REPLICA_ID,
+            max(5, ORCHESTRATOR_REPLICA_TTL_SECONDS),
+        )
+    return {str(r["agent_id"]): str(r["replica_id"]) for r in rows}
 
 
-@app.post("/yara/validate")
-async def validate_yara_rule(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
-    _ = _tenant_for_request(user, payload.get("tenant_id"))
-    name = _validate_yara_rule_name(str(payload.get("name") or "rule.yar"))
-    content = str(payload.get("content") or "")
-    if not content.strip():
-        raise HTTPException(status_code=400, detail="rule content must not be empty")
-    encoded = content.encode("utf-8")
-    if len(encoded) > 1024 * 1024:
-        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
+async def _handle_replica_message(kind: str, source: str, body: dict) -> None:
+    job_id = _safe_string(body.get("job_id"))
+    agent_id = _safe_string(body.get("agent_id"))
+    if kind == "agent.command":
+        ws = agents.get(agent_id)
+        if ws is None:
+            await _notify_replica(
+                source, "job.failed", {"job_id": job_id, "agent_id": agent_id, "error": "agent not connected"}
+            )
+            return
+        relayed_jobs[job_id] = (source, agent_id, asyncio.get_running_loop().time())
+        try:
+            await ws.send_text(_safe_string(body.get("message_text")))
+        except (WebSocketDisconnect, RuntimeError):
+            relayed_jobs.pop(job_id, None)
+            await _notify_replica(
+                source, "job.failed", {"job_id": job_id, "agent_id": agent_id, "error": "agent disconnected before dispatch"}
+            )
+    elif kind == "job.result":
+        msg = body.get("message")
+        if isinstance(msg, dict):
+            _resolve_job_waiter(agent_id, msg)
+    elif kind == "job.failed":
+        waiter = job_waiters.get(job_id)
+        if waiter is not None and not waiter.done() and job_agents.get(job_id) == agent_id:
+            waiter.set_exception(ConnectionError(_safe_string(body.get("error"), "agent unavailable")))
+    elif kind == "agent.evict":
+        ws = agents.get(agent_id)
+        if ws is not None:
+            try:
+                await ws.close()
+            except Exception:
+                pass
+    else:
+        logger.warning("ignoring unknown replica message kind %s from %s", kind, source)
 
+
+async def _drain_replica_messages(message_id: Optional[int] = None) -> None:
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            DELETE FROM replica_messages
+            WHERE target_replica = $1
+              AND ($2::bigint IS NULL OR id = $2)
+            RETURNING id, source_replica, kind, body_json
+            """,
+            ORCHESTRATOR_REPLICA_ID,
+            message_id,
+        )
+    for row in sorted(rows, key=lambda r: r["id"]):
+        try:
+            await _handle_replica_message(str(row["kind"]), str(row["source_replica"]), _json_value(row["body_json"], {}))
+        except Exception:
+            logger.exception("failed to handle replica message %s", row["id"])
+
+
+async def _forward_remote_job_event(job_id: str) -> None:
+    row = await _get_command_job(job_id)
+    if row is not None:
+        _publish_job_event(_command_job_to_dict(row))
+
+
+def _on_replica_notification(_conn: Any, _pid: int, channel: str, payload: str) -> None:
+    if channel == JOB_EVENTS_CHANNEL:
+        source, _, job_id = payload.partition("|")
+        if source != ORCHESTRATOR_REPLICA_ID and job_id in job_listeners:
+            _spawn_background(_forward_remote_job_event(job_id))
+        return
     try:
-        result = await asyncio.to_thread(_validate_yara_with_yarac, name, content)
-    except RuntimeError as exc:
-        raise HTTPException(status_code=503, detail=str(exc))
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=504, detail="validation timed out")
-    except Exception as exc:
-        logger.exception("yara validation failed")
-        raise HTTPException(status_code=502, detail=f"validation failed: {exc}")
+        message_id = int(payload)
+    except ValueError:
+        return
+    _spawn_background(_drain_replica_messages(message_id))
+
+
+async def _replica_heartbeat() -> None:
+    ttl = max(5, ORCHESTRATOR_REPLICA_TTL_SECONDS)
+    db = await _db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO orchestrator_replicas (replica_id, started_at, last_seen)
+            VALUES ($1, now(), now())
+            ON CONFLICT (replica_id) DO UPDATE SET last_seen = now()
+            """,
+            ORCHESTRATOR_REPLICA_ID,
+        )
+        # Routes and undelivered messages of replicas that stopped heartbeating are dead weight.
+        await conn.execute(
+            """
+            DELETE FROM agent_routes r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM orchestrator_replicas o
+                WHERE o.replica_id = r.replica_id
+                  AND o.last_seen >= now() - make_interval(secs => $1::int)
+            )
+            """,
+            ttl * 4,
+        )
+        await conn.execute(
+            "DELETE FROM orchestrator_replicas WHERE last_seen < now() - make_interval(secs => $1::int)",
+            ttl * 4,
+        )
+        await conn.execute(
+            "DELETE FROM replica_messages WHERE created_at < now() - make_interval(secs => $1::int)",
+            ttl * 4,
+        )
+    # Relays whose origin already gave up (timeout) would otherwise never be cleared.
+    horizon = asyncio.get_running_loop().time() - max(1.0, COMMAND_JOB_TIMEOUT_SECONDS) * 2
+    for job_id, (_, _, created) in list(relayed_jobs.items()):
+        if created < horizon:
+            relayed_jobs.pop(job_id, None)
 
-    return JSONResponse(result)
 
+async def _replica_loop() -> None:
+    global _replica_listener
+    interval = max(1.0, ORCHESTRATOR_REPLICA_TTL_SECONDS / 3)
+    while True:
+        try:
+            if _replica_listener is None or _replica_listener.is_closed():
+                _replica_listener = await asyncpg.connect(**_pg_connect_kwargs())
+                await _replica_listener.add_listener(_replica_channel(ORCHESTRATOR_REPLICA_ID), _on_replica_notification)
+                await _replica_listener.add_listener(JOB_EVENTS_CHANNEL, _on_replica_notification)
+                # Pick up anything addressed to us while we were not listening.
+                await _drain_replica_messages()
+            await _replica_heartbeat()
+        except Exception:
+            logger.exception("replica routing loop failed")
+            if _replica_listener is not None:
+                try:
+                    await _replica_listener.close()
+                except Exception:
+                    pass
+                _replica_listener = None
+        await asyncio.sleep(interval)
 
-@app.post("/yara/assistant")
-async def yara_assistant(payload: dict, user: dict = Depends(get_current_user)) -> JSONResponse:
-    _ensure_yara_storage_enabled()
-    _ = _tenant_for_request(user, payload.get("tenant_id"))
-    rule_name = _validate_yara_rule_name(str(payload.get("rule_name") or "rule.yar"))
-    rule_content = str(payload.get("rule_content") or "")
-    if len(rule_content.encode("utf-8")) > 1024 * 1024:
-        raise HTTPException(status_code=400, detail="rule content exceeds 1MB limit")
-    message = str(payload.get("message") or "").strip()
-    if not message:
-        raise HTTPException(status_code=400, detail="message is required")
-    history = payload.get("history")
-    if not isinstance(history, list):
-        history = []
-    clean_history = []
-    for item in history[:20]:
-        if not isinstance(item, dict):
-            continue
-        role = str(item.get("role") or "").strip().lower()
-        content = str(item.get("content") or "").strip()
-        if role not in {"user", "model"} or not content:
-            continue
-        clean_history.append({"role": role, "content": content})
 
-    try:
-        reply = await asyncio.to_thread(_call_gemini_yara_assistant, message, clean_history, rule_name, rule_content)
-    except RuntimeError as exc:
-        raise HTTPException(status_code=502, detail=str(exc))
-    except Exception as exc:
-        logger.exception("yara assistant request failed")
-        raise HTTPException(status_code=502, detail=f"assistant error: {exc}")
-    return JSONResponse({"reply": reply})
+async def _send_compiled_ruleset(ws: WebSocket, agent_id: str, msg: dict) -> None:
+    sha256_hex = _safe_string(msg.get("sha256")).strip().lower()
+    tenant_id = ((agent_state.get(agent_id) or {}).get("tenant_id") or "default").strip()
+    reply: Dict[str, Any] = {"type": "ruleset.blob", "sha256": sha256_hex, "yara_version": _yara_version()}
+    compiled = None
+    if re.fullmatch(r"[0-9a-f]{64}", sha256_hex):
+        compiled = await _get_compiled_ruleset(tenant_id, None, sha256_hex=sha256_hex)
+    if compiled is None:
+        reply["error"] = "compiled ruleset not found"
+    else:
+        reply["data"] = base64.b64encode(compiled["data"]).decode("ascii")
+    await ws.send_text(json.dumps(reply))
 
 
 @app.websocket("/agent/ws")
@@ -1319,9 +6068,7 @@ async def agent_ws(ws: WebSocket):
             await previous_ws.close()
         except Exception:
             pass
-    q: asyncio.Queue = asyncio.Queue()
     agents[agent_id] = ws
-    agent_queues[agent_id] = q
     agent_state[agent_id] = {
         "connected_at": now,
         "last_seen": now,
@@ -1336,25 +6083,35 @@ async def agent_ws(ws: WebSocket):
         "sbom": [],
         "cves": [],
         "findings_count": 0,
+        # field -> content hash of the last snapshot queued for the database
+        "snapshot_hashes": {},
     }
     logger.info("agent connected: %s", agent_id)
-    await _upsert_agent_control_state(
-        agent_id,
-        status_value="connected",
-        connected_at=now,
-        last_seen=now,
-        tenant_id="default",
-        capabilities={},
-        is_ephemeral=requested_ephemeral,
-        instance_id=requested_instance_id,
-        runtime_kind=requested_runtime,
-        lease_expires_at=_lease_expiry(now) if requested_ephemeral else None,
-    )
-
-    # send registration message to agent
-    await ws.send_text(json.dumps({"type": "agent.registered", "id": agent_id}))
 
+    # Everything after registering the socket runs under the finally below, so a failed
+    # write, route claim or send does not leave a stale entry in agents.
     try:
+        await _write_through_agent_control_state(
+            agent_id,
+            status_value="connected",
+            connected_at=now,
+            last_seen=now,
+            tenant_id="default",
+            capabilities={},
+            is_ephemeral=requested_ephemeral,
+            instance_id=requested_instance_id,
+            runtime_kind=requested_runtime,
+            lease_expires_at=_lease_expiry(now) if requested_ephemeral else None,
+        )
+
+        previous_owner = await _claim_agent_route(agent_id)
+        if previous_owner is not None:
+            # The agent reconnected through another replica; make that replica drop its old socket.
+            await _notify_replica(previous_owner, "agent.evict", {"agent_id": agent_id})
+
+        # send registration message to agent
+        await ws.send_text(json.dumps({"type": "agent.registered", "id": agent_id}))
+
         while True:
             data = await ws.receive_text()
             try:
@@ -1365,11 +6122,14 @@ async def agent_ws(ws: WebSocket):
             state = agent_state.get(agent_id)
             if state is not None:
                 state["last_seen"] = datetime.now(timezone.utc)
-                await _upsert_agent_control_state(agent_id, status_value="connected", last_seen=state["last_seen"])
+                _queue_agent_control_state(agent_id, status_value="connected", last_seen=state["last_seen"])
 
             msg_type = msg.get("type")
             if msg_type == "agent.heartbeat":
                 if state is not None:
+                    if state.get("last_heartbeat") is None:
+                        # First heartbeat carries the tenant; only now can the agent's policy be checked.
+                        _request_policy_reconcile(agent_id=agent_id)
                     state["last_heartbeat"] = datetime.now(timezone.utc)
                     caps = msg.get("capabilities")
                     if isinstance(caps, dict):
@@ -1407,86 +6167,165 @@ async def agent_ws(ws: WebSocket):
                     tenant_id = msg.get("tenant_id")
                     if isinstance(tenant_id, str) and tenant_id.strip():
                         state["tenant_id"] = tenant_id.strip()
-                    await _upsert_agent_control_state(
+                    # Unchanged snapshots are left out so the flush only touches timestamps.
+                    changed_snapshots = _changed_snapshots(
+                        state,
+                        {
+                            "capabilities": state.get("capabilities") or {},
+                            "asset_profile": state.get("asset_profile") or {},
+                            "sbom": state.get("sbom") or [],
+                            "cves": state.get("cves") or [],
+                        },
+                    )
+                    sbom_changed = changed_snapshots.pop("sbom", None) is not None
+                    cves_changed = changed_snapshots.pop("cves", None) is not None
+                    if sbom_changed or cves_changed:
+                        _queue_agent_inventory(
+                            agent_id,
+                            tenant_id=state.get("tenant_id") or "default",
+                            sbom=(state.get("sbom") or []) if sbom_changed else None,
+                            cves=(state.get("cves") or []) if cves_changed else None,
+                        )
+                    _queue_agent_control_state(
                         agent_id,
                         tenant_id=state.get("tenant_id") or "default",
                         status_value="connected",
                         last_seen=state["last_seen"],
                         last_heartbeat=state["last_heartbeat"],
-                        capabilities=state.get("capabilities") or {},
                         is_ephemeral=bool(state.get("is_ephemeral")),
                         instance_id=state.get("instance_id"),
                         runtime_kind=state.get("runtime_kind"),
                         lease_expires_at=state.get("lease_expires_at"),
-                        asset_profile=state.get("asset_profile") or {},
-                        sbom_snapshot=state.get("sbom") or [],
-                        cve_snapshot=state.get("cves") or [],
                         findings_count=int(state.get("findings_count") or 0),
+                        **changed_snapshots,
                     )
 
-            # push message to agent queue for any waiting HTTP callers
-            await q.put(msg)
+            if msg_type in JOB_RESULT_MESSAGE_TYPES:
+                _resolve_job_waiter(agent_id, msg)
+            elif msg_type == "ruleset.fetch":
+                await _send_compiled_ruleset(ws, agent_id, msg)
     except WebSocketDisconnect:
         logger.info("agent disconnected: %s", agent_id)
     finally:
         # Ignore stale disconnects when a newer websocket already replaced this agent_id.
         if agents.get(agent_id) is ws:
             agents.pop(agent_id, None)
-            agent_queues.pop(agent_id, None)
             agent_state.pop(agent_id, None)
-            await _upsert_agent_control_state(
-                agent_id,
-                status_value="disconnected",
-                last_seen=datetime.now(timezone.utc),
-            )
+            _fail_agent_job_waiters(agent_id)
+            try:
+                still_owner = await _release_agent_route(agent_id)
+            except Exception:
+                logger.exception("failed to release route for agent %s", agent_id)
+                still_owner = True
+            # When another replica already owns the agent again, its "connected" state must win.
+            if still_owner:
+                _queue_agent_control_state(
+                    agent_id,
+                    status_value="disconnected",
+                    last_seen=datetime.now(timezone.utc),
+                )
 
 
-@app.post("/push_rule")
-async def push_rule(payload: dict, user: dict = Depends(get_current_user)):
-    """Push a rule to an agent and wait for compile result.
+async def _stored_agent_capabilities(agent_id: str) -> dict:
+    db = await _db()
+    async with db.acquire() as conn:
+        raw = await conn.fetchval("SELECT capabilities_json FROM agents_control_state WHERE agent_id = $1", agent_id)
+    value = _json_value(raw, {})
+    return value if isinstance(value, dict) else {}
 
-    JSON body: { "agent_id": "...", "id": "optional-job-id", "rule_text": "..." }
-    """
-    agent_id = payload.get("agent_id")
-    rule_text = payload.get("rule_text")
-    if not agent_id or not rule_text:
-        raise HTTPException(status_code=400, detail="missing agent_id or rule_text")
 
-    ws = agents.get(agent_id)
-    if ws is None:
-        raise HTTPException(status_code=404, detail="agent not connected")
+async def _tenant_max_rule_cost(tenant_id: str) -> Optional[float]:
+    db = await _db()
+    async with db.acquire() as conn:
+        row = await conn.fetchrow("SELECT max_rule_cost FROM tenant_rule_policies WHERE tenant_id = $1", tenant_id)
+    if row is not None:
+        return float(row["max_rule_cost"]) if row["max_rule_cost"] is not None else None
+    return RULE_PERF_MAX_COST if RULE_PERF_MAX_COST > 0 else None
+
+
+async def _rules_over_cost_policy(tenant_id: str, rule_text: str) -> Tuple[Optional[float], list[dict]]:
+    """The tenant's max_rule_cost and the rules of rule_text scoring above it."""
+    threshold = await _tenant_max_rule_cost(tenant_id)
+    if threshold is None:
+        return None, []
+    analysis = await asyncio.to_thread(_rule_performance, rule_text)
+    over = [
+        {"rule_name": r["rule_name"], "line": r["line"], "score": r["score"], "warnings": r["warnings"]}
+        for r in analysis["rules"]
+        if r["score"] > threshold
+    ]
+    return threshold, over
+
+
+async def _enforce_rule_cost_policy(tenant_id: str, rule_text: str) -> None:
+    threshold, over = await _rules_over_cost_policy(tenant_id, rule_text)
+    if over:
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "rule exceeds the tenant performance threshold", "max_rule_cost": threshold, "rules": over},
+        )
 
-    requested_tenant = _tenant_for_request(user, payload.get("tenant_id"))
-    state = agent_state.get(agent_id) or {}
-    agent_tenant = (state.get("tenant_id") or "default").strip()
-    if requested_tenant != agent_tenant:
-        raise HTTPException(status_code=403, detail="agent tenant mismatch")
 
-    job_id = payload.get("id") or str(uuid.uuid4())
-    policy_version = (payload.get("policy_version") or job_id).strip()
-    rule_hash = hashlib.sha256(rule_text.encode("utf-8")).hexdigest()
-    encoded = base64.b64encode(rule_text.encode("utf-8")).decode("ascii")
-    msg = {"type": "rule.push", "id": job_id, "payload": encoded}
-    await _create_command_job(
-        job_id=job_id,
-        tenant_id=requested_tenant,
-        agent_id=agent_id,
-        command_type="rule.push",
-        payload={"policy_version": policy_version, "rule_hash": rule_hash},
-    )
+async def _stored_agent_tenant(agent_id: str) -> str:
+    db = await _db()
+    async with db.acquire() as conn:
+        tenant = await conn.fetchval("SELECT tenant_id FROM agents_control_state WHERE agent_id = $1", agent_id)
+    return (tenant or "default").strip()
+
 
-    # send to agent
-    await ws.send_text(json.dumps(msg))
+async def _send_job_to_agent(
+    agent_id: str,
+    job_id: str,
+    message_text: str,
+    owner_replica: Optional[str] = None,
+) -> asyncio.Future:
+    ws = agents.get(agent_id)
+    if ws is None and owner_replica is None:
+        owner_replica = (await _remote_agent_owners([agent_id])).get(agent_id)
+    if ws is None and owner_replica is None:
+        await _update_command_job(
+            job_id=job_id,
+            status_value="failed",
+            error_text="agent not connected",
+            mark_completed=True,
+        )
+        raise HTTPException(status_code=404, detail="agent not connected")
+    # register before sending so a fast reply cannot be missed
+    waiter = _register_job_waiter(job_id, agent_id)
+    try:
+        if ws is not None:
+            await ws.send_text(message_text)
+        else:
+            await _publish_replica_message(
+                owner_replica,
+                "agent.command",
+                {"job_id": job_id, "agent_id": agent_id, "message_text": message_text},
+            )
+    except (WebSocketDisconnect, RuntimeError, asyncpg.PostgresError, OSError):
+        _discard_job_waiter(job_id)
+        await _update_command_job(
+            job_id=job_id,
+            status_value="failed",
+            error_text="agent disconnected before dispatch",
+            mark_completed=True,
+        )
+        raise HTTPException(status_code=502, detail="agent disconnected before dispatch")
     await _update_command_job(job_id=job_id, status_value="sent", mark_started=True)
+    return waiter
 
-    # wait for compile result from agent queue
-    q = agent_queues.get(agent_id)
-    if q is None:
-        raise HTTPException(status_code=500, detail="internal queue missing")
 
+async def _finish_rule_push(
+    *,
+    job_id: str,
+    agent_id: str,
+    agent_tenant: str,
+    policy_version: str,
+    rule_hash: str,
+    waiter: asyncio.Future,
+    pinned: bool,
+) -> dict:
     try:
-        # wait up to 15s for response
-        resp = await asyncio.wait_for(_wait_for_job_result(q, job_id), timeout=15.0)
+        resp = await asyncio.wait_for(waiter, timeout=max(1.0, COMMAND_JOB_TIMEOUT_SECONDS))
     except asyncio.TimeoutError:
         await _update_command_job(
             job_id=job_id,
@@ -1495,6 +6334,16 @@ async def push_rule(payload: dict, user: dict = Depends(get_current_user)):
             mark_completed=True,
         )
         raise HTTPException(status_code=504, detail="agent did not respond in time")
+    except ConnectionError:
+        await _update_command_job(
+            job_id=job_id,
+            status_value="failed",
+            error_text="agent disconnected before responding",
+            mark_completed=True,
+        )
+        raise HTTPException(status_code=502, detail="agent disconnected before responding")
+    finally:
+        _discard_job_waiter(job_id)
 
     success = bool(resp.get("success"))
     await _update_command_job(
@@ -1504,23 +6353,590 @@ async def push_rule(payload: dict, user: dict = Depends(get_current_user)):
         error_text=None if success else str(resp.get("diagnostics") or "compile failed"),
         mark_completed=True,
     )
-    await _upsert_agent_control_state(
+    _queue_agent_control_state(
         agent_id,
         tenant_id=agent_tenant,
         policy_version=policy_version,
         policy_hash=rule_hash,
         last_policy_result="success" if success else "failed",
+        policy_pinned=pinned,
+    )
+    state = agent_state.get(agent_id)
+    if state is not None:
+        state["policy_hash"] = rule_hash
+        state["last_policy_result"] = "success" if success else "failed"
+        state["policy_pinned"] = pinned
+    return resp
+
+
+async def _finish_rule_push_in_background(**kwargs: Any) -> None:
+    try:
+        await _finish_rule_push(**kwargs)
+    except HTTPException:
+        # Already recorded on the command job; pollers pick it up from there.
+        pass
+    except Exception:
+        logger.exception("async rule push %s failed", kwargs.get("job_id"))
+
+
+@app.post("/push_rule")
+async def push_rule(payload: dict, user: dict = Depends(get_current_user)):
+    """Push a rule to an agent and wait for compile result.
+
+    JSON body: { "agent_id": "...", "id": "optional-job-id", "rule_text": "...", "async": false }
+
+    With "bundle": true (and no rule_text) the tenant's current ruleset bundle is pushed and
+    its version becomes the job's policy_version.
+
+    With "async": true the job is dispatched and 202 is returned right away; follow it
+    via GET /jobs/{id} (optionally long-polling with ?wait=) or GET /jobs/{id}/events.
+    """
+    agent_id = payload.get("agent_id")
+    rule_text = payload.get("rule_text")
+    use_bundle = not rule_text and _is_truthy(payload.get("bundle"))
+    if not agent_id or not (rule_text or use_bundle):
+        raise HTTPException(status_code=400, detail="missing agent_id or rule_text")
+
+    owner_replica: Optional[str] = None
+    if agent_id in agents:
+        state = agent_state.get(agent_id) or {}
+        agent_tenant = (state.get("tenant_id") or "default").strip()
+    else:
+        owner_replica = (await _remote_agent_owners([agent_id])).get(agent_id)
+        if owner_replica is None:
+            raise HTTPException(status_code=404, detail="agent not connected")
+        agent_tenant = await _stored_agent_tenant(agent_id)
+
+    requested_tenant = _tenant_for_request(user, payload.get("tenant_id"))
+    if requested_tenant != agent_tenant:
+        raise HTTPException(status_code=403, detail="agent tenant mismatch")
+
+    job_id = payload.get("id") or str(uuid.uuid4())
+    if job_id in job_waiters:
+        raise HTTPException(status_code=409, detail="job id already in flight")
+    default_version = job_id
+    if use_bundle:
+        bundle = await _get_tenant_bundle(agent_tenant)
+        rule_text = bundle["content"]
+        default_version = bundle["version"]
+    await _enforce_rule_cost_policy(agent_tenant, rule_text)
+    policy_version = (payload.get("policy_version") or default_version).strip()
+    rule_hash = hashlib.sha256(rule_text.encode("utf-8")).hexdigest()
+    encoded = base64.b64encode(rule_text.encode("utf-8")).decode("ascii")
+    if owner_replica is None:
+        capabilities = (agent_state.get(agent_id) or {}).get("capabilities") or {}
+    else:
+        capabilities = await _stored_agent_capabilities(agent_id)
+    compiled = None
+    if _is_truthy(capabilities.get("compiled_rules")):
+        compiled = await _get_compiled_ruleset(agent_tenant, rule_text)
+    msg = _rule_push_message(job_id, encoded, capabilities, compiled)
+    await _create_command_job(
+        job_id=job_id,
+        tenant_id=requested_tenant,
+        agent_id=agent_id,
+        command_type="rule.push",
+        payload={"policy_version": policy_version, "rule_hash": rule_hash, "format": msg.get("format", "source")},
     )
 
+    waiter = await _send_job_to_agent(agent_id, job_id, json.dumps(msg), owner_replica=owner_replica)
+
+    finish_kwargs = {
+        "job_id": job_id,
+        "agent_id": agent_id,
+        "agent_tenant": agent_tenant,
+        "policy_version": policy_version,
+        "rule_hash": rule_hash,
+        "waiter": waiter,
+        # A hand-pushed rule is kept on the agent; pushing the bundle hands it back to the reconciler.
+        "pinned": not use_bundle,
+    }
+    if _is_truthy(payload.get("async")):
+        _spawn_background(_finish_rule_push_in_background(**finish_kwargs))
+        return JSONResponse(
+            {
+                "job_id": job_id,
+                "status": "sent",
+                "status_url": f"/jobs/{job_id}",
+                "events_url": f"/jobs/{job_id}/events",
+            },
+            status_code=202,
+        )
+
+    resp = await _finish_rule_push(**finish_kwargs)
     return JSONResponse(resp)
 
 
-async def _wait_for_job_result(q: asyncio.Queue, job_id: str):
+async def _resolve_bulk_targets(tenant_id: str, payload: dict) -> list[str]:
+    explicit_ids = payload.get("agent_ids")
+    if explicit_ids is not None:
+        if not isinstance(explicit_ids, list):
+            raise HTTPException(status_code=400, detail="agent_ids must be a list")
+        wanted = [str(aid).strip() for aid in explicit_ids if str(aid).strip()]
+    else:
+        wanted = None
+    filters = payload.get("filter") or {}
+    if not isinstance(filters, dict):
+        raise HTTPException(status_code=400, detail="filter must be an object")
+    capabilities = filters.get("capabilities")
+    if capabilities is not None and not isinstance(capabilities, dict):
+        raise HTTPException(status_code=400, detail="filter.capabilities must be an object")
+
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT agent_id
+            FROM agents_control_state
+            WHERE tenant_id = $1
+              AND ($2::text[] IS NULL OR agent_id = ANY($2::text[]))
+              AND ($3::text IS NULL OR runtime_kind = $3)
+              AND ($4::text IS NULL OR status = $4)
+              AND ($5::jsonb IS NULL OR capabilities_json @> $5::jsonb)
+            ORDER BY agent_id
+            LIMIT $6
+            """,
+            tenant_id,
+            wanted,
+            (str(filters.get("runtime_kind") or "").strip().lower() or None),
+            (str(filters.get("status") or "").strip().lower() or None),
+            json.dumps(capabilities) if capabilities else None,
+            max(1, BULK_PUSH_MAX_TARGETS),
+        )
+    return [str(r["agent_id"]) for r in rows]
+
+
+async def _run_bulk_rule_push(
+    *,
+    targets: list[tuple[str, str]],
+    tenant_id: str,
+    encoded_source: str,
+    compiled: Optional[dict],
+    policy_version: str,
+    rule_hash: str,
+    pinned: bool,
+    concurrency: int,
+    remote_owners: Dict[str, str],
+    results: asyncio.Queue,
+) -> None:
+    window = asyncio.Semaphore(concurrency)
+
+    async def _push_one(agent_id: str, job_id: str) -> None:
+        async with window:
+            result: Dict[str, Any] = {"type": "result", "agent_id": agent_id, "job_id": job_id}
+            try:
+                owner_replica = remote_owners.get(agent_id)
+                if owner_replica is None:
+                    capabilities = (agent_state.get(agent_id) or {}).get("capabilities") or {}
+                else:
+                    capabilities = await _stored_agent_capabilities(agent_id)
+                waiter = await _send_job_to_agent(
+                    agent_id,
+                    job_id,
+                    json.dumps(_rule_push_message(job_id, encoded_source, capabilities, compiled)),
+                    owner_replica=owner_replica,
+                )
+                resp = await _finish_rule_push(
+                    job_id=job_id,
+                    agent_id=agent_id,
+                    agent_tenant=tenant_id,
+                    policy_version=policy_version,
+                    rule_hash=rule_hash,
+                    waiter=waiter,
+                    pinned=pinned,
+                )
+                result["status"] = "completed" if resp.get("success") else "failed"
+                result["response"] = resp
+            except HTTPException as exc:
+                result["status"] = "timeout" if exc.status_code == 504 else "failed"
+                result["error"] = str(exc.detail)
+            except Exception as exc:
+                logger.exception("bulk rule push to %s failed", agent_id)
+                result["status"] = "failed"
+                result["error"] = str(exc)
+            await results.put(result)
+
+    try:
+        await asyncio.gather(*(_push_one(agent_id, job_id) for agent_id, job_id in targets))
+    finally:
+        await results.put(None)
+
+
+@app.post("/push_rule/bulk")
+async def push_rule_bulk(payload: dict, user: dict = Depends(get_current_user)) -> StreamingResponse:
+    """Push one rule to many agents and stream per-agent results as they arrive.
+
+    JSON body: { "rule_text": "...", "agent_ids": [...] | "filter": {"runtime_kind", "status",
+    "capabilities"}, "concurrency": 32, "format": "ndjson" | "sse" }
+
+    "bundle": true in place of rule_text rolls out the tenant's current ruleset bundle.
+
+    Without agent_ids or filter every agent of the tenant is targeted. Agents without a
+    live websocket on any orchestrator replica are reported as skipped.
+    """
+    rule_text = payload.get("rule_text")
+    use_bundle = not rule_text and _is_truthy(payload.get("bundle"))
+    if not rule_text and not use_bundle:
+        raise HTTPException(status_code=400, detail="missing rule_text")
+    tenant_id = _tenant_for_request(user, payload.get("tenant_id"))
+    stream_format = str(payload.get("format") or "ndjson").strip().lower()
+    if stream_format not in {"ndjson", "sse"}:
+        raise HTTPException(status_code=400, detail="format must be ndjson or sse")
+    try:
+        concurrency = int(payload.get("concurrency") or BULK_PUSH_DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="concurrency must be an integer")
+    concurrency = max(1, min(concurrency, max(1, BULK_PUSH_MAX_CONCURRENCY)))
+
+    candidates = await _resolve_bulk_targets(tenant_id, payload)
+    remote_owners = await _remote_agent_owners([aid for aid in candidates if aid not in agents])
+    live: list[str] = []
+    skipped: list[str] = []
+    for agent_id in candidates:
+        state = agent_state.get(agent_id) or {}
+        if agent_id in agents and (state.get("tenant_id") or "default").strip() == tenant_id:
+            live.append(agent_id)
+        elif agent_id in remote_owners:
+            # _resolve_bulk_targets already matched the stored tenant.
+            live.append(agent_id)
+        else:
+            skipped.append(agent_id)
+
+    bulk_id = str(uuid.uuid4())
+    default_version = bulk_id
+    if use_bundle:
+        bundle = await _get_tenant_bundle(tenant_id)
+        rule_text = bundle["content"]
+        default_version = bundle["version"]
+    await _enforce_rule_cost_policy(tenant_id, rule_text)
+    policy_version = (payload.get("policy_version") or default_version).strip()
+    rule_hash = hashlib.sha256(rule_text.encode("utf-8")).hexdigest()
+    encoded = base64.b64encode(rule_text.encode("utf-8")).decode("ascii")
+    targets = [(agent_id, str(uuid.uuid4())) for agent_id in live]
+    # Compiled once for the whole rollout; agents on another YARA version get source.
+    compiled = await _get_compiled_ruleset(tenant_id, rule_text) if targets else None
+    job_payload = {"policy_version": policy_version, "rule_hash": rule_hash, "bulk_id": bulk_id}
+    await _create_command_jobs_batch(
+        tenant_id=tenant_id,
+        command_type="rule.push",
+        jobs=[(job_id, agent_id, job_payload) for agent_id, job_id in targets],
+    )
+
+    results: asyncio.Queue = asyncio.Queue()
+    # Runs independently of the response so pushes finish even if the client goes away.
+    _spawn_background(
+        _run_bulk_rule_push(
+            targets=targets,
+            tenant_id=tenant_id,
+            encoded_source=encoded,
+            compiled=compiled,
+            policy_version=policy_version,
+            rule_hash=rule_hash,
+            pinned=not use_bundle,
+            concurrency=concurrency,
+            remote_owners=remote_owners,
+            results=results,
+        )
+    )
+
+    def _frame(item: dict) -> str:
+        if stream_format == "sse":
+            return f"event: {item['type']}\ndata: {json.dumps(item)}\n\n"
+        return json.dumps(item) + "\n"
+
+    async def _stream():
+        counts = {"completed": 0, "failed": 0, "timeout": 0, "skipped": len(skipped)}
+        yield _frame(
+            {
+                "type": "started",
+                "bulk_id": bulk_id,
+                "tenant_id": tenant_id,
+                "targets": len(targets),
+                "skipped": len(skipped),
+                "concurrency": concurrency,
+            }
+        )
+        for agent_id in skipped:
+            yield _frame({"type": "result", "agent_id": agent_id, "job_id": None, "status": "skipped", "error": "agent not connected"})
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+            yield _frame(item)
+        yield _frame({"type": "summary", "bulk_id": bulk_id, "total": len(candidates), **counts})
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream" if stream_format == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _on_rules_changed(tenant_id: str) -> None:
+    _rule_index_wakeup.set()
+    _request_policy_reconcile(tenant_id=tenant_id)
+
+
+def _request_policy_reconcile(*, agent_id: Optional[str] = None, tenant_id: Optional[str] = None) -> None:
+    if not POLICY_RECONCILE_ENABLED:
+        return
+    if agent_id:
+        _policy_reconcile_agents.add(agent_id)
+    if tenant_id:
+        _policy_reconcile_tenants.add(tenant_id)
+    _policy_reconcile_wakeup.set()
+
+
+def _policy_retry_delay(failures: int) -> float:
+    delay = max(0.0, POLICY_RECONCILE_RETRY_BASE_SECONDS) * (2 ** max(0, failures - 1))
+    return min(delay, max(0.0, POLICY_RECONCILE_RETRY_MAX_SECONDS))
+
+
+async def _load_stored_policy_state(agent_ids: list[str]) -> None:
+    # Agents connect without their applied policy in memory; fetch it once per connection.
+    missing = [aid for aid in agent_ids if aid in agent_state and "policy_hash" not in agent_state[aid]]
+    if not missing:
+        return
+    db = await _db()
+    async with db.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT agent_id, policy_hash, last_policy_result, policy_pinned
+            FROM agents_control_state
+            WHERE agent_id = ANY($1::text[])
+            """,
+            missing,
+        )
+    stored = {r["agent_id"]: r for r in rows}
+    for aid in missing:
+        state = agent_state.get(aid)
+        if state is None:
+            continue
+        row = stored.get(aid)
+        state["policy_hash"] = row["policy_hash"] if row else None
+        state["last_policy_result"] = row["last_policy_result"] if row else None
+        state["policy_pinned"] = bool(row["policy_pinned"]) if row else False
+
+
+async def _reconcile_agent_policy(
+    *,
+    agent_id: str,
+    tenant_id: str,
+    bundle: Dict[str, Any],
+    encoded_source: str,
+    compiled: Optional[dict],
+    slots: asyncio.Semaphore,
+) -> None:
+    success = False
+    try:
+        job_id = str(uuid.uuid4())
+        capabilities = (agent_state.get(agent_id) or {}).get("capabilities") or {}
+        msg = _rule_push_message(job_id, encoded_source, capabilities, compiled)
+        await _create_command_job(
+            job_id=job_id,
+            tenant_id=tenant_id,
+            agent_id=agent_id,
+            command_type="rule.push",
+            payload={
+                "policy_version": bundle["version"],
+                "rule_hash": bundle["sha256"],
+                "format": msg.get("format", "source"),
+                "reconcile": True,
+            },
+        )
+        waiter = await _send_job_to_agent(agent_id, job_id, json.dumps(msg))
+        resp = await _finish_rule_push(
+            job_id=job_id,
+            agent_id=agent_id,
+            agent_tenant=tenant_id,
+            policy_version=bundle["version"],
+            rule_hash=bundle["sha256"],
+            waiter=waiter,
+            pinned=False,
+        )
+        success = bool(resp.get("success"))
+    except HTTPException as exc:
+        logger.info("policy reconcile push to %s failed: %s", agent_id, exc.detail)
+    except Exception:
+        logger.exception("policy reconcile push to %s failed", agent_id)
+    finally:
+        _policy_reconcile_in_flight.discard(agent_id)
+        slots.release()
+    if success:
+        _policy_reconcile_backoff.pop(agent_id, None)
+        return
+    failures = _policy_reconcile_backoff.get(agent_id, (0, 0.0))[0] + 1
+    _policy_reconcile_backoff[agent_id] = (failures, asyncio.get_running_loop().time() + _policy_retry_delay(failures))
+
+
+async def _reconcile_policies(agent_ids: list[str], slots: asyncio.Semaphore) -> int:
+    """Push the tenant bundle to the given local agents whose applied policy drifted from it."""
+    await _load_stored_policy_state(agent_ids)
+    now = asyncio.get_running_loop().time()
+    by_tenant: Dict[str, list[str]] = {}
+    for agent_id in agent_ids:
+        state = agent_state.get(agent_id)
+        if agent_id not in agents or state is None or not state.get("tenant_id"):
+            continue
+        if state.get("policy_pinned"):
+            # Manually pushed policy; left alone until the tenant bundle is pushed to it again.
+            continue
+        if agent_id in _policy_reconcile_in_flight:
+            continue
+        if _policy_reconcile_backoff.get(agent_id, (0, 0.0))[1] > now:
+            continue
+        by_tenant.setdefault(state["tenant_id"], []).append(agent_id)
+
+    pace = 1.0 / POLICY_RECONCILE_PUSHES_PER_SECOND if POLICY_RECONCILE_PUSHES_PER_SECOND > 0 else 0.0
+    dispatched = 0
+    for tenant_id, tenant_agents in by_tenant.items():
+        try:
+            bundle = await _get_tenant_bundle(tenant_id)
+        except HTTPException as exc:
+            if exc.status_code != 404:
+                logger.warning("policy reconcile skipped tenant %s: %s", tenant_id, exc.detail)
+            continue
+        # Same threshold as manual pushes; a bundle over it is not rolled out by the reconciler.
+        threshold, over = await _rules_over_cost_policy(tenant_id, bundle["content"])
+        if over:
+            if _policy_reconcile_blocked.get(tenant_id) != bundle["version"]:
+                _policy_reconcile_blocked[tenant_id] = bundle["version"]
+                logger.warning(
+                    "policy reconcile held back bundle %s of tenant %s: %s exceed max_rule_cost %s",
+                    bundle["version"],
+                    tenant_id,
+                    ", ".join(f"{r['rule_name']} ({r['score']})" for r in over),
+                    threshold,
+                )
+            continue
+        _policy_reconcile_blocked.pop(tenant_id, None)
+        drifted = [
+            aid
+            for aid in tenant_agents
+            if (agent_state.get(aid) or {}).get("policy_hash") != bundle["sha256"]
+            or (agent_state.get(aid) or {}).get("last_policy_result") != "success"
+        ]
+        if not drifted:
+            continue
+        compiled = None
+        if any(_is_truthy(((agent_state.get(aid) or {}).get("capabilities") or {}).get("compiled_rules")) for aid in drifted):
+            compiled = await _get_compiled_ruleset(tenant_id, bundle["content"], sha256_hex=bundle["sha256"])
+        encoded = base64.b64encode(bundle["content"].encode("utf-8")).decode("ascii")
+        for agent_id in drifted:
+            await slots.acquire()
+            if agent_id not in agents or agent_id in _policy_reconcile_in_flight:
+                slots.release()
+                continue
+            _policy_reconcile_in_flight.add(agent_id)
+            _spawn_background(
+                _reconcile_agent_policy(
+                    agent_id=agent_id,
+                    tenant_id=tenant_id,
+                    bundle=bundle,
+                    encoded_source=encoded,
+                    compiled=compiled,
+                    slots=slots,
+                )
+            )
+            dispatched += 1
+            if pace:
+                await asyncio.sleep(pace)
+    return dispatched
+
+
+async def _policy_reconcile_loop() -> None:
+    slots = asyncio.Semaphore(max(1, POLICY_RECONCILE_MAX_IN_FLIGHT))
     while True:
-        msg = await q.get()
-        # expect agent message with type 'rule.compile.result' and matching id
+        sweep = False
+        try:
+            await asyncio.wait_for(_policy_reconcile_wakeup.wait(), timeout=max(1.0, POLICY_RECONCILE_INTERVAL_SECONDS))
+        except asyncio.TimeoutError:
+            # Periodic sweep: retries whose backoff expired and rule edits made on other replicas.
+            sweep = True
+        _policy_reconcile_wakeup.clear()
+        wanted_agents = set(_policy_reconcile_agents)
+        wanted_tenants = set(_policy_reconcile_tenants)
+        _policy_reconcile_agents.clear()
+        _policy_reconcile_tenants.clear()
+        if sweep:
+            candidates = list(agents)
+        else:
+            candidates = [
+                aid
+                for aid in agents
+                if aid in wanted_agents or (agent_state.get(aid) or {}).get("tenant_id") in wanted_tenants
+            ]
+        for aid in [aid for aid in _policy_reconcile_backoff if aid not in agents]:
+            if _policy_reconcile_backoff[aid][1] < asyncio.get_running_loop().time():
+                _policy_reconcile_backoff.pop(aid, None)
+        if not candidates:
+            continue
         try:
-            if msg.get("type") == "rule.compile.result" and msg.get("id") == job_id:
-                return msg
+            dispatched = await _reconcile_policies(candidates, slots)
+            if dispatched > 0:
+                logger.info("policy reconcile pushed tenant bundles to %d drifted agents", dispatched)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("policy reconcile pass failed")
+
+
+async def _load_job_for_user(job_id: str, user: dict) -> asyncpg.Record:
+    row = await _get_command_job(job_id)
+    if row is None or row["tenant_id"] != _tenant_for_request(user, None):
+        raise HTTPException(status_code=404, detail="job not found")
+    return row
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0, user: dict = Depends(get_current_user)) -> JSONResponse:
+    row = await _load_job_for_user(job_id, user)
+    if wait <= 0 or row["status"] in TERMINAL_JOB_STATUSES:
+        return JSONResponse(_command_job_to_dict(row))
+
+    # Long-poll: subscribe first, then re-read so a transition in between is not lost.
+    q = _subscribe_job(job_id)
+    try:
+        row = await _load_job_for_user(job_id, user)
+        job = _command_job_to_dict(row)
+        deadline = asyncio.get_running_loop().time() + min(wait, max(1.0, JOB_LONG_POLL_MAX_SECONDS))
+        while job["status"] not in TERMINAL_JOB_STATUSES:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(q.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+    finally:
+        _unsubscribe_job(job_id, q)
+    return JSONResponse(job)
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, user: dict = Depends(get_current_user)) -> StreamingResponse:
+    await _load_job_for_user(job_id, user)
+    q = _subscribe_job(job_id)
+
+    async def _events():
+        try:
+            row = await _get_command_job(job_id)
+            job = _command_job_to_dict(row) if row is not None else None
+            if job is not None:
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            while job is not None and job["status"] not in TERMINAL_JOB_STATUSES:
+                try:
+                    job = await asyncio.wait_for(q.get(), timeout=max(1.0, JOB_EVENTS_KEEPALIVE_SECONDS))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
         finally:
-            q.task_done()
+            _unsubscribe_job(job_id, q)
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,518 @@
+"""N-gram prefilter index over a local sample corpus, used to narrow retro-hunts.
+
+The index maps every distinct byte n-gram (3 or 4 bytes) of each sample to the
+samples containing it. It is built offline and updated incrementally:
+
+    python ngram_index.py update --corpus /samples --index /samples-index [--gram 3] [--workers 4]
+    python ngram_index.py compact --index /samples-index
+    python ngram_index.py stats --index /samples-index
+
+Layout of an index directory:
+
+- ``manifest.json``: gram size, corpus path, live samples (id -> [relpath, size, mtime_ns]),
+  samples skipped as too large, and the list of segment files. Replaced atomically.
+- ``seg-*.ngs``: immutable segments, each covering the samples added by one update
+  batch. Little-endian: 16-byte header (magic, version, gram, key count), sorted uint32
+  gram keys, uint64 posting offsets (key count + 1), then uint32 sample ids. Readers
+  mmap segments and binary-search the key array without loading it.
+
+Changed or removed samples are dropped from the manifest; their ids stay in old
+segments until ``compact`` rewrites everything into one segment.
+"""
+import argparse
+import array
+import bisect
+import fcntl
+import heapq
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Iterator, Optional
+
+MANIFEST = "manifest.json"
+_LOCK = ".lock"
+_MAGIC = b"YNGS"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHQ")
+_SEGMENT_MAX_POSTINGS = 20_000_000
+_AUTO_COMPACT_SEGMENTS = 16
+_GRAM_CHUNK = 1 << 20  # window positions per pass in file_grams
+_BIT_PLANES = [bytes(value >> bit & 1 for value in range(256)) for bit in range(8)]
+
+if sys.byteorder != "little":
+    raise ImportError("ngram_index segments are little-endian and read through native memoryviews")
+
+
+def _windows(view: memoryview, start: int, stop: int, gram: int) -> array.array:
+    """Big-endian keys of the grams starting at offsets [start, stop) of view."""
+    count = min(stop, len(view) - gram + 1) - start
+    # Each gram lands right-aligned in a 4-byte slot; strided copies keep the loop in C.
+    slots = bytearray(4 * count)
+    for i in range(gram):
+        slots[4 - gram + i::4] = view[start + i:start + i + count]
+    keys = array.array("I")
+    keys.frombytes(slots)
+    keys.byteswap()
+    return keys
+
+
+def _grams3(view: memoryview) -> array.array:
+    # One bit per possible 3-gram: 2 MB regardless of file size.
+    bitmap = bytearray(1 << 21)
+    for start in range(0, len(view) - 2, _GRAM_CHUNK):
+        for key in set(_windows(view, start, start + _GRAM_CHUNK, 3)):
+            bitmap[key >> 3] |= 1 << (key & 7)
+    # Expand to one 0/1 byte per key (bit b of byte i is key 8 * i + b) and keep the set ones.
+    flags = bytearray(1 << 24)
+    for bit in range(8):
+        flags[bit::8] = bitmap.translate(_BIT_PLANES[bit])
+    return array.array("I", itertools.compress(range(1 << 24), flags))
+
+
+def _grams4(view: memoryview) -> array.array:
+    # Sorted distinct keys per chunk, merged one top byte at a time to bound the working set.
+    runs = [
+        array.array("I", sorted(set(_windows(view, start, start + _GRAM_CHUNK, 4))))
+        for start in range(0, len(view) - 3, _GRAM_CHUNK)
+    ]
+    if len(runs) == 1:
+        return runs[0]
+    keys = array.array("I")
+    for top in range(256):
+        low, high = top << 24, (top + 1) << 24
+        part: set = set()
+        for run in runs:
+            part.update(run[bisect.bisect_left(run, low):bisect.bisect_left(run, high)])
+        keys.extend(sorted(part))
+    return keys
+
+
+def file_grams(path: str, gram: int, max_bytes: int) -> Optional[array.array]:
+    """Sorted distinct n-grams of one file as big-endian integers, or None when it is too large."""
+    if gram not in (3, 4):
+        raise ValueError("gram must be 3 or 4")
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if max_bytes and size > max_bytes:
+            return None
+        if size < gram:
+            return array.array("I")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return _grams3(view) if gram == 3 else _grams4(view)
+            finally:
+                view.release()
+
+
+def _align8(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _write_segment_file(path: str, gram: int, keys: array.array, offsets: array.array, postings_src) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, gram, len(keys)))
+        keys.tofile(f)
+        f.write(b"\0" * (_align8(f.tell()) - f.tell()))
+        offsets.tofile(f)
+        if isinstance(postings_src, dict):
+            for key in keys:
+                postings_src[key].tofile(f)
+        else:
+            postings_src.seek(0)
+            shutil.copyfileobj(postings_src, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _write_segment(path: str, gram: int, postings: dict) -> None:
+    keys = array.array("I", sorted(postings))
+    offsets = array.array("Q", [0])
+    total = 0
+    for key in keys:
+        total += len(postings[key])
+        offsets.append(total)
+    _write_segment_file(path, gram, keys, offsets, postings)
+
+
+class _Segment:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.gram, count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{path} is not an n-gram index segment")
+        keys_end = _HEADER.size + 4 * count
+        offsets_start = _align8(keys_end)
+        offsets_end = offsets_start + 8 * (count + 1)
+        view = memoryview(self._mm)
+        self.keys = view[_HEADER.size:keys_end].cast("I")
+        self.offsets = view[offsets_start:offsets_end].cast("Q")
+        self.postings = view[offsets_end:].cast("I")
+
+    def lookup(self, key: int) -> memoryview:
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.postings[self.offsets[i]:self.offsets[i + 1]]
+        return self.postings[0:0]
+
+    def iter_keys(self, tag: int) -> Iterator[tuple]:
+        for i, key in enumerate(self.keys):
+            yield key, tag, i
+
+    def close(self) -> None:
+        for view in (self.keys, self.offsets, self.postings):
+            view.release()
+        self._mm.close()
+        self._file.close()
+
+
+def _load_manifest(index_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(index_dir, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_manifest(index_dir: str, manifest: dict) -> None:
+    fd, tmp = tempfile.mkstemp(prefix=".manifest-", dir=index_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(index_dir, MANIFEST))
+
+
+class NgramIndex:
+    """Read side: answers which samples can contain a set of literals."""
+
+    def __init__(self, index_dir: str):
+        manifest = _load_manifest(index_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"no n-gram index in {index_dir}")
+        self.gram = int(manifest["gram"])
+        self.corpus = manifest["corpus"]
+        self.files = {int(k): v for k, v in manifest["files"].items()}
+        self._by_path = {v[0]: v for v in self.files.values()}
+        self._segments = [_Segment(os.path.join(index_dir, name)) for name in manifest["segments"]]
+
+    def entry(self, relpath: str) -> Optional[list]:
+        """[relpath, size, mtime_ns] of an indexed sample, or None when it is not covered."""
+        return self._by_path.get(relpath)
+
+    def _gram_ids(self, key: int) -> set:
+        ids: set = set()
+        for segment in self._segments:
+            ids.update(segment.lookup(key))
+        return ids
+
+    def _literal(self, data: bytes, nocase: bool) -> Optional[set]:
+        if len(data) < self.gram:
+            return None
+        windows = {data[i:i + self.gram] for i in range(len(data) - self.gram + 1)}
+        groups = []
+        for window in windows:
+            variants = {window}
+            if nocase:
+                for i, b in enumerate(window):
+                    if 0x41 <= b <= 0x5A or 0x61 <= b <= 0x7A:
+                        variants |= {v[:i] + bytes([v[i] ^ 0x20]) + v[i + 1:] for v in variants}
+            groups.append([int.from_bytes(v, "big") for v in variants])
+        sized = []
+        for keys in groups:
+            ids: set = set()
+            for key in keys:
+                ids |= self._gram_ids(key)
+            if not ids:
+                return set()
+            sized.append(ids)
+        sized.sort(key=len)
+        result = sized[0]
+        for ids in sized[1:]:
+            result = result & ids
+            if not result:
+                break
+        return result
+
+    def candidates(self, node) -> Optional[set]:
+        """Sample ids that may satisfy a query tree; None means the tree does not narrow anything.
+
+        Nodes: None (unconstrained), ("lit", bytes), ("nocase", bytes), ("and", [nodes]),
+        ("or", [nodes]).
+        """
+        if node is None:
+            return None
+        kind = node[0]
+        if kind in ("lit", "nocase"):
+            return self._literal(node[1], kind == "nocase")
+        if kind == "and":
+            result: Optional[set] = None
+            for child in node[1]:
+                ids = self.candidates(child)
+                if ids is None:
+                    continue
+                result = ids if result is None else result & ids
+                if not result:
+                    break
+            return result
+        if kind == "or":
+            result = set()
+            for child in node[1]:
+                ids = self.candidates(child)
+                if ids is None:
+                    return None
+                result |= ids
+            return result
+        raise ValueError(f"unknown query node {kind!r}")
+
+    def close(self) -> None:
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+
+def _scan_corpus(corpus_dir: str) -> dict:
+    found = {}
+    for root, dirs, names in os.walk(corpus_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if os.path.isfile(path) and not os.path.islink(path):
+                found[os.path.relpath(path, corpus_dir)] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+def _segment_name() -> str:
+    return f"seg-{time.time_ns():020d}.ngs"
+
+
+def compact_index(index_dir: str, *, locked: bool = False) -> dict:
+    """Merge all segments into one, dropping ids of samples no longer in the manifest."""
+    lock = None if locked else _acquire_lock(index_dir)
+    if lock is False:
+        return {"skipped": "another indexer holds the lock"}
+    try:
+        manifest = _load_manifest(index_dir)
+        if manifest is None or len(manifest["segments"]) == 0:
+            return {"segments": 0}
+        live = {int(k) for k in manifest["files"]}
+        segments = [_Segment(os.path.join(index_dir, name)) for name in manifest["segments"]]
+        keys = array.array("I")
+        offsets = array.array("Q", [0])
+        total = 0
+        try:
+            with tempfile.TemporaryFile(dir=index_dir) as postings:
+                merged = heapq.merge(*(segment.iter_keys(n) for n, segment in enumerate(segments)))
+                current_key, ids = None, set()
+
+                def _emit() -> None:
+                    nonlocal total
+                    if current_key is None or not ids:
+                        return
+                    out = array.array("I", sorted(ids))
+                    out.tofile(postings)
+                    keys.append(current_key)
+                    total += len(out)
+                    offsets.append(total)
+
+                for key, n, i in merged:
+                    if key != current_key:
+                        _emit()
+                        current_key, ids = key, set()
+                    segment = segments[n]
+                    ids.update(x for x in segment.postings[segment.offsets[i]:segment.offsets[i + 1]] if x in live)
+                _emit()
+                postings.flush()
+                name = _segment_name()
+                _write_segment_file(os.path.join(index_dir, name), int(manifest["gram"]), keys, offsets, postings)
+        finally:
+            for segment in segments:
+                segment.close()
+        old = manifest["segments"]
+        manifest["segments"] = [name]
+        _save_manifest(index_dir, manifest)
+        for stale in old:
+            try:
+                os.unlink(os.path.join(index_dir, stale))
+            except OSError:
+                pass
+        return {"segments": 1, "merged": len(old), "keys": len(keys), "postings": total}
+    finally:
+        if lock:
+            lock.close()
+
+
+def _acquire_lock(index_dir: str):
+    os.makedirs(index_dir, exist_ok=True)
+    handle = open(os.path.join(index_dir, _LOCK), "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.close()
+        return False
+    return handle
+
+
+def update_index(
+    corpus_dir: str,
+    index_dir: str,
+    *,
+    gram: int = 3,
+    workers: int = 4,
+    max_file_bytes: int = 32 * 1024 * 1024,
+    rebuild: bool = False,
+) -> dict:
+    """Index samples added or changed since the last run; returns counters.
+
+    Only one indexer runs per index directory (flock); a concurrent call returns at once.
+    """
+    if gram not in (3, 4):
+        raise ValueError("gram must be 3 or 4")
+    lock = _acquire_lock(index_dir)
+    if lock is False:
+        return {"skipped": "another indexer holds the lock"}
+    try:
+        corpus = os.path.realpath(corpus_dir)
+        manifest = None if rebuild else _load_manifest(index_dir)
+        if manifest is not None and (manifest["gram"] != gram or manifest["corpus"] != corpus):
+            raise ValueError("index was built with another gram size or corpus; run with --rebuild")
+        old_segments: list[str] = []
+        if manifest is None:
+            old_manifest = _load_manifest(index_dir)
+            old_segments = old_manifest["segments"] if old_manifest else []
+            manifest = {"version": _VERSION, "gram": gram, "corpus": corpus, "next_id": 0, "files": {}, "skipped": {}, "segments": []}
+
+        current = _scan_corpus(corpus)
+        removed = 0
+        for file_id, (relpath, size, mtime_ns) in list(manifest["files"].items()):
+            if current.get(relpath) != (size, mtime_ns):
+                del manifest["files"][file_id]
+                removed += 1
+        indexed = {v[0] for v in manifest["files"].values()}
+        skipped = {p: v for p, v in manifest["skipped"].items() if current.get(p) == tuple(v)}
+        todo = [p for p in current if p not in indexed and p not in skipped]
+
+        added = 0
+        postings: dict = {}
+        pending: dict = {}
+        pending_postings = 0
+
+        def _flush() -> None:
+            nonlocal postings, pending, pending_postings
+            if pending:
+                name = _segment_name()
+                _write_segment(os.path.join(index_dir, name), gram, postings)
+                manifest["segments"].append(name)
+                manifest["files"].update(pending)
+                manifest["skipped"] = skipped
+                _save_manifest(index_dir, manifest)
+            postings, pending, pending_postings = {}, {}, 0
+
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=get_context("spawn")) as pool:
+            paths = [os.path.join(corpus, p) for p in todo]
+            results = pool.map(file_grams, paths, [gram] * len(paths), [max_file_bytes] * len(paths), chunksize=16)
+            for relpath, grams in zip(todo, results):
+                size, mtime_ns = current[relpath]
+                if grams is None:
+                    skipped[relpath] = [size, mtime_ns]
+                    continue
+                file_id = manifest["next_id"]
+                manifest["next_id"] += 1
+                for key in grams:
+                    bucket = postings.get(key)
+                    if bucket is None:
+                        postings[key] = array.array("I", [file_id])
+                    else:
+                        bucket.append(file_id)
+                pending[str(file_id)] = [relpath, size, mtime_ns]
+                pending_postings += len(grams)
+                added += 1
+                if pending_postings >= _SEGMENT_MAX_POSTINGS:
+                    _flush()
+        _flush()
+        manifest["skipped"] = skipped
+        _save_manifest(index_dir, manifest)
+        for stale in old_segments:
+            try:
+                os.unlink(os.path.join(index_dir, stale))
+            except OSError:
+                pass
+        compacted = None
+        if removed or len(manifest["segments"]) > _AUTO_COMPACT_SEGMENTS:
+            compacted = compact_index(index_dir, locked=True)
+        return {
+            "added": added,
+            "removed": removed,
+            "skipped": len(skipped),
+            "files": len(manifest["files"]),
+            "segments": len(_load_manifest(index_dir)["segments"]),
+            "compacted": compacted is not None,
+        }
+    finally:
+        lock.close()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Build and maintain the retro-hunt n-gram prefilter index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    update = sub.add_parser("update", help="index samples added or changed since the last run")
+    update.add_argument("--corpus", default=os.getenv("RETROHUNT_CORPUS_DIR", ""))
+    update.add_argument("--index", default=os.getenv("RETROHUNT_INDEX_DIR", ""))
+    update.add_argument("--gram", type=int, default=int(os.getenv("RETROHUNT_INDEX_GRAM", "3")))
+    update.add_argument("--workers", type=int, default=4)
+    update.add_argument("--max-file-bytes", type=int, default=int(os.getenv("RETROHUNT_INDEX_MAX_FILE_BYTES", str(32 * 1024 * 1024))))
+    update.add_argument("--rebuild", action="store_true")
+    for name in ("compact", "stats"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("--index", default=os.getenv("RETROHUNT_INDEX_DIR", ""))
+    args = parser.parse_args(argv)
+    if not args.index:
+        parser.error("--index is required")
+
+    if args.command == "update":
+        if not args.corpus or not os.path.isdir(args.corpus):
+            parser.error("--corpus must be an existing directory")
+        result = update_index(
+            args.corpus,
+            args.index,
+            gram=args.gram,
+            workers=args.workers,
+            max_file_bytes=args.max_file_bytes,
+            rebuild=args.rebuild,
+        )
+    elif args.command == "compact":
+        result = compact_index(args.index)
+    else:
+        manifest = _load_manifest(args.index)
+        if manifest is None:
+            parser.error(f"no index in {args.index}")
+        result = {
+            "gram": manifest["gram"],
+            "corpus": manifest["corpus"],
+            "files": len(manifest["files"]),
+            "skipped": len(manifest["skipped"]),
+            "segments": len(manifest["segments"]),
+            "bytes": sum(os.path.getsize(os.path.join(args.index, s)) for s in manifest["segments"]),
+        }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
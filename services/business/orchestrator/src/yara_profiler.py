@@ -0,0 +1,193 @@
+"""Scan-time profiler for YARA rulesets against a local sample corpus.
+
+Used by the orchestrator's POST /yara/profile and runnable on its own:
+
+    python yara_profiler.py rules.yar [more.yar ...] --corpus /path/to/samples [--workers 4]
+
+Each worker process compiles the ruleset once, then scans memory-mapped corpus files
+and reports per-file scan time and matched rules. The parent aggregates per-rule match
+counts, total/p50/p95 scan time per file and throughput.
+"""
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Optional
+
+_rules = None
+
+
+def init_worker(source: str, memory_limit_bytes: int) -> None:
+    global _rules
+    if memory_limit_bytes > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+    import yara
+
+    _rules = yara.compile(source=source, includes=False)
+
+
+def scan_file(path: str, timeout_seconds: int) -> dict:
+    import yara
+
+    out = {"path": path, "size_bytes": 0, "seconds": 0.0, "rules": [], "error": None}
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            out["size_bytes"] = size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            try:
+                started = time.perf_counter()
+                matches = _rules.match(data=data, timeout=timeout_seconds)
+                out["seconds"] = time.perf_counter() - started
+            finally:
+                if size:
+                    data.close()
+        out["rules"] = [(m.rule, sum(len(s.instances) for s in m.strings)) for m in matches]
+    except yara.TimeoutError:
+        out["seconds"] = float(timeout_seconds)
+        out["error"] = "timeout"
+    except (OSError, ValueError, yara.Error) as exc:
+        out["error"] = str(exc)
+    return out
+
+
+def corpus_files(corpus_dir: str, max_files: int = 0, max_file_bytes: int = 0) -> list[str]:
+    files: list[str] = []
+    for root, dirs, names in os.walk(corpus_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            if max_file_bytes and os.path.getsize(path) > max_file_bytes:
+                continue
+            files.append(path)
+            if max_files and len(files) >= max_files:
+                return files
+    return files
+
+
+def corpus_fingerprint(files: list[str]) -> str:
+    """Identifies a corpus by its file list, sizes and mtimes, so stored profiles are comparable."""
+    digest = hashlib.sha256()
+    for path in files:
+        st = os.stat(path)
+        digest.update(f"{path}\0{st.st_size}\0{int(st.st_mtime)}\n".encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()[:16]
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Nearest-rank: the smallest value with at least pct% of the values at or below it.
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def profile_ruleset(
+    source: str,
+    files: list[str],
+    *,
+    workers: int = 4,
+    timeout_seconds: int = 30,
+    memory_limit_bytes: int = 0,
+    slowest: int = 10,
+    precompile: bool = True,
+) -> dict:
+    """Scan every file with the compiled ruleset and aggregate timings and match counts.
+
+    With precompile, raises yara.SyntaxError/yara.Error when the ruleset does not compile.
+    Callers that validated the ruleset already (the orchestrator) pass precompile=False so
+    the only compiles happen in the memory-limited workers.
+    """
+    if precompile:
+        import yara
+
+        # Fail fast (and with a clean error) before starting any workers.
+        yara.compile(source=source, includes=False)
+    rule_counts: dict[str, dict] = {}
+    results: list[dict] = []
+    started = time.perf_counter()
+    if files:
+        with ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            mp_context=get_context("spawn"),
+            initializer=init_worker,
+            initargs=(source, memory_limit_bytes),
+        ) as pool:
+            chunksize = max(1, len(files) // (max(1, workers) * 8))
+            for result in pool.map(scan_file, files, [timeout_seconds] * len(files), chunksize=chunksize):
+                results.append(result)
+                for rule, hits in result["rules"]:
+                    entry = rule_counts.setdefault(rule, {"rule": rule, "files_matched": 0, "string_matches": 0})
+                    entry["files_matched"] += 1
+                    entry["string_matches"] += hits
+    wall_seconds = time.perf_counter() - started
+
+    scanned = [r for r in results if r["error"] is None]
+    # A timed-out file cost at least the timeout, so it counts at that value in the timings;
+    # leaving it out would make the slowest rulesets look fastest.
+    times = [r["seconds"] for r in results if r["error"] in (None, "timeout")]
+    scan_seconds = sum(times)
+    scanned_bytes = sum(r["size_bytes"] for r in scanned)
+    completed_seconds = sum(r["seconds"] for r in scanned)
+    return {
+        "files": len(files),
+        "scanned": len(scanned),
+        "timeouts": sum(1 for r in results if r["error"] == "timeout"),
+        "errors": sum(1 for r in results if r["error"] not in (None, "timeout")),
+        "bytes": scanned_bytes,
+        "scan_seconds": round(scan_seconds, 6),
+        "wall_seconds": round(wall_seconds, 6),
+        "p50_seconds": round(_percentile(times, 50), 6),
+        "p95_seconds": round(_percentile(times, 95), 6),
+        "max_seconds": round(max(times, default=0.0), 6),
+        "bytes_per_second": round(scanned_bytes / completed_seconds) if completed_seconds > 0 else None,
+        "rules": sorted(rule_counts.values(), key=lambda r: (-r["files_matched"], r["rule"])),
+        "slowest_files": [
+            {"path": r["path"], "size_bytes": r["size_bytes"], "seconds": round(r["seconds"], 6), "error": r["error"]}
+            for r in sorted(results, key=lambda r: r["seconds"], reverse=True)[:slowest]
+        ],
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Profile YARA rule scan time against a local corpus")
+    parser.add_argument("rules", nargs="+", help="rule files; they are compiled together as one ruleset")
+    parser.add_argument("--corpus", default=os.getenv("RULE_PROFILE_CORPUS_DIR", ""), help="sample corpus directory")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("RULE_PROFILE_WORKERS", "4")))
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("RULE_PROFILE_FILE_TIMEOUT_SECONDS", "30")))
+    parser.add_argument("--max-files", type=int, default=0)
+    parser.add_argument("--max-file-bytes", type=int, default=0)
+    args = parser.parse_args(argv)
+    if not args.corpus or not os.path.isdir(args.corpus):
+        parser.error("--corpus must be an existing directory")
+
+    sources = []
+    for path in args.rules:
+        with open(path, "r", encoding="utf-8") as f:
+            sources.append(f.read().rstrip("\n") + "\n")
+    source = "".join(sources)
+    files = corpus_files(args.corpus, args.max_files, args.max_file_bytes)
+    try:
+        report = profile_ruleset(source, files, workers=args.workers, timeout_seconds=args.timeout)
+    except Exception as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 1
+    report["sha256"] = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    report["corpus"] = corpus_fingerprint(files)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
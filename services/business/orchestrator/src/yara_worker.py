@@ -0,0 +1,54 @@
+"""YARA compiler worker for the orchestrator's validation pool.
+
+Each worker is a long-lived child process that keeps yara-python loaded and
+answers compile requests over a pipe, so validation costs one in-memory
+compile instead of a yarac fork plus temp files.
+"""
+import re
+import resource
+from typing import Optional
+
+_LINE_RE = re.compile(r"line\s+(\d+)", flags=re.IGNORECASE)
+
+
+def _diagnostic(message: str) -> dict:
+    text = str(message).strip()
+    m = _LINE_RE.search(text)
+    return {"line": int(m.group(1)) if m else None, "message": text}
+
+
+def compile_source(source: str, externals: Optional[dict] = None) -> dict:
+    import yara
+
+    try:
+        rules = yara.compile(source=source, includes=False, externals=externals or None)
+    except yara.SyntaxError as exc:
+        return {"valid": False, "errors": [_diagnostic(exc)], "warnings": []}
+    except MemoryError:
+        return {"valid": False, "errors": [{"line": None, "message": "compiler memory limit exceeded"}], "warnings": []}
+    except yara.Error as exc:
+        return {"valid": False, "errors": [_diagnostic(exc)], "warnings": []}
+    return {
+        "valid": True,
+        "errors": [],
+        "warnings": [_diagnostic(w) for w in (getattr(rules, "warnings", None) or [])],
+        "rule_count": sum(1 for _ in rules),
+    }
+
+
+def serve(conn, memory_limit_bytes: int) -> None:
+    if memory_limit_bytes > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+    import yara  # noqa: F401  (loaded before the first request so it is not billed to it)
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        try:
+            conn.send(compile_source(request["source"], request.get("externals")))
+        except (BrokenPipeError, OSError):
+            return
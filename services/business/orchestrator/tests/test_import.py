@@ -0,0 +1,102 @@
+"""A damaged archive must never be reported as a successful (partial) import."""
+import asyncio
+import io
+import json
+import os
+import sys
+import tarfile
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import main  # noqa: E402
+
+
+class _Request:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def stream(self):
+        for i in range(0, len(self._body), 64 * 1024):
+            yield self._body[i:i + 64 * 1024]
+
+
+class _Written:
+    etag = '"etag"'
+    version_id = None
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    uploaded = []
+
+    async def _storage_call(fn, client, object_key, data, **kwargs):
+        uploaded.append(object_key)
+        return _Written()
+
+    async def _list_rule_metadata(tenant_id):
+        return {}
+
+    async def _record_imported_rules(tenant_id, actor, written):
+        return None
+
+    monkeypatch.setattr(main, "YARA_STORAGE_ENABLED", True)
+    monkeypatch.setattr(main, "_minio_client", lambda: object())
+    monkeypatch.setattr(main, "_storage_call", _storage_call)
+    monkeypatch.setattr(main, "_list_rule_metadata", _list_rule_metadata)
+    monkeypatch.setattr(main, "_record_imported_rules", _record_imported_rules)
+    monkeypatch.setattr(main, "_on_rules_changed", lambda tenant_id: None)
+    return uploaded
+
+
+def _rules(count: int) -> list:
+    # Incompressible bodies, so a cut in the compressed stream lands inside a later member.
+    return [
+        (f"r{i}.yar", f"rule r{i} {{ strings: $a = \"{os.urandom(96 * 1024).hex()}\" condition: $a }}\n".encode())
+        for i in range(count)
+    ]
+
+
+def _import(body: bytes):
+    try:
+        response = asyncio.run(main.import_yara_rules(_Request(body), overwrite=True, user={"sub": "test"}))
+    except HTTPException as exc:
+        return exc.status_code, None
+    return response.status_code, json.loads(response.body)
+
+
+def _assert_failed(status: int, result) -> None:
+    if status == 200:
+        assert result["ok"] is False
+        assert result["error"]
+    else:
+        assert status in (400, 500)
+
+
+def test_truncated_tar_gz_is_not_a_success(storage):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as archive:
+        for name, data in _rules(4):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    body = buf.getvalue()
+    _assert_failed(*_import(body[: len(body) * 2 // 3]))
+
+
+def test_corrupt_zip_entry_is_not_a_success(storage):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in _rules(3):
+            archive.writestr(name, data)
+    body = bytearray(buf.getvalue())
+    with zipfile.ZipFile(io.BytesIO(bytes(body))) as archive:
+        info = archive.infolist()[1]
+    # Garble the deflate stream of the second entry; its local header stays intact.
+    start = info.header_offset + 30 + len(info.filename.encode()) + len(info.extra)
+    for i in range(start + 16, start + 48):
+        body[i] = 0xFF
+    _assert_failed(*_import(bytes(body)))
@@ -0,0 +1,93 @@
+"""The retro-hunt prefilter must never drop a sample the rule actually matches."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+yara = pytest.importorskip("yara")
+
+import main  # noqa: E402
+import ngram_index  # noqa: E402
+
+SAMPLES = {
+    "foobar": b"xx foobar xx",
+    "fooxbar": b"xx fooxbar xx",
+    "foo-bracket-bar": b"xx foo]bar xx",
+    "foo-backslash-bar": b"xx foo\\bar xx",
+    "xyz-bar": b"xx xyz]bar xx",
+    "caf": b"le caf noir",
+    "caf-c3": b"le caf\xc3 noir",
+    "cafe": "le café noir".encode("utf-8"),
+    "cafeee": "le caféééx noir".encode("utf-8"),
+    "cafx": b"le cafx noir",
+    "upper": b"xx FOOZBAR xx",
+    "alt": b"xx de]gh xx",
+    "repeat": b"xx abbbbc xx",
+    "plain": b"nothing to see here at all",
+}
+
+PATTERNS = [
+    r"/foo[\]xyz]bar/",
+    r"/foo[^\]]bar/",
+    r"/foo[\\\]]bar/",
+    r"/fo[]o]o?bar/",
+    r"/FOO[\]xyz]BAR/i",
+    r"/abc|de[f\]]gh/",
+    r"/ab{2,}c/",
+    r"/x\x41?yz|foo/",
+    "/café*/",
+    "/café?x/",
+    "/café+/",
+    "/caf(é)?x/",
+    "/é{0,2}x/",
+    r"/ca[f\]]é*/",
+]
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    corpus = tmp_path_factory.mktemp("corpus")
+    for name, data in SAMPLES.items():
+        (corpus / name).write_bytes(data)
+    index_dir = tmp_path_factory.mktemp("index")
+    ngram_index.update_index(str(corpus), str(index_dir), gram=3, workers=1)
+    idx = ngram_index.NgramIndex(str(index_dir))
+    yield str(corpus), idx
+    idx.close()
+
+
+def _candidates(idx, rule: str) -> set:
+    ids = idx.candidates(main._prefilter_plan(rule))
+    if ids is None:
+        return set(SAMPLES)
+    return {idx.files[file_id][0] for file_id in ids}
+
+
+@pytest.mark.parametrize("pattern", PATTERNS)
+def test_regex_prefilter_keeps_every_match(index, pattern):
+    corpus, idx = index
+    rule = f"rule r {{ strings: $a = {pattern} condition: $a }}"
+    compiled = yara.compile(source=rule)
+    matched = {name for name in SAMPLES if compiled.match(os.path.join(corpus, name))}
+    assert matched <= _candidates(idx, rule)
+
+
+def test_literal_prefilter_narrows(index):
+    _, idx = index
+    assert _candidates(idx, 'rule r { strings: $a = "fooxbar" condition: $a }') == {"fooxbar"}
+
+
+@pytest.mark.parametrize("pattern", ["foo[\\]xyz]bar", "café*", "café?x"])
+def test_regex_runs_drop_optional_atoms(pattern):
+    alternatives, _ = main._regex_literal_runs(pattern)
+    for runs in alternatives:
+        for run in runs:
+            run.decode("utf-8")
+            assert b"]" not in run
+
+
+@pytest.mark.parametrize("pattern", ["ab{x", "(ab", "ab)", "[abc", "ab\\", "a\\xZZ"])
+def test_regex_runs_give_up_on_unknown_syntax(pattern):
+    assert main._regex_literal_runs(pattern)[0] is None
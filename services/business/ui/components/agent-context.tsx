@@ -356,19 +356,26 @@ export function AgentProvider({ children }: { children: React.ReactNode }) {
     if (!token) {
       throw new Error("Not authenticated");
     }
-    const res = await fetch(`${API_BASE}/yara/rules`, {
-      headers: withAuthHeaders(),
-    });
-    if (!res.ok) {
-      if (res.status === 401) {
-        handleUnauthorized();
+    const items: YaraRuleFile[] = [];
+    let cursor: string | null = null;
+    do {
+      const query: string = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+      const res: Response = await fetch(`${API_BASE}/yara/rules${query}`, {
+        headers: withAuthHeaders(),
+      });
+      if (!res.ok) {
+        if (res.status === 401) {
+          handleUnauthorized();
+        }
+        const msg = await res.text();
+        throw new Error(`HTTP ${res.status} ${msg}`);
       }
-      const msg = await res.text();
-      throw new Error(`HTTP ${res.status} ${msg}`);
-    }
-    const data = await res.json();
-    if (!Array.isArray(data)) return [];
-    return data.map(mapYaraRuleFile);
+      const data = await res.json();
+      if (!Array.isArray(data)) break;
+      items.push(...data.map(mapYaraRuleFile));
+      cursor = res.headers.get("X-Next-Cursor");
+    } while (cursor);
+    return items;
   }, [token, withAuthHeaders, handleUnauthorized]);
 
   const getYaraRule = useCallback(
@@ -214,6 +214,7 @@ def init_postgres_schema() -> None:
             cur.execute("ALTER TABLE agents_control_state ADD COLUMN IF NOT EXISTS sbom_json JSONB NOT NULL DEFAULT '[]'::jsonb")
             cur.execute("ALTER TABLE agents_control_state ADD COLUMN IF NOT EXISTS cve_json JSONB NOT NULL DEFAULT '[]'::jsonb")
             cur.execute("ALTER TABLE agents_control_state ADD COLUMN IF NOT EXISTS findings_count INTEGER NOT NULL DEFAULT 0")
+            cur.execute("ALTER TABLE agents_control_state ADD COLUMN IF NOT EXISTS policy_pinned BOOLEAN NOT NULL DEFAULT false")
             cur.execute(
                 """
                 CREATE INDEX IF NOT EXISTS idx_agents_control_state_ephemeral_lease
@@ -274,6 +275,97 @@ def init_postgres_schema() -> None:
                 ON agents_stale_state (archived_at DESC)
                 """
             )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS agent_packages (
+                    agent_id TEXT NOT NULL,
+                    tenant_id TEXT NOT NULL DEFAULT 'default',
+                    name TEXT NOT NULL,
+                    version TEXT NOT NULL DEFAULT '',
+                    ecosystem TEXT NOT NULL DEFAULT '',
+                    attributes_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    first_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (agent_id, name, version, ecosystem)
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_agent_packages_tenant_name_version
+                ON agent_packages (tenant_id, name, version, agent_id)
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS agent_cves (
+                    agent_id TEXT NOT NULL,
+                    tenant_id TEXT NOT NULL DEFAULT 'default',
+                    cve_id TEXT NOT NULL,
+                    package TEXT NOT NULL DEFAULT '',
+                    severity TEXT,
+                    status TEXT,
+                    attributes_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    first_seen TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (agent_id, cve_id, package)
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_agent_cves_tenant_cve
+                ON agent_cves (tenant_id, cve_id, agent_id)
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_agent_cves_attributes
+                ON agent_cves USING GIN (attributes_json jsonb_path_ops)
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS orchestrator_replicas (
+                    replica_id TEXT PRIMARY KEY,
+                    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS agent_routes (
+                    agent_id TEXT PRIMARY KEY,
+                    replica_id TEXT NOT NULL,
+                    connected_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_agent_routes_replica
+                ON agent_routes (replica_id)
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS replica_messages (
+                    id BIGSERIAL PRIMARY KEY,
+                    target_replica TEXT NOT NULL,
+                    source_replica TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    body_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_replica_messages_target
+                ON replica_messages (target_replica, id)
+                """
+            )
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS yara_rule_files (
@@ -304,6 +396,204 @@ def init_postgres_schema() -> None:
                 ON yara_rule_files (tenant_id, updated_at DESC)
                 """
             )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_yara_rule_files_object_key
+                ON yara_rule_files (object_key COLLATE "C")
+                """
+            )
+            cur.execute("ALTER TABLE yara_rule_files ADD COLUMN IF NOT EXISTS indexed_sha256 TEXT")
+            cur.execute("ALTER TABLE yara_rule_files ADD COLUMN IF NOT EXISTS index_claimed_at TIMESTAMPTZ")
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS yara_rule_index (
+                    tenant_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    rule_name TEXT NOT NULL,
+                    is_private BOOLEAN NOT NULL DEFAULT false,
+                    is_global BOOLEAN NOT NULL DEFAULT false,
+                    tags TEXT[] NOT NULL DEFAULT '{}',
+                    imports TEXT[] NOT NULL DEFAULT '{}',
+                    meta JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    string_ids TEXT[] NOT NULL DEFAULT '{}',
+                    literals TEXT[] NOT NULL DEFAULT '{}',
+                    condition_text TEXT NOT NULL DEFAULT '',
+                    literals_text TEXT NOT NULL DEFAULT '',
+                    search_text TEXT NOT NULL DEFAULT '',
+                    search_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, search_text)) STORED,
+                    PRIMARY KEY (tenant_id, file_name, rule_name)
+                )
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_yara_rule_index_tsv ON yara_rule_index USING GIN (search_tsv)")
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_yara_rule_index_search_trgm ON yara_rule_index USING GIN (search_text gin_trgm_ops)"
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_yara_rule_index_literals_trgm ON yara_rule_index USING GIN (literals_text gin_trgm_ops)"
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_yara_rule_index_tags ON yara_rule_index USING GIN (tags)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_yara_rule_index_imports ON yara_rule_index USING GIN (imports)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_yara_rule_index_meta ON yara_rule_index USING GIN (meta jsonb_path_ops)")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS yara_rule_versions (
+                    id BIGSERIAL PRIMARY KEY,
+                    tenant_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    version_id TEXT,
+                    sha256 TEXT,
+                    size_bytes BIGINT NOT NULL DEFAULT 0,
+                    etag TEXT,
+                    actor TEXT,
+                    action TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_yara_rule_versions_tenant_name
+                ON yara_rule_versions (tenant_id, name, id DESC)
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS yara_validation_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    engine TEXT NOT NULL,
+                    result_json JSONB NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_yara_validation_cache_created ON yara_validation_cache (created_at)"
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tenant_rule_policies (
+                    tenant_id TEXT PRIMARY KEY,
+                    max_rule_cost DOUBLE PRECISION,
+                    updated_by TEXT,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS yara_rule_profiles (
+                    tenant_id TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    corpus_id TEXT NOT NULL,
+                    engine TEXT NOT NULL,
+                    name TEXT,
+                    result_json JSONB NOT NULL,
+                    created_by TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (tenant_id, sha256, corpus_id, engine)
+                )
+                """
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_yara_rule_profiles_latest ON yara_rule_profiles (tenant_id, sha256, created_at DESC)"
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS retrohunt_jobs (
+                    id TEXT PRIMARY KEY,
+                    tenant_id TEXT NOT NULL,
+                    rule_sha256 TEXT NOT NULL,
+                    rule_source TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    prefix TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    owner_replica TEXT,
+                    sample_count BIGINT NOT NULL DEFAULT 0,
+                    shard_count INTEGER NOT NULL DEFAULT 0,
+                    shards_done INTEGER NOT NULL DEFAULT 0,
+                    files_scanned BIGINT NOT NULL DEFAULT 0,
+                    bytes_scanned BIGINT NOT NULL DEFAULT 0,
+                    match_count BIGINT NOT NULL DEFAULT 0,
+                    error_text TEXT,
+                    created_by TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    planned_at TIMESTAMPTZ,
+                    started_at TIMESTAMPTZ,
+                    heartbeat_at TIMESTAMPTZ,
+                    completed_at TIMESTAMPTZ
+                )
+                """
+            )
+            cur.execute("ALTER TABLE retrohunt_jobs ADD COLUMN IF NOT EXISTS candidate_count BIGINT")
+            cur.execute("ALTER TABLE retrohunt_jobs ADD COLUMN IF NOT EXISTS claim_token TEXT")
+            cur.execute("ALTER TABLE retrohunt_jobs ADD COLUMN IF NOT EXISTS rule_count INTEGER")
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_retrohunt_jobs_tenant_created ON retrohunt_jobs (tenant_id, created_at DESC)"
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_retrohunt_jobs_active
+                ON retrohunt_jobs (created_at) WHERE status IN ('queued', 'running')
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS retrohunt_shards (
+                    job_id TEXT NOT NULL REFERENCES retrohunt_jobs(id) ON DELETE CASCADE,
+                    shard_index INTEGER NOT NULL,
+                    sample_keys JSONB NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    files_scanned INTEGER NOT NULL DEFAULT 0,
+                    bytes_scanned BIGINT NOT NULL DEFAULT 0,
+                    completed_at TIMESTAMPTZ,
+                    PRIMARY KEY (job_id, shard_index)
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS retrohunt_matches (
+                    id BIGSERIAL PRIMARY KEY,
+                    job_id TEXT NOT NULL REFERENCES retrohunt_jobs(id) ON DELETE CASCADE,
+                    shard_index INTEGER NOT NULL,
+                    sample_key TEXT NOT NULL,
+                    rule_name TEXT NOT NULL,
+                    string_matches INTEGER NOT NULL DEFAULT 0,
+                    size_bytes BIGINT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    UNIQUE (job_id, sample_key, rule_name)
+                )
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_retrohunt_matches_job_id ON retrohunt_matches (job_id, id)")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS yara_metadata_sync_state (
+                    bucket TEXT PRIMARY KEY,
+                    cursor TEXT NOT NULL DEFAULT '',
+                    cycle_started_at TIMESTAMPTZ,
+                    last_cycle_completed_at TIMESTAMPTZ,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tenant_ruleset_bundles (
+                    tenant_id TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    bundle_sha256 TEXT NOT NULL,
+                    object_key TEXT NOT NULL,
+                    rule_count INTEGER NOT NULL DEFAULT 0,
+                    size_bytes BIGINT NOT NULL DEFAULT 0,
+                    manifest_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (tenant_id, version)
+                )
+                """
+            )
 
 
 def _minio_client() -> Minio: